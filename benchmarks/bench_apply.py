@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+# committed entries applied per second: through the queue adapter, with a
+# consumer thread taking them off one at a time the way make_server's
+# callers do, and through a state machine that takes each run as a batch.
+# entries go through the server's apply thread either way; the server is
+# only as much of one as apply_committed needs.
+from __future__ import print_function
+import sys
+import time
+import threading
+try:
+    import Queue
+except ImportError: # for python3
+    import queue as Queue
+
+from raft import log
+from raft import server
+from raft import statemachine
+
+
+class Counter(statemachine.StateMachine):
+    def __init__(self):
+        self.state = {}
+
+    def apply_batch(self, entries):
+        results = []
+        for _, data in entries:
+            count = self.state.get(data, 0) + 1
+            self.state[data] = count
+            results.append(count)
+        return results
+
+
+def build(n):
+    rl = log.RaftLog(None)
+    for i in range(1, n + 1):
+        msg = {'type': 'cq', 'id': 'q%d' % i, 'data': 'k%d' % (i % 100)}
+        rl.add(log.logentry(1, msg['id'], msg))
+    rl.commit(n, 1)
+    return rl
+
+
+def apply_all(rl, sm):
+    srv = server.Server.__new__(server.Server)
+    srv.log = rl
+    srv.role = 'leader'
+    srv.applier = statemachine.Applier(sm)
+    srv.applying = srv.apply_limit = 0
+    srv.commitidx = rl.get_commit_index()
+    srv.clients = {}
+    srv.reads_ready = []
+    srv.applier.start()
+    while srv.applier.applied < srv.commitidx:
+        srv.apply_committed()
+        time.sleep(0.001)
+    srv.applier.stop()
+
+
+def run_queue(rl):
+    queue = Queue.Queue()
+    n = rl.get_commit_index()
+
+    def consume():
+        for _ in range(n):
+            queue.get()
+
+    consumer = threading.Thread(target=consume)
+    start = time.time()
+    consumer.start()
+    apply_all(rl, statemachine.QueueStateMachine(queue))
+    consumer.join()
+    return n / (time.time() - start)
+
+
+def run_batch(rl):
+    n = rl.get_commit_index()
+    start = time.time()
+    apply_all(rl, Counter())
+    return n / (time.time() - start)
+
+
+def main(sizes):
+    for n in sizes:
+        rl = build(n)
+        print('%8d entries: queue %8.0f entries/s, apply_batch %8.0f '
+              'entries/s' % (n, run_queue(rl), run_batch(rl)))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [10000, 100000])
@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+# how long the server's loop spends handing committed entries over when
+# the state machine is slow: SLOW seconds per entry, with BATCH entries
+# committed per pass.  "inline" applies them before the pass ends, the way
+# the server used to; "thread" leaves them to the apply thread.
+from __future__ import print_function
+import sys
+import time
+
+from raft import log
+from raft import server
+from raft import statemachine
+
+SLOW = 0.0001
+BATCH = 100
+
+
+class Slow(statemachine.StateMachine):
+    def apply_batch(self, entries):
+        time.sleep(SLOW * len(entries))
+        return [None] * len(entries)
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100.0), len(samples) - 1)]
+
+
+def run(n, inline):
+    rl = log.RaftLog(None)
+    srv = server.Server.__new__(server.Server)
+    srv.log = rl
+    srv.role = 'leader'
+    srv.applier = statemachine.Applier(Slow())
+    srv.applying = srv.apply_limit = srv.commitidx = 0
+    srv.clients = {}
+    srv.reads_ready = []
+    if not inline:
+        srv.applier.start()
+    passes = []
+    for i in range(1, n + 1):
+        msg = {'type': 'cq', 'id': 'q%d' % i, 'data': 'x'}
+        rl.add(log.logentry(1, msg['id'], msg))
+        if i % BATCH == 0:
+            rl.commit(i, 1)
+            srv.commitidx = i
+            start = time.time()
+            srv.apply_committed()
+            if inline:
+                srv.applier.apply_pending()
+            passes.append(time.time() - start)
+    while srv.applier.applied < n:
+        srv.apply_committed()
+        time.sleep(0.001)
+    srv.applier.stop()
+    return passes
+
+
+def main(n):
+    for name, inline in (('inline', True), ('thread', False)):
+        passes = run(n, inline)
+        print('%-6s %6d entries: pass p50 %7.2f ms  p99 %7.2f ms  '
+              'max %7.2f ms' % (name, n, percentile(passes, 50) * 1e3,
+                                percentile(passes, 99) * 1e3,
+                                max(passes) * 1e3))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
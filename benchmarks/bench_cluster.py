@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# end to end: a real 3- and 5-node cluster on localhost, every node its own
+# process with its own state directory, driven over tcp by a RaftClient
+# that keeps CONCURRENCY commands outstanding.  for each payload size and
+# concurrency we measure commits/s, commit latency (p50, p99, p999), the
+# leader's cpu (cores in use) and replication lag (entries the slowest
+# follower is behind the leader), and print it all as json.
+#
+#     PYTHONPATH=. python benchmarks/bench_cluster.py [--out FILE]
+#         [--duration SECONDS] [--nodes 3,5] [--payloads 16,256,4096]
+#         [--concurrency 1,16,64]
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+
+import msgpack
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import localcluster
+
+
+def drive(client, payload, concurrency, duration):
+    # keep concurrency commands outstanding for duration seconds; returns
+    # the latency of every one that committed
+    data = b'x' * payload
+    sent = {}
+    latencies = []
+    end = time.time() + duration
+    while time.time() < end:
+        while len(sent) < concurrency:
+            msgid = uuid.uuid4().hex
+            client.tcp.send(client.cq_rpc(data, msgid), client.leader)
+            sent[msgid] = time.time()
+        for _, msgs in client.tcp.recv(0.01) or ():
+            now = time.time()
+            for raw in msgs:
+                msg = msgpack.unpackb(raw, use_list=False, encoding='utf-8')
+                if msg['type'] == 'cr' and msg['id'] in sent:
+                    latencies.append(now - sent.pop(msg['id']))
+    # let what's still outstanding drain, so it doesn't count against the
+    # next run
+    wait = time.time() + 1
+    while sent and time.time() < wait:
+        for _, msgs in client.tcp.recv(0.01) or ():
+            for raw in msgs:
+                msg = msgpack.unpackb(raw, use_list=False, encoding='utf-8')
+                sent.pop(msg['id'], None)
+    return latencies
+
+
+def ms(seconds):
+    return None if seconds is None else round(seconds * 1e3, 3)
+
+
+def run_cluster(size, payloads, concurrencies, duration):
+    cluster = localcluster.Cluster(size)
+    windows = []
+    try:
+        cluster.start_all()
+        client = localcluster.connect(cluster)
+        leader = localcluster.find_leader(client)
+        for payload in payloads:
+            for concurrency in concurrencies:
+                cpu = cluster.cpu(leader)
+                start = time.time()
+                lat = drive(client, payload, concurrency, duration)
+                elapsed = time.time() - start
+                windows.append((start, start + duration, {
+                    'nodes': size,
+                    'payload': payload,
+                    'concurrency': concurrency,
+                    'commits': len(lat),
+                    'commits_per_sec': round(len(lat) / float(duration), 1),
+                    'latency_ms': {
+                        'p50': ms(localcluster.percentile(lat, 50)),
+                        'p99': ms(localcluster.percentile(lat, 99)),
+                        'p999': ms(localcluster.percentile(lat, 99.9)),
+                    },
+                    'leader_cpu': round((cluster.cpu(leader) - cpu) /
+                                        elapsed, 3),
+                }))
+        stats = cluster.stop_all()
+    finally:
+        cluster.close()
+    # the leader sampled its followers' lag the whole time; each run gets
+    # the samples taken while it was going
+    samples = stats[leader]['lag']
+    results = []
+    for start, end, result in windows:
+        lag = [value for when, value in samples if start <= when < end]
+        result['replication_lag'] = {
+            'p50': localcluster.percentile(lag, 50),
+            'p99': localcluster.percentile(lag, 99),
+            'max': max(lag) if lag else None,
+        }
+        results.append(result)
+    return results
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--out', help='write the json here, not stdout')
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--nodes', default='3,5')
+    parser.add_argument('--payloads', default='16,256,4096')
+    parser.add_argument('--concurrency', default='1,16,64')
+    args = parser.parse_args(argv)
+
+    def ints(arg):
+        return [int(n) for n in arg.split(',')]
+    results = []
+    for size in ints(args.nodes):
+        results.extend(run_cluster(size, ints(args.payloads),
+                                   ints(args.concurrency), args.duration))
+    report = json.dumps({'duration': args.duration, 'results': results},
+                        indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as w:
+            w.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# per-ack cost on the leader as the log grows.  every ae_reply that moves
+# a follower's match_index goes through msg_recorded, which works out
+# where a quorum has got to and, if that's past the commit index,
+# commits it and hands the applier what's newly committed; this should
+# stay flat no matter how long the log is.  the leader is a real Server
+# on a MemoryStore with four followers, each acking batches of its own
+# size, the way pipelining cuts them.
+from __future__ import print_function
+import sys
+import time
+
+from raft import log
+from raft import server
+from raft import sim
+from raft import statemachine
+
+ACKS = 20000
+# entries per ack, for each follower
+BATCHES = {'f1': 3, 'f2': 5, 'f3': 7, 'f4': 11}
+
+
+class Nowhere(object):
+    def send(self, rpc, uuid):
+        pass
+
+
+class Discard(statemachine.StateMachine):
+    def apply_batch(self, entries):
+        return [None] * len(entries)
+
+
+def build(n):
+    peers = dict((uuid, ('127.0.0.1', 0)) for uuid in BATCHES)
+    store = sim.MemoryStore('leader', peers)
+    srv = server.Server(Discard(), 0, [], transport=Nowhere(),
+                        storage=store)
+    srv.term = 1
+    srv.role = 'leader'
+    for i in range(n):
+        srv.log.add(log.logentry(1, 'msg%d' % i, {}))
+    return srv
+
+
+def bench(n):
+    srv = build(n)
+    maxidx = srv.log.maxindex()
+    acks = min(maxidx - 1, ACKS)
+    base = maxidx - acks
+    srv.log.commit(base, 1)
+    srv.commitidx = srv.applying = srv.applier.applied = base
+    srv.match_index = {srv.uuid: maxidx}
+    for uuid in BATCHES:
+        srv.match_index[uuid] = base
+    count = 0
+    elapsed = 0.0
+    while count < acks:
+        start = time.time()
+        for uuid, size in sorted(BATCHES.items()):
+            index = min(srv.match_index[uuid] + size, maxidx)
+            srv.match_index[uuid] = index
+            srv.msg_recorded(dict(term=1, index=index, id=uuid))
+            count += 1
+        elapsed += time.time() - start
+        # the applier's work is its own thread's; don't let it pile up
+        srv.applier.apply_pending()
+    return elapsed / count
+
+
+def main(sizes):
+    for n in sizes:
+        print('%8d entries: %6.2f us/ack' % (n, bench(n) * 1e6))
+
+
+if __name__ == '__main__':
+    sizes = [int(x) for x in sys.argv[1:]] or [1000, 10000, 100000, 1000000]
+    main(sizes)
@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# memory spent remembering client msgids after a long run of commands:
+# a plain msgid -> index dict, which the log used to keep for every
+# entry it ever had, against the bounded window it keeps now.
+from __future__ import print_function
+import sys
+import time
+import tracemalloc
+
+from raft import log
+
+
+def unbounded(n):
+    seen = {}
+    for idx in range(n):
+        seen['%032x' % idx] = idx
+    return seen
+
+
+def window(n):
+    seen = log.MsgidWindow(log.DEDUPE_WINDOW)
+    for idx in range(n):
+        seen.add('%032x' % idx, idx)
+    return seen
+
+
+def measure(build, n):
+    tracemalloc.start()
+    start = time.time()
+    seen = build(n)
+    elapsed = time.time() - start
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del seen
+    return size, elapsed
+
+
+def main(n):
+    for build in (unbounded, window):
+        size, elapsed = measure(build, n)
+        print('%-9s %9d commands: %8.1f MB, %5.2f us/command' %
+              (build.__name__, n, size / 1e6, elapsed / n * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000000)
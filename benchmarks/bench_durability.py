@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# wal throughput and write-to-durable latency for each durability mode.
+# groups of commands are appended back to back, the way flush_commands
+# does under load, polling sync_if_due after each like the server loop;
+# a group's latency runs from when it's appended until the store says it's
+# durable.  run it against a tmpfs and a real disk:
+#
+#     python benchmarks/bench_durability.py /dev/shm /var/tmp
+from __future__ import print_function
+import sys
+import time
+import collections
+import shutil
+import tempfile
+
+from raft import log
+from raft import store
+
+GROUP = 16
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100.0), len(samples) - 1)]
+
+
+def run(base, mode, n):
+    tmp = tempfile.mkdtemp(dir=base)
+    try:
+        st = store.Store(0, tmp, durability=mode)
+        st.read_state()
+        rl = log.RaftLog(None)
+        payload = b'\xa4' + b'x' * 4  # a short msgpack string
+        latencies = []
+        waiting = collections.deque()
+        start = time.time()
+        for pos in range(0, n, GROUP):
+            began = time.time()
+            for i in range(pos, min(pos + GROUP, n)):
+                rl.add(log.logentry(1, 'q%d' % i, None, payload))
+            st.write_state(1, None, rl.take_unsaved(), {}, 'x')
+            waiting.append((rl.maxindex(), began))
+            durable = st.sync_if_due()
+            if pos + GROUP >= n:
+                durable = st.sync()
+            now = time.time()
+            while waiting and waiting[0][0] <= durable:
+                latencies.append(now - waiting.popleft()[1])
+        elapsed = time.time() - start
+        st.close()
+        return n / elapsed, latencies
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main(n, dirs):
+    for base in dirs:
+        for mode in (store.NONE, store.BATCH, store.STRICT):
+            rate, lat = run(base, mode, n)
+            print('%-12s %-6s %8.0f entries/s  p50 %7.2f ms  p99 %7.2f ms' %
+                  (base, mode, rate, percentile(lat, 50) * 1e3,
+                   percentile(lat, 99) * 1e3))
+
+
+if __name__ == '__main__':
+    dirs = sys.argv[1:] or ['/dev/shm', tempfile.gettempdir()]
+    main(5000, dirs)
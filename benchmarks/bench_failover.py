@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# how long writes are unavailable when the leader dies.  a real cluster on
+# localhost has its leader killed, over and over; each time we time how
+# long until one of the survivors wins an election and how long until a
+# client, trying every node that's left, gets a command committed, and
+# count the elections it took (more than one means a split vote, or a
+# candidate that timed out).  the killed node comes back before the next
+# trial.  the election and heartbeat timings are Server's, and can be set
+# from the command line to see what each costs; everything comes out as
+# json.
+#
+#     PYTHONPATH=. python benchmarks/bench_failover.py [--nodes 3]
+#         [--trials 10] [--out FILE] [--follower-timeout 0.5]
+#         [--follower-jitter 0.0] [--election-timeout 0.5,1.0]
+#         [--heartbeat-interval 0.3] [--poll-interval 0.15]
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import uuid
+import argparse
+
+import msgpack
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import localcluster
+
+# how often the client sends a fresh command while there's no leader
+RETRY = 0.01
+
+
+def first_commit(cluster, client, survivors, timeout=30):
+    # send a new command every RETRY seconds, going round the survivors
+    # and following redirects to any of them, until one commits
+    deadline = time.time() + timeout
+    target = 0
+    sent = set()
+    while time.time() < deadline:
+        msgid = uuid.uuid4().hex
+        client.tcp.send(client.cq_rpc(None, msgid), client.leader)
+        sent.add(msgid)
+        for _, msgs in client.tcp.recv(RETRY) or ():
+            for raw in msgs:
+                msg = msgpack.unpackb(raw, use_list=False, encoding='utf-8')
+                if msg['id'] not in sent:
+                    continue
+                if msg['type'] == 'cr':
+                    return time.time()
+                if msg['type'] == 'cr_rdr' and msg['leader'] in survivors:
+                    client.leader = msg['leader']
+                    client.tcp.connect(tuple(msg['addr']))
+                    target = None
+        if target is not None:
+            target = (target + 1) % len(survivors)
+            client.leader = survivors[target]
+    raise RuntimeError('nothing committed after %d seconds' % timeout)
+
+
+def new_leader(cluster, survivors, since, timeout=5):
+    # the survivor that won an election after since, with its stats
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        for uuid_ in survivors:
+            stats = cluster.stats(uuid_)
+            if stats and stats['elected'] and stats['elected'] > since:
+                return uuid_, stats
+        time.sleep(localcluster.SAMPLE)
+    raise RuntimeError('no new leader after %d seconds' % timeout)
+
+
+def settle(cluster, leader, timeout=10):
+    # wait until every node is in the leader's term and has caught up
+    # with what it's committed, so a trial starts from a steady cluster;
+    # returns the leader's stats
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        stats = dict((uuid_, cluster.stats(uuid_))
+                     for uuid_ in cluster.uuids)
+        ours = stats[leader]
+        if ours and ours['role'] == 'leader' and all(
+                other and other['term'] == ours['term'] and
+                other['commitidx'] >= ours['commitidx']
+                for other in stats.values()):
+            return ours
+        time.sleep(localcluster.SAMPLE)
+    raise RuntimeError('cluster did not settle')
+
+
+def trial(cluster, client):
+    localcluster.reconnect(cluster, client)
+    leader = localcluster.find_leader(client)
+    before = settle(cluster, leader)
+    survivors = [uuid_ for uuid_ in cluster.uuids if uuid_ != leader]
+    elections = sum(cluster.stats(uuid_)['elections'] for uuid_ in survivors)
+    killed = time.time()
+    cluster.kill(leader)
+    committed = first_commit(cluster, client, survivors)
+    winner, stats = new_leader(cluster, survivors, killed)
+    # elections can still be finishing up on the losers' side
+    time.sleep(localcluster.SAMPLE * 2)
+    elections = sum(cluster.stats(uuid_)['elections']
+                    for uuid_ in survivors) - elections
+    cluster.start(leader)
+    return {
+        'killed': leader,
+        'leader': winner,
+        'time_to_leader': round(stats['elected'] - killed, 4),
+        'time_to_commit': round(committed - killed, 4),
+        'terms': stats['term'] - before['term'],
+        'elections': elections,
+        'split_votes': stats['term'] - before['term'] - 1,
+    }
+
+
+def summary(samples):
+    return {
+        'mean': round(sum(samples) / float(len(samples)), 4),
+        'p50': localcluster.percentile(samples, 50),
+        'p90': localcluster.percentile(samples, 90),
+        'max': max(samples),
+    }
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--nodes', type=int, default=3)
+    parser.add_argument('--trials', type=int, default=10)
+    parser.add_argument('--out', help='write the json here, not stdout')
+    parser.add_argument('--follower-timeout', type=float)
+    parser.add_argument('--follower-jitter', type=float)
+    parser.add_argument('--election-timeout',
+                        help='the smallest and largest, as MIN,MAX')
+    parser.add_argument('--heartbeat-interval', type=float)
+    parser.add_argument('--poll-interval', type=float)
+    args = parser.parse_args(argv)
+
+    options = {}
+    for name in ('follower_timeout', 'follower_jitter',
+                 'heartbeat_interval', 'poll_interval'):
+        if getattr(args, name) is not None:
+            options[name] = getattr(args, name)
+    if args.election_timeout:
+        low, high = [float(n) for n in args.election_timeout.split(',')]
+        options['election_timeout_min'] = low
+        options['election_timeout_max'] = high
+
+    cluster = localcluster.Cluster(args.nodes, options=options)
+    try:
+        cluster.start_all()
+        client = localcluster.connect(cluster)
+        trials = [trial(cluster, client) for _ in range(args.trials)]
+    finally:
+        cluster.close()
+    report = json.dumps({
+        'nodes': args.nodes,
+        'options': options,
+        'time_to_leader': summary([t['time_to_leader'] for t in trials]),
+        'time_to_commit': summary([t['time_to_commit'] for t in trials]),
+        'split_votes': sum(t['split_votes'] for t in trials),
+        'trials': trials,
+    }, indent=2, sort_keys=True)
+    if args.out:
+        with open(args.out, 'w') as w:
+            w.write(report + '\n')
+    else:
+        print(report)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+# reads answered by a follower: within a staleness bound, straight from
+# its own state, or at a read index it asks the leader for (one request
+# per batch of reads).  the follower is a real Server with a real store;
+# the leader is faked by the channel, which answers read index requests
+# straight away.  every replica can do this much on top of what the
+# leader does, so read capacity grows with the size of the cluster.
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+
+import msgpack
+
+from raft import server
+from raft import statemachine
+
+BATCH = 100
+LEADER = 'leader'
+
+
+class Channel(object):
+    def __init__(self, commitidx):
+        self.commitidx = commitidx
+        self.replies = []
+        self.answers = 0
+
+    def send(self, rpc, uuid):
+        msg = msgpack.unpackb(rpc, use_list=False, encoding='utf-8')
+        if uuid != LEADER:
+            self.answers += msg['type'] == 'cr'
+        elif msg['type'] == 'ri':
+            self.replies.append(dict(type='ri_reply', term=1, id=LEADER,
+                                     round=msg['round'],
+                                     index=self.commitidx))
+
+    def writable(self, uuid):
+        return True
+
+    def deliver(self, srv):
+        replies, self.replies = self.replies, []
+        for msg in replies:
+            srv.handle_message(msgpack.packb(msg), msg['id'])
+
+
+class Counter(statemachine.StateMachine):
+    def __init__(self):
+        self.count = 0
+
+    def apply_batch(self, entries):
+        self.count += len(entries)
+        return [self.count] * len(entries)
+
+    def read(self, query):
+        return self.count
+
+
+def follower(port):
+    chan = Channel(0)
+    server.channel.start = lambda *args: chan
+    srv = server.Server(Counter(), port, [])
+    srv.term = 1
+    srv.leader = LEADER
+    srv.peers[LEADER] = ('127.0.0.1', 0)
+    srv.last_update = float('inf')
+    chan.commitidx = srv.commitidx
+    return srv, chan
+
+
+def run(n, max_lag):
+    port = 20000 + os.getpid() % 10000
+    path = '/tmp/raft-state-%d' % port
+    try:
+        srv, chan = follower(port)
+        start = time.time()
+        for pos in range(0, n, BATCH):
+            for i in range(pos, min(pos + BATCH, n)):
+                rpc = msgpack.packb(dict(type='rq', id='q%d' % i, data=i,
+                                         max_lag=max_lag))
+                srv.handle_message(rpc, 'client')
+            while chan.answers < min(pos + BATCH, n):
+                srv.flush_reads()
+                chan.deliver(srv)
+                srv.apply_committed()
+                srv.applier.apply_pending()
+                srv.apply_committed()
+        elapsed = time.time() - start
+        srv.store.close()
+        return n / elapsed
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main(n):
+    for name, max_lag in (('readindex', None), ('stale', 10)):
+        print('%-9s %6d reads: %8.0f reads/s' % (name, n, run(n, max_lag)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
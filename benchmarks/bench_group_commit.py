@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+# leader commits/sec as concurrent clients go up.  every client keeps one
+# command outstanding, so each pass through the event loop brings in one
+# command per client.  "single" writes the wal and the metadata and sends
+# an append entries to every follower for each command, the way the
+# leader used to; "grouped" does that once per pass, like flush_commands.
+# commands from the previous pass are treated as committed, which moves
+# the commit index (and so the metadata) every time.
+from __future__ import print_function
+import sys
+import time
+import shutil
+import tempfile
+
+import msgpack
+
+from raft import log
+from raft import store
+
+FOLLOWERS = 4
+
+
+def replicate(rl, previdx, commitidx):
+    window = rl.logs_after_index(previdx, len(rl.entries))
+    for _ in range(FOLLOWERS):
+        rpc = {'type': 'ae', 'term': 1, 'id': 'leader', 'previdx': previdx,
+               'prevterm': 1, 'commitidx': commitidx}
+        log.packmap(rpc, {'entries': log.pack_entries(window)})
+
+
+def single(st, rl, batch):
+    for msgid, raw in batch:
+        idx = rl.add(log.logentry(1, msgid, None, raw))
+        st.write_state(1, None, rl.take_unsaved(), {}, 'leader',
+                       rl.get_commit_index())
+        replicate(rl, idx - 1, rl.get_commit_index())
+
+
+def grouped(st, rl, batch):
+    first = rl.maxindex()
+    for msgid, raw in batch:
+        rl.add(log.logentry(1, msgid, None, raw))
+    st.write_state(1, None, rl.take_unsaved(), {}, 'leader',
+                   rl.get_commit_index())
+    replicate(rl, first, rl.get_commit_index())
+
+
+def run(path, n, clients):
+    tmp = tempfile.mkdtemp()
+    try:
+        st = store.Store(0, tmp)
+        st.read_state()
+        rl = log.RaftLog(None)
+        queries = [('q%d' % i, msgpack.packb({'type': 'cq', 'id': 'q%d' % i,
+                                              'data': 'x' * 64}))
+                   for i in range(n)]
+        start = time.time()
+        for pos in range(0, n, clients):
+            rl.commit(rl.maxindex(), rl.get_term_of(rl.maxindex()))
+            path(st, rl, queries[pos:pos + clients])
+        elapsed = time.time() - start
+        st.close()
+        return n / elapsed
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main(n):
+    for clients in (1, 4, 16, 64, 256):
+        print('%4d clients: single %8.0f commits/s, grouped %8.0f commits/s' %
+              (clients, run(single, n, clients), run(grouped, n, clients)))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
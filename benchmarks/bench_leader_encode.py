@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+# leader cpu per committed command for the encode-heavy part of the
+# pipeline: decode the client query, append it to the log and the wal,
+# and build an append entries rpc carrying it for every follower.
+# "repack" keeps dict entries and packs them again every time, the way
+# the leader used to; "cached" splices in each entry's cached encoding.
+from __future__ import print_function
+import sys
+import time
+import shutil
+import tempfile
+
+import msgpack
+
+from raft import log
+from raft import store
+
+FOLLOWERS = 4
+BATCH = 50
+cpu = getattr(time, 'process_time', time.time)
+
+
+def repack(st, queries):
+    logs = {}
+    for idx, raw in enumerate(queries, 1):
+        msg = msgpack.unpackb(raw, use_list=False, encoding='utf-8')
+        logs[idx] = {'index': idx, 'term': 1, 'msgid': msg['id'],
+                     'committed': False, 'acked': [], 'msg': msg}
+        st.active.write(store.frame(msgpack.packb(logs[idx])))
+        st.active.flush()
+        window = dict((x, logs[x]) for x in range(max(idx - BATCH, 1), idx + 1))
+        for _ in range(FOLLOWERS):
+            msgpack.packb({'type': 'ae', 'term': 1, 'id': 'leader',
+                           'previdx': idx - BATCH, 'prevterm': 1,
+                           'commitidx': idx - BATCH, 'entries': window})
+
+
+def cached(st, queries):
+    rl = log.RaftLog(None)
+    for raw in queries:
+        msg = msgpack.unpackb(raw, use_list=False, encoding='utf-8')
+        idx = rl.add(log.logentry(1, msg['id'], msg, raw))
+        st.append(rl.take_unsaved())
+        window = rl.logs_after_index(max(idx - BATCH - 1, 0))
+        for _ in range(FOLLOWERS):
+            rpc = {'type': 'ae', 'term': 1, 'id': 'leader',
+                   'previdx': idx - BATCH, 'prevterm': 1,
+                   'commitidx': idx - BATCH}
+            log.packmap(rpc, {'entries': log.pack_entries(window)})
+
+
+def run(path, n, payload):
+    tmp = tempfile.mkdtemp()
+    try:
+        st = store.Store(0, tmp)
+        st.read_state()
+        st.roll()
+        queries = [msgpack.packb({'type': 'cq', 'id': 'q%d' % i,
+                                  'data': payload}) for i in range(n)]
+        start = cpu()
+        path(st, queries)
+        elapsed = cpu() - start
+        st.close()
+        return elapsed / n
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main(n):
+    for size in (16, 256, 4096):
+        payload = 'x' * size
+        print('%5d byte payloads: repack %7.1f us/cmd, cached %7.1f us/cmd' %
+              (size, run(repack, n, payload) * 1e6,
+               run(cached, n, payload) * 1e6))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 5000)
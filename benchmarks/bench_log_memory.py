@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+# bytes per log entry, before the payload, for the old representation
+# (a dict per entry in a dict keyed by index) and for RaftLog.
+from __future__ import print_function
+import sys
+import tracemalloc
+
+from raft import log
+
+
+def old_log(n, msg):
+    logs = {}
+    for i in range(n):
+        logs[i] = {'index': i, 'term': 1, 'msgid': 'msg%d' % i,
+                   'committed': True, 'acked': [], 'msg': msg}
+    return logs
+
+
+def new_log(n, msg):
+    rl = log.RaftLog(None)
+    for i in range(n):
+        rl.add(log.logentry(1, 'msg%d' % i, msg))
+    rl.take_unsaved()
+    return rl
+
+
+def measure(build, n):
+    msg = {}  # shared, so only the per-entry overhead gets counted
+    tracemalloc.start()
+    start = tracemalloc.get_traced_memory()[0]
+    obj = build(n, msg)
+    used = tracemalloc.get_traced_memory()[0] - start
+    tracemalloc.stop()
+    del obj
+    return float(used) / n
+
+
+def main(n):
+    print('%d entries' % n)
+    print('  dict of dicts: %6.1f bytes/entry' % measure(old_log, n))
+    print('  RaftLog:       %6.1f bytes/entry' % measure(new_log, n))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+# how long writes are unavailable around a partition, in a simulated
+# 5-node cluster with CLIENTS clients each keeping one command
+# outstanding.  two cases:
+#
+#   follower: one follower is cut off for ISOLATE seconds and comes back.
+#     without pre-vote it calls election after election while it's away,
+#     and its term, when it's back, deposes the leader.
+#   leader: the leader is cut off, and the rest elect another.  with
+#     check-quorum the old one notices and stands down.
+#
+# for each we report the longest the clients went without a commit, from
+# the partition until SETTLE seconds after it heals, the terms the
+# cluster went through and how long a cut-off leader went on thinking it
+# was one; averaged over SEEDS runs.
+from __future__ import print_function
+import sys
+
+from raft import sim
+
+CLIENTS = 3
+ISOLATE = 3.0
+SETTLE = 3.0
+SEEDS = 3
+ABANDON = 1.0
+
+OPTIONS = (
+    ('plain', {}),
+    ('prevote', {'pre_vote': True}),
+    ('prevote+cq', {'pre_vote': True, 'check_quorum': True}),
+)
+
+
+def drive(cluster, clients, waiting, until):
+    # step until the clock reaches until, keeping every client busy.  a
+    # command still unanswered after ABANDON seconds is given up on for a
+    # new one: a retry of one applied while no leader had its client gets
+    # only an ack, never the result.
+    while cluster.clock() < until:
+        cluster.step()
+        now = cluster.clock()
+        for cl in clients:
+            item = cl.outstanding.get(waiting[cl.uuid])
+            if item is not None and now - item[2] >= ABANDON:
+                del cl.outstanding[waiting[cl.uuid]]
+                item = None
+            if item is None:
+                waiting[cl.uuid] = cl.send(['k', len(cl.done)])
+
+
+def run(case, options, seed):
+    cluster = sim.Cluster(5, seed=seed, options=options)
+    cluster.run_until(lambda: cluster.leader() is not None, 10)
+    clients = [cluster.client() for _ in range(CLIENTS)]
+    waiting = dict((cl.uuid, cl.send(['k', 0])) for cl in clients)
+    drive(cluster, clients, waiting, cluster.clock() + 1)
+    leader = cluster.leader()
+    term = leader.term
+    if case == 'leader':
+        cut = leader.uuid
+    else:
+        cut = min(uuid for uuid in cluster.uuids if uuid != leader.uuid)
+    rest = [uuid for uuid in cluster.uuids if uuid != cut]
+    start = cluster.clock()
+    cluster.network.partition([cut], rest + [cl.uuid for cl in clients])
+    # how long the cut-off node went on leading
+    deposed = None
+    while cluster.clock() < start + ISOLATE:
+        drive(cluster, clients, waiting, cluster.clock() + 0.01)
+        if deposed is None and cluster.servers[cut].role != 'leader':
+            deposed = cluster.clock() - start
+    cluster.network.heal()
+    drive(cluster, clients, waiting, start + ISOLATE + SETTLE)
+    finished = sorted(end for cl in clients
+                      for _, end, _ in cl.done.values() if end >= start)
+    ends = [start] + finished + [start + ISOLATE + SETTLE]
+    gaps = [b - a for a, b in zip(ends, ends[1:])]
+    return {
+        'gap': max(gaps),
+        'terms': max(srv.term for srv in cluster.servers.values()) - term,
+        'deposed': deposed if case == 'leader' else None,
+    }
+
+
+def main(seeds):
+    for case in ('follower', 'leader'):
+        for name, options in OPTIONS:
+            runs = [run(case, options, seed) for seed in range(seeds)]
+            gap = sum(r['gap'] for r in runs) / len(runs)
+            terms = sum(r['terms'] for r in runs) / float(len(runs))
+            line = '%-8s %-10s  longest gap %5.0f ms (max %5.0f)  ' \
+                '%4.1f terms' % (case, name, gap * 1e3,
+                                 max(r['gap'] for r in runs) * 1e3, terms)
+            if case == 'leader':
+                deposed = [r['deposed'] for r in runs]
+                if None in deposed:
+                    line += '  old leader never stood down'
+                else:
+                    line += '  old leader stood down after %4.0f ms' % (
+                        sum(deposed) / len(deposed) * 1e3)
+            print(line)
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else SEEDS)
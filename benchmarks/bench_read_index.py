@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# what a read costs the leader as a command pushed through the log (a wal
+# write, replication and an apply) against a ReadIndex read (a round of
+# heartbeats shared by every read that came in together) and a lease read
+# (no round at all while the lease lasts).  the leader is
+# a real Server with a real store; its two followers are faked by the
+# channel, which answers whatever it's sent straight away.
+from __future__ import print_function
+import os
+import sys
+import time
+import shutil
+
+import msgpack
+
+from raft import server
+from raft import statemachine
+
+BATCH = 100
+FOLLOWERS = ('f1', 'f2')
+
+
+class Channel(object):
+    def __init__(self):
+        self.replies = []
+        self.answers = 0
+
+    def send(self, rpc, uuid):
+        msg = msgpack.unpackb(rpc, use_list=False, encoding='utf-8')
+        if uuid not in FOLLOWERS:
+            self.answers += msg['type'] == 'cr'
+            return
+        if msg['type'] != 'ae':
+            return
+        if msg['entries']:
+            self.replies.append(dict(type='ae_reply', term=msg['term'],
+                                     id=uuid, index=max(msg['entries']),
+                                     success=True, conflict_term=None,
+                                     conflict_index=None))
+        if msg['round']:
+            self.replies.append(dict(type='round_reply', term=msg['term'],
+                                     id=uuid, round=msg['round']))
+
+    def writable(self, uuid):
+        return True
+
+    def deliver(self, srv):
+        replies, self.replies = self.replies, []
+        for msg in replies:
+            srv.handle_message(msgpack.packb(msg), msg['id'])
+
+
+class Counter(statemachine.StateMachine):
+    def __init__(self):
+        self.count = 0
+
+    def apply_batch(self, entries):
+        self.count += len(entries)
+        return [self.count] * len(entries)
+
+    def read(self, query):
+        return self.count
+
+
+def leader(port, lease):
+    chan = Channel()
+    server.channel.start = lambda *args: chan
+    srv = server.Server(Counter(), port, [])
+    srv.term = 1
+    srv.read_lease = lease
+    srv.role = 'leader'
+    srv.last_update = float('inf')
+    for uuid in FOLLOWERS:
+        srv.peers[uuid] = ('127.0.0.1', 0)
+        srv.next_index[uuid] = srv.log.maxindex()
+    return srv, chan
+
+
+def settle(srv, chan, expected):
+    while chan.answers < expected:
+        srv.flush_commands()
+        srv.release_durable()
+        srv.flush_reads()
+        chan.deliver(srv)
+        srv.applier.apply_pending()
+        srv.apply_committed()
+
+
+def disk_usage(path):
+    return sum(os.path.getsize(os.path.join(path, name))
+               for name in os.listdir(path))
+
+
+def run(n, mtype, lease=False):
+    port = 20000 + os.getpid() % 10000
+    path = '/tmp/raft-state-%d' % port
+    try:
+        srv, chan = leader(port, lease)
+        # commit something of our term first, so reads can go
+        srv.handle_message(msgpack.packb(dict(type='cq', id='first',
+                                              data=0)), 'client')
+        settle(srv, chan, 1)
+        chan.answers = 0
+        walsize = disk_usage(path)
+        start = time.time()
+        for pos in range(0, n, BATCH):
+            for i in range(pos, min(pos + BATCH, n)):
+                rpc = msgpack.packb(dict(type=mtype, id='q%d' % i, data=i))
+                srv.handle_message(rpc, 'client')
+            settle(srv, chan, min(pos + BATCH, n))
+        elapsed = time.time() - start
+        walsize = disk_usage(path) - walsize
+        srv.store.close()
+        return n / elapsed, walsize / float(n)
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def main(n):
+    for name, mtype, lease in (('log', 'cq', False),
+                               ('readindex', 'rq', False),
+                               ('lease', 'rq', True)):
+        rate, walbytes = run(n, mtype, lease)
+        print('%-9s %6d reads: %8.0f reads/s, %6.1f wal bytes/read' %
+              (name, n, rate, walbytes))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
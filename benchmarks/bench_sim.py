@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# commit latency and throughput of a simulated cluster, in simulated
+# time: CLIENTS clients each keep one command outstanding for DURATION
+# seconds, over a network with 0.5-1.5 ms of latency.  the numbers only
+# depend on the seed, so they're comparable from run to run; the wall
+# time is what it cost to simulate.
+from __future__ import print_function
+import sys
+import time
+
+from raft import sim
+
+CLIENTS = 10
+DURATION = 2.0
+
+
+def percentile(samples, pct):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100.0), len(samples) - 1)]
+
+
+def run(size, seed):
+    cluster = sim.Cluster(size, seed=seed)
+    cluster.run_until(lambda: cluster.leader() is not None, 10)
+    clients = [cluster.client() for _ in range(CLIENTS)]
+    waiting = dict((cl.uuid, cl.send(['k', 0])) for cl in clients)
+    start = cluster.clock()
+    began = time.time()
+    while cluster.clock() < start + DURATION:
+        cluster.step()
+        for cl in clients:
+            if waiting[cl.uuid] in cl.done:
+                waiting[cl.uuid] = cl.send(['k', len(cl.done)])
+    latencies = [end - begin for cl in clients
+                 for begin, end, _ in cl.done.values() if begin >= start]
+    return (len(latencies) / DURATION, latencies, time.time() - began)
+
+
+def main(sizes, seed):
+    for size in sizes:
+        rate, lat, wall = run(size, seed)
+        print('%d nodes: %7.0f commits/s  p50 %6.2f ms  p99 %6.2f ms  '
+              '(%.1f s to simulate)' %
+              (size, rate, percentile(lat, 50) * 1e3,
+               percentile(lat, 99) * 1e3, wall))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [3, 5, 9], 0)
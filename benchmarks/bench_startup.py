@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# how long a node takes to get from starting up to having a log it can
+# vote and take append entries with: reading the store and building the
+# RaftLog.  "scan" has to read the whole wal; "checkpoint" has one taken
+# TAIL entries before the end.
+from __future__ import print_function
+import sys
+import time
+import shutil
+import tempfile
+
+from raft import log
+from raft import store
+
+PAYLOAD = b'\xa4' + b'x' * 4  # a short msgpack string
+TAIL = 1000
+
+
+def build(path, n, checkpoint):
+    st = store.Store(0, path, durability=store.NONE)
+    st.read_state()
+    rl = log.RaftLog(None, st)
+    for i in range(1, n + 1):
+        rl.add(log.logentry(1, 'msg%d' % i, None, PAYLOAD))
+        if i % 10000 == 0:
+            st.write_state(1, None, rl.take_unsaved(), {}, 'x')
+        if checkpoint and n - i == TAIL:
+            st.write_state(1, None, rl.take_unsaved(), {}, 'x')
+            st.write_checkpoint(*rl.index_state())
+    rl.commit(n, 1)
+    st.write_state(1, None, rl.take_unsaved(), {}, 'x', n)
+    st.close()
+
+
+def start(path):
+    began = time.time()
+    st = store.Store(0, path, durability=store.NONE)
+    _, _, llog, _, _ = st.read_state()
+    rl = log.RaftLog(llog, st)
+    elapsed = time.time() - began
+    st.close()
+    return elapsed
+
+
+def run(n, checkpoint):
+    tmp = tempfile.mkdtemp()
+    try:
+        build(tmp, n, checkpoint)
+        return start(tmp)
+    finally:
+        shutil.rmtree(tmp)
+
+
+def main(sizes):
+    for n in sizes:
+        print('%8d entries: scan %7.2f s, checkpoint %7.2f s' %
+              (n, run(n, False), run(n, True)))
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [10000, 100000, 1000000])
@@ -0,0 +1,48 @@
+#!/usr/bin/env python
+# frames/sec through raft.tcp over loopback, for small and large frames.
+from __future__ import print_function
+import sys
+import time
+
+import raft.tcp as tcp
+
+
+def connect(readsize):
+    a = tcp.start(0, 'a', readsize=readsize)
+    b = tcp.start(0, 'b', readsize=readsize)
+    a.connect(('127.0.0.1', b.srv.getsockname()[1]))
+    while 'b' not in a or 'a' not in b:
+        a.recv(0.01)
+        b.recv(0.01)
+    return a, b
+
+
+def run(a, b, size, count):
+    msg = b'x' * size
+    got = 0
+    sent = 0
+    start = time.time()
+    while got < count:
+        while sent < count and a.writable('b'):
+            a.send(msg, 'b')
+            sent += 1
+        a.recv(0)  # flushes whatever's queued
+        for _, msgs in b.recv(0.001) or []:
+            got += len(msgs)
+    return time.time() - start
+
+
+def main(readsize):
+    a, b = connect(readsize)
+    try:
+        for size, count in ((100, 200000), (1024 * 1024, 500)):
+            elapsed = run(a, b, size, count)
+            print('%8d byte frames: %9.0f frames/sec, %7.1f MB/sec' %
+                  (size, count / elapsed, size * count / elapsed / 1e6))
+    finally:
+        a.shutdown()
+        b.shutdown()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else tcp.READ_SIZE)
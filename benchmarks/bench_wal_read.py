@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# recovering a log from the wal, and serving a follower that's far behind
+# out of it.  only entries from the commit index on are loaded; anything
+# older is read out of the mapped segments on demand, so peak memory on
+# startup should track the uncommitted tail rather than the whole log.
+from __future__ import print_function
+import sys
+import time
+import shutil
+import tempfile
+import tracemalloc
+
+from raft import log
+from raft import store
+
+PAYLOAD = b'\xda\x01\x00' + b'x' * 256  # a 256 byte msgpack string
+TAIL = 1000
+
+
+def build(path, n):
+    st = store.Store(0, path, durability=store.NONE)
+    st.read_state()
+    rl = log.RaftLog(None, st)
+    for i in range(1, n + 1):
+        rl.add(log.logentry(1, 'msg%d' % i, None, PAYLOAD))
+        if i % 10000 == 0:
+            st.write_state(1, None, rl.take_unsaved(), {}, 'x')
+    rl.commit(n - TAIL, 1)
+    st.write_state(1, None, rl.take_unsaved(), {}, 'x', n - TAIL)
+    st.close()
+
+
+def recover(path):
+    start = time.time()
+    st = store.Store(0, path, durability=store.NONE)
+    _, _, llog, _, _ = st.read_state()
+    rl = log.RaftLog(llog, st)
+    return st, rl, time.time() - start
+
+
+def peak_memory(path):
+    tracemalloc.start()
+    st, _, _ = recover(path)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    st.close()
+    return peak
+
+
+def catch_up(rl):
+    # a follower starting from nothing, in full-size batches
+    start = time.time()
+    index = 0
+    sent = 0
+    while index < rl.maxindex():
+        logs = rl.logs_after_index(index, 1000, 1024 * 1024)
+        log.pack_entries(logs)
+        index = max(logs)
+        sent += len(logs)
+    return sent / (time.time() - start)
+
+
+def main(sizes):
+    for n in sizes:
+        tmp = tempfile.mkdtemp()
+        try:
+            build(tmp, n)
+            peak = peak_memory(tmp)
+            st, rl, elapsed = recover(tmp)
+            rate = catch_up(rl)
+            st.close()
+            print('%8d entries: recovery %6.2f s, peak %7.1f MB, '
+                  'catch-up %8.0f entries/s' %
+                  (n, elapsed, peak / 1e6, rate))
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    main([int(n) for n in sys.argv[1:]] or [10000, 100000])
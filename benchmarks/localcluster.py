@@ -0,0 +1,219 @@
+# a real cluster on localhost for the end-to-end benchmarks: one process
+# per node, each with its own port and state directory.  every node keeps
+# a file of stats up to date, and adds the follower lag it saw as leader
+# when it's stopped.  run as a script, this is a node:
+#
+#     python benchmarks/localcluster.py UUID PORT PATH STATS OPTIONS \
+#         PEER=PORT...
+from __future__ import print_function
+import os
+import sys
+import json
+import time
+import signal
+import shutil
+import tempfile
+import uuid as uuid_
+import subprocess
+
+import msgpack
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from raft import client as rclient
+from raft import server
+from raft import store
+from raft import statemachine
+
+# how often a node samples how far behind its followers are
+SAMPLE = 0.05
+
+
+class Discard(statemachine.StateMachine):
+    # the benchmarks only care that commands were applied
+    def apply_batch(self, entries):
+        return [None] * len(entries)
+
+    def restore(self, data):
+        pass
+
+    def read(self, query):
+        return None
+
+
+class Cluster(object):
+    # size nodes on ports base, base + 1, ..., n0 to n(size - 1); options
+    # are set on every node's Server
+    def __init__(self, size, base=None, options=None):
+        self.size = size
+        # below the ephemeral range, so no outgoing connection can be
+        # holding a port while its node is down
+        self.base = base or 20000 + os.getpid() % 10000
+        self.options = options or {}
+        self.uuids = ['n%d' % i for i in range(size)]
+        self.tmp = tempfile.mkdtemp(prefix='raft-bench-')
+        self.procs = {}
+
+    def port(self, uuid):
+        return self.base + self.uuids.index(uuid)
+
+    def addr(self, uuid):
+        return ('127.0.0.1', self.port(uuid))
+
+    def stats_file(self, uuid):
+        return os.path.join(self.tmp, uuid + '.json')
+
+    def start(self, uuid):
+        peers = ['%s=%d' % (peer, self.port(peer))
+                 for peer in self.uuids if peer != uuid]
+        if os.path.exists(self.stats_file(uuid)):
+            os.remove(self.stats_file(uuid))
+        cmd = [sys.executable, os.path.abspath(__file__), uuid,
+               str(self.port(uuid)), os.path.join(self.tmp, uuid),
+               self.stats_file(uuid), json.dumps(self.options)] + peers
+        with open(os.devnull, 'w') as devnull:
+            self.procs[uuid] = subprocess.Popen(cmd, stdout=devnull)
+
+    def start_all(self):
+        for uuid in self.uuids:
+            self.start(uuid)
+
+    def kill(self, uuid):
+        # no goodbyes, no stats
+        proc = self.procs.pop(uuid)
+        proc.kill()
+        proc.wait()
+
+    def cpu(self, uuid):
+        # seconds of cpu a node has used so far, user and system
+        with open('/proc/%d/stat' % self.procs[uuid].pid) as r:
+            fields = r.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / \
+            float(os.sysconf('SC_CLK_TCK'))
+
+    def stats(self, uuid):
+        # the latest a node has written, if it's written anything yet
+        try:
+            with open(self.stats_file(uuid)) as r:
+                return json.load(r)
+        except (IOError, ValueError):
+            return None
+
+    def stop(self, uuid):
+        proc = self.procs.pop(uuid)
+        proc.send_signal(signal.SIGTERM)
+        proc.wait()
+        return self.stats(uuid)
+
+    def stop_all(self):
+        return dict((uuid, self.stop(uuid)) for uuid in list(self.procs))
+
+    def close(self):
+        for uuid in list(self.procs):
+            self.kill(uuid)
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * pct / 100.0), len(samples) - 1)]
+
+
+def connect(cluster, timeout=10):
+    # a RaftClient connected to every node that's up
+    deadline = time.time() + timeout
+    while True:
+        try:
+            client = rclient.RaftClient(cluster.addr(cluster.uuids[0]))
+            break
+        except rclient.NoConnection:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+    reconnect(cluster, client)
+    return client
+
+
+def reconnect(cluster, client):
+    for uuid in cluster.procs:
+        if uuid not in client.tcp:
+            client.tcp.connect(cluster.addr(uuid))
+
+
+def find_leader(client, timeout=30):
+    # send a command until it commits, following redirects; afterwards
+    # client.leader is the leader
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        msgid = uuid_.uuid4().hex
+        client.tcp.send(client.cq_rpc(None, msgid), client.leader)
+        wait = time.time() + 0.5
+        while time.time() < wait:
+            for _, msgs in client.tcp.recv(0.05) or ():
+                for raw in msgs:
+                    msg = msgpack.unpackb(raw, use_list=False,
+                                          encoding='utf-8')
+                    if msg['id'] != msgid:
+                        continue
+                    if msg['type'] == 'cr':
+                        return client.leader
+                    if msg['type'] == 'cr_rdr':
+                        client.leader = msg['leader']
+                        client.tcp.connect(tuple(msg['addr']))
+    raise RuntimeError('no leader after %d seconds' % timeout)
+
+
+def write_stats(srv, stats, **extra):
+    # written whole and renamed into place, so readers never see half
+    info = {
+        'uuid': srv.uuid,
+        'role': srv.role,
+        'term': srv.term,
+        'commitidx': srv.commitidx,
+        'applied': srv.applier.applied,
+        'elections': srv.elections,
+        'elected': srv.elected,
+    }
+    info.update(extra)
+    with open(stats + '.tmp', 'w') as w:
+        json.dump(info, w)
+    os.rename(stats + '.tmp', stats)
+
+
+def run_node(uuid, port, path, stats, options, peers):
+    st = store.Store(port, path)
+    if st.read_meta() is None:
+        # a fresh node: it knows the rest of the cluster from the start
+        st.read_state()
+        st.write_state(0, None, [], peers, uuid)
+    st.close()
+    srv = server.Server(Discard(), port, [],
+                        storage=store.Store(port, path))
+    for name, value in options.items():
+        setattr(srv, name, value)
+    srv.daemon = True
+    srv.start()
+    stopping = []
+    signal.signal(signal.SIGTERM, lambda *args: stopping.append(True))
+    lag = []
+    while not stopping:
+        time.sleep(SAMPLE)
+        if srv.role == 'leader':
+            # entries the slowest follower has yet to take, and when
+            match = [srv.match_index.get(peer, 0) for peer in peers]
+            lag.append((time.time(), srv.log.maxindex() - min(match)))
+        write_stats(srv, stats)
+    srv.running = False
+    write_stats(srv, stats, lag=lag)
+
+
+if __name__ == '__main__':
+    uuid, port, path, stats, options = sys.argv[1:6]
+    peers = {}
+    for arg in sys.argv[6:]:
+        peer, peerport = arg.split('=')
+        peers[peer] = ('127.0.0.1', int(peerport))
+    run_node(uuid, int(port), path, stats, json.loads(options), peers)
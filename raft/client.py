@@ -12,7 +12,9 @@ class NoConnection(Exception):
 
 class RaftClient(object):
     def __init__(self, server):
-        self.tcp = tcp.TCP(0, 'client')
+        # every client needs a uuid of its own, or the servers can't tell
+        # two of them apart
+        self.tcp = tcp.TCP(0, 'client-' + uuid.uuid4().hex)
         self.tcp.start()
         self.msgs = {}
         self.tcp.connect(server)
@@ -43,7 +45,7 @@ class RaftClient(object):
         msgids = set()
         for _, msgs in ans:
             for msg in msgs:
-                msg = msgpack.unpackb(msg, use_list=False)
+                msg = msgpack.unpackb(msg, use_list=False, encoding='utf-8')
                 msgid = msg['id']
                 msgids.add(msgid)
                 ums = self.msgs.get(msgid, [])
@@ -57,6 +59,15 @@ class RaftClient(object):
         self._send(rpc, msgid)
         return msgid
 
+    def read(self, query, max_lag=None, max_age=None):
+        # answered by the state machine, without going into the log.  with
+        # max_lag (entries) or max_age (seconds), a follower may answer
+        # from a state that far behind the leader's.
+        msgid = uuid.uuid4().hex
+        rpc = self.rq_rpc(query, msgid, max_lag, max_age)
+        self._send(rpc, msgid)
+        return msgid
+
     def update_hosts(self, config):
         msgid = uuid.uuid4().hex
         rpc = self.pu_rpc(config, msgid)
@@ -72,6 +83,17 @@ class RaftClient(object):
         }
         return msgpack.packb(rpc)
 
+    def rq_rpc(self, query, msgid, max_lag=None, max_age=None):
+        # read query rpc
+        rpc = {
+            'type': 'rq',
+            'id': msgid,
+            'data': query,
+            'max_lag': max_lag,
+            'max_age': max_age
+        }
+        return msgpack.packb(rpc)
+
     def pu_rpc(self, config, msgid):
         # protocol update rpc
         rpc = {
@@ -1,132 +1,339 @@
+import bisect
+import collections
+
+import msgpack
+
+
+# how many of the most recent entries' msgids the log remembers, and so
+# how long a client has to retry a command and get the original back
+DEDUPE_WINDOW = 100000
+
+
 class RaftLog(object):
-    def __init__(self, log):
-        if not log:
-            le = logentry(0, '', {})
-            le['index'] = 0
-            le['committed'] = True
+    def __init__(self, log, disk=None, window=DEDUPE_WINDOW):
+        # disk, if we have one, is the store the log is written to.  it
+        # holds everything before the entries we're handed, and entries
+        # we've let go of get read back from it.
+        self.disk = disk
+        first = disk.first_index_term() if disk is not None else None
+        if not log and first is None:
+            le = snapentry(0, 0)
             log = {0: le}
-        self.log_by_index = log
-        self.log_by_msgid = {}
-        for ent in self.log_by_index.values():
-            msgid = ent['msgid']
-            self.log_by_msgid[msgid] = ent
+            self.unsaved = [le]
+        else:
+            self.unsaved = []
+        # everything before snapidx has been compacted into a snapshot;
+        # the entry at snapidx is a stub that only remembers its term.
+        # entries from base on are kept in memory densely, with
+        # entries[i] holding index base + i, and removed entries leaving
+        # a None behind.  anything between snapidx and base is on disk.
+        if first is not None:
+            self.snapidx, self.snapterm = first
+            self.base = min(log) if log else disk.maxindex() + 1
+            self.termstarts, self.termids, self.log_by_msgid = \
+                disk.take_index()
+        else:
+            self.snapidx = self.base = min(log)
+            self.snapterm = log[self.base]['term']
+            # where each term starts in the log, as parallel lists in
+            # index order, so the term of an index and the extent of a
+            # term can be found without walking entries
+            self.termstarts = []
+            self.termids = []
+            # msgid -> index, for recent entries
+            self.log_by_msgid = MsgidWindow(window)
+        self.entries = [None] * (max(log) - self.base + 1 if log else 0)
+        # the commit index only moves with add/remove/commit, so keep it
+        # as a counter rather than searching the log every time.  the
+        # store only leaves committed entries on disk.
+        self.commitidx = self.base - 1 if first is not None else 0
+        self.forget_terms(self.base)
+        for idx in sorted(log):
+            ent = log[idx]
+            if not isinstance(ent, LogEntry):
+                ent = LogEntry.from_dict(ent)
+            self.entries[idx - self.base] = ent
+            self.log_by_msgid.add(ent.msgid, idx)
+            if ent.committed and ent.index > self.commitidx:
+                self.commitidx = ent.index
+        for ent in self.entries:
+            if ent is not None:
+                self.note_term(ent.index, ent.term)
 
     def dump(self):
-        return self.log_by_index
+        logs = {}
+        for idx in range(self.snapidx, self.maxindex() + 1):
+            ent = self.get(idx)
+            if ent is not None:
+                logs[ent.index] = ent.to_dict()
+        return logs
+
+    def take_unsaved(self):
+        # entries added since the last call, in the order they were added,
+        # for the store to append to its write-ahead log
+        unsaved = self.unsaved
+        self.unsaved = []
+        return unsaved
+
+    def index_state(self):
+        # the term starts and msgid window, for the store to checkpoint
+        return self.termstarts, self.termids, self.log_by_msgid
+
+    def release(self, index):
+        # stop holding on to entries before index.  only committed
+        # entries that have made it to disk can go; they're read back
+        # from there if anybody (usually a lagging follower) asks.
+        if self.disk is None:
+            return
+        index = min(index, self.commitidx, self.maxindex())
+        if index <= self.base:
+            return
+        del self.entries[:index - self.base]
+        self.base = index
 
     def get_max_index_term(self):
         maxindex = self.maxindex()
-        maxterm = self.log_by_index.get(maxindex, {}).get('term', None)
+        ent = self.get(maxindex)
+        maxterm = ent.term if ent is not None else None
         return maxindex, maxterm
 
     def has_uuid(self, uuid):
         return uuid in self.log_by_msgid
 
     def maxindex(self):
-        return max(self.log_by_index)
+        return self.base + len(self.entries) - 1
 
     def get(self, idx):
-        return self.log_by_index.get(idx, None)
+        pos = idx - self.base
+        if 0 <= pos < len(self.entries):
+            return self.entries[pos]
+        if self.snapidx <= idx < self.base:
+            if idx == self.snapidx:
+                return snapentry(self.snapidx, self.snapterm)
+            ent = self.disk.read(idx)
+            if ent is not None:
+                # only committed entries are left on disk
+                ent.committed = True
+            return ent
+        return None
 
     def get_by_uuid(self, uuid):
-        return self.log_by_msgid.get(uuid, None)
+        idx = self.log_by_msgid.get(uuid)
+        if idx is None:
+            return None
+        ent = self.get(idx)
+        if ent is None or ent.msgid != uuid:
+            # compacted
+            return None
+        return ent
 
     def get_by_index(self, index):
         return self.get(index)
 
     def get_term_of(self, idx):
         le = self.get(idx)
-        return le['term']
+        if le is None and idx < self.snapidx:
+            return None
+        return le.term
 
     def remove(self, idx):
-        ent = self.log_by_index[idx]
-        del self.log_by_index[idx]
-        msgid = ent['msgid']
-        del self.log_by_msgid[msgid]
+        self.discard(idx)
+        # don't leave holes at the end of the log
+        while self.entries and self.entries[-1] is None:
+            self.entries.pop()
+        self.forget_terms(self.maxindex() + 1)
+        if idx <= self.commitidx:
+            # fall back to the highest entry still marked committed
+            self.commitidx = idx - 1
+            while self.commitidx > 0:
+                ent = self.get(self.commitidx)
+                if ent is not None and ent.committed:
+                    break
+                self.commitidx -= 1
+
+    def discard(self, idx):
+        ent = self.get(idx)
+        if ent is None:
+            return
+        if idx >= self.base:
+            self.entries[idx - self.base] = None
+        self.forget(ent)
+
+    def truncate(self, index):
+        # drop index and everything after it
+        self.log_by_msgid.truncate(index)
+        del self.entries[max(index - self.base, 0):]
+        self.base = min(self.base, index)
+        self.forget_terms(index)
+
+    def forget(self, ent):
+        self.log_by_msgid.forget(ent.msgid, ent.index)
+
+    def note_term(self, index, term):
+        # entries only ever go on the end of the log, and terms never go
+        # backwards along it
+        if not self.termids or self.termids[-1] != term:
+            self.termstarts.append(index)
+            self.termids.append(term)
+
+    def forget_terms(self, index):
+        # index and everything after it is gone
+        pos = bisect.bisect_left(self.termstarts, index)
+        del self.termstarts[pos:]
+        del self.termids[pos:]
+
+    def term_start(self, index):
+        # the first index we have of the term that index belongs to
+        pos = bisect.bisect_right(self.termstarts, index) - 1
+        if pos < 0:
+            return None
+        return self.termstarts[pos]
+
+    def last_index_of_term(self, term):
+        # the last index we have in term, or None if we have none of it
+        pos = bisect.bisect_left(self.termids, term)
+        if pos == len(self.termids) or self.termids[pos] != term:
+            return None
+        if pos + 1 < len(self.termstarts):
+            return self.termstarts[pos + 1] - 1
+        return self.maxindex()
+
+    def compact(self, index):
+        # drop everything before index, which must be committed and
+        # covered by a snapshot.  index itself is replaced with a stub
+        # that carries its term, like the index 0 entry of a fresh log
+        if index <= self.snapidx:
+            return
+        # msgids stay in the window, so retries of what we compacted
+        # are still caught
+        term = self.get_term_of(index)
+        if index >= self.base:
+            del self.entries[:index - self.base]
+            self.entries[0] = snapentry(index, term)
+            self.base = index
+        self.snapidx = index
+        self.snapterm = term
+        start = bisect.bisect_right(self.termstarts, index) - 1
+        del self.termstarts[:start]
+        del self.termids[:start]
+        self.termstarts[0] = index
+        self.commitidx = max(self.commitidx, index)
+
+    def reset(self, index, term):
+        # we were sent a snapshot.  if our log agrees with it, keep
+        # whatever comes after, otherwise throw the whole log away
+        if index <= self.snapidx:
+            return
+        if self.exists(index, term):
+            self.compact(index)
+            return
+        stub = snapentry(index, term)
+        self.entries = [stub]
+        # some of what we had may never have been committed, and a retry
+        # of it must not look like a duplicate
+        self.log_by_msgid = MsgidWindow(self.log_by_msgid.size)
+        self.termstarts = [index]
+        self.termids = [term]
+        self.snapidx = self.base = index
+        self.snapterm = term
+        self.commitidx = index
+        # a record at index truncates the wal there on replay, which
+        # gets rid of any conflicting entries we had persisted
+        self.unsaved.append(stub)
 
     def add(self, logentry):
-        if not 'index' in logentry:
+        if not isinstance(logentry, LogEntry):
+            logentry = LogEntry.from_dict(logentry)
+        if logentry.index is None:
             # this is being appended to a leader's log; reject if msgid is
             # known and allocate a new index for it
-            if logentry['msgid'] in self.log_by_msgid:
+            if logentry.msgid in self.log_by_msgid:
                 return
             index = self.maxindex() + 1
-            logentry['index'] = index
+            logentry.index = index
         else:
             # this is a follower being told to put logentry in a specific spot
-            index = logentry['index']
+            index = logentry.index
+            if index <= self.snapidx:
+                # already covered by our snapshot
+                return
             mi = self.maxindex()
             if mi + 1 != index:
                 # remove everything in the log after and including the current
                 # index
-                remove = [x for x in self.log_by_index if x >= index]
-                for rem in remove:
-                    self.remove(rem)
-        self.log_by_index[index] = logentry
-        msgid = logentry['msgid']
-        self.log_by_msgid[msgid] = logentry
+                self.truncate(min(index, mi + 1))
+                self.commitidx = min(self.commitidx, index - 1)
+            while self.maxindex() + 1 < index:
+                self.entries.append(None)
+        self.entries.append(logentry)
+        self.log_by_msgid.add(logentry.msgid, index)
+        self.note_term(index, logentry.term)
+        self.unsaved.append(logentry)
         return index
 
-    def add_ack(self, index, term, uuid):
-        ent = self.log_by_index[index]
-        if uuid in ent['acked']:
-            return
-        ent['acked'].append(uuid)
-
-    def num_acked(self, index):
-        ent = self.log_by_index[index]
-        return len(ent['acked'])
-
     def commit(self, index, term):
-        ent = self.log_by_index[index]
-        assert ent['term'] == term
-        ent['committed'] = True
+        ent = self.get(index)
+        assert ent.term == term
+        ent.committed = True
+        if index > self.commitidx:
+            self.commitidx = index
 
     def force_commit(self, index):
         # this is more dangerous; only call it from followers on orders
         # from the leader
-        ent = self.log_by_index.get(index, None)
+        ent = self.get(index)
         if ent is None:
             return
-        ent['committed'] = True
+        ent.committed = True
+        if index > self.commitidx:
+            self.commitidx = index
 
     def is_committed(self, index, term):
-        ent = self.log_by_index[index]
-        if ent['term'] != term:
+        ent = self.get(index)
+        if ent.term != term:
             return False
-        index = ent['index']
-        return index <= self.get_commit_index()
+        return ent.index <= self.get_commit_index()
 
     def is_committed_by_uuid(self, uuid):
-        ent = self.log_by_msgid.get(uuid, None)
-        if ent is None:
+        idx = self.log_by_msgid.get(uuid, None)
+        if idx is None:
             return False
-        index = ent['index']
-        return index <= self.get_commit_index()
+        return idx <= self.get_commit_index()
 
-    def logs_after_index(self, index):
+    def logs_after_index(self, index, maxcount=50, maxbytes=None):
+        # a batch of entries following index, stopping at maxcount entries
+        # or before the encoded batch would pass maxbytes, whichever comes
+        # first.  there's always at least one entry if there are any.
         last = self.maxindex()
         logs = {}
-        for x in range(index, min(last, index + 50)):
-            logs[x+1] = self.log_by_index[x+1]
+        size = 0
+        for x in range(max(index, self.snapidx), min(last, index + maxcount)):
+            ent = self.get(x+1)
+            if ent is None:
+                continue
+            if maxbytes is not None:
+                size += len(ent.encoded())
+                if size > maxbytes and logs:
+                    break
+            logs[x+1] = ent
         return logs
 
     def committed_logs_after_index(self, index):
         last = self.get_commit_index()
         logs = {}
         for x in range(index, last):
-            logs[x+1] = self.log_by_index[x+1]
+            logs[x+1] = self.get(x+1)
         return logs
 
     def get_commit_index(self):
-        for k in reversed(sorted(self.log_by_index)):
-            v = self.log_by_index[k]
-            if v['committed']:
-                return v['index']
-        return 0
+        return self.commitidx
 
     def exists(self, index, term):
-        return self.log_by_index.get(index, {}).get('term', None) == term
+        if index < self.snapidx:
+            # compacted entries were committed, so they match anybody's
+            return True
+        ent = self.get(index)
+        return ent is not None and ent.term == term
 
     def __le__(self, other):
         mi, mt = self.get_max_index_term()
@@ -137,12 +344,179 @@ class RaftLog(object):
         return not self <= other
 
 
-def logentry(term, uuid, msg):
-    rpc = {
-        'term': term,
-        'msgid': uuid,
-        'committed': False,
-        'acked': [],
-        'msg': msg,
-    }
-    return rpc
+class MsgidWindow(object):
+    # which index each msgid went into the log at, for the msgids of the
+    # last size entries.  a client retrying a command inside the window
+    # gets the original entry back, exactly once; anything older has
+    # been forgotten, so this doesn't grow with the log.
+    def __init__(self, size, pairs=()):
+        self.size = size
+        self.index = {}
+        # (index, msgid) in log order, oldest first
+        self.order = collections.deque()
+        for idx, msgid in pairs:
+            self.add(msgid, idx)
+
+    def __contains__(self, msgid):
+        return msgid in self.index
+
+    def __len__(self):
+        return len(self.index)
+
+    def get(self, msgid, default=None):
+        return self.index.get(msgid, default)
+
+    def add(self, msgid, idx):
+        self.index[msgid] = idx
+        self.order.append((idx, msgid))
+        while self.order[0][0] <= idx - self.size:
+            self.forget(*reversed(self.order.popleft()))
+
+    def forget(self, msgid, idx):
+        if self.index.get(msgid) == idx:
+            del self.index[msgid]
+
+    def truncate(self, idx):
+        # idx and everything after it are gone from the log
+        while self.order and self.order[-1][0] >= idx:
+            self.forget(*reversed(self.order.pop()))
+
+    def pairs(self):
+        return [(idx, msgid) for idx, msgid in self.order
+                if self.index.get(msgid) == idx]
+
+
+class LogEntry(object):
+    # a dict per entry cost several hundred bytes before the payload, so
+    # entries are slotted objects.  they still answer to ent['term'] and
+    # friends, since that's how the rest of the code (and the wire format)
+    # sees them.  acked is only there for the dict form; the leader counts
+    # acks by each peer's match index, not per entry.
+    #
+    # the payload is kept msgpack-encoded (for a client query, it's the
+    # exact bytes the client sent us) and the entry caches its own wire
+    # encoding, so replicating it to every follower on every heartbeat
+    # and writing it to the wal never packs it again.
+    __slots__ = ('index', 'term', 'msgid', 'committed', 'acked', 'raw',
+                 'enc')
+    keys = ('index', 'term', 'msgid', 'committed', 'acked', 'msg')
+
+    def __init__(self, term, msgid, msg, index=None, committed=False,
+                 raw=None):
+        self.index = index
+        self.term = term
+        self.msgid = msgid
+        self.committed = committed
+        self.acked = None
+        self.raw = raw if raw is not None else msgpack.packb(msg)
+        self.enc = None
+
+    @property
+    def msg(self):
+        return msgpack.unpackb(self.raw, use_list=False, encoding='utf-8')
+
+    @msg.setter
+    def msg(self, msg):
+        self.raw = msgpack.packb(msg)
+        self.enc = None
+
+    @classmethod
+    def from_encoded(cls, enc):
+        # an entry from what encoded() gave us, payload and all, without
+        # decoding the payload
+        unpacker = msgpack.Unpacker(use_list=False, encoding='utf-8')
+        unpacker.feed(enc)
+        fields = {}
+        raw = None
+        for _ in range(unpacker.read_map_header()):
+            key = unpacker.unpack()
+            if key == 'msg':
+                start = unpacker.tell()
+                unpacker.skip()
+                raw = enc[start:unpacker.tell()]
+            else:
+                fields[key] = unpacker.unpack()
+        ent = cls(fields['term'], fields['msgid'], None, fields['index'],
+                  raw=raw)
+        ent.enc = enc
+        return ent
+
+    @classmethod
+    def from_dict(cls, ent):
+        return cls(ent['term'], ent['msgid'], ent['msg'], ent.get('index'),
+                   ent.get('committed', False))
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'term': self.term,
+            'msgid': self.msgid,
+            'committed': self.committed,
+            'acked': list(self.acked or ()),
+            'msg': self.msg,
+        }
+
+    def encoded(self):
+        # what goes on the wire and into the wal.  acks and the commit
+        # flag are our own business, so they're left out.
+        if self.enc is None:
+            fields = {'index': self.index, 'term': self.term,
+                      'msgid': self.msgid}
+            self.enc = packmap(fields, {'msg': self.raw})
+        return self.enc
+
+    def __contains__(self, key):
+        return key in self.keys and getattr(self, key) is not None
+
+    def __getitem__(self, key):
+        if key not in self.keys:
+            raise KeyError(key)
+        if key == 'acked' and self.acked is None:
+            self.acked = []
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        if key not in self.keys:
+            raise KeyError(key)
+        setattr(self, key, value)
+        if key in ('index', 'term', 'msgid'):
+            self.enc = None
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __repr__(self):
+        return 'LogEntry(%r)' % self.to_dict()
+
+
+def packmap(fields, raw=None):
+    # pack a map like msgpack.packb would, except that the values in raw
+    # are already encoded and just get spliced in
+    raw = raw or {}
+    parts = [msgpack.Packer().pack_map_header(len(fields) + len(raw))]
+    for key, val in fields.items():
+        parts.append(msgpack.packb(key))
+        parts.append(msgpack.packb(val))
+    for key, val in raw.items():
+        parts.append(msgpack.packb(key))
+        parts.append(val)
+    return b''.join(parts)
+
+
+def pack_entries(logs):
+    # the entries map of an append entries rpc, from cached encodings
+    parts = [msgpack.Packer().pack_map_header(len(logs))]
+    for idx in sorted(logs):
+        parts.append(msgpack.packb(idx))
+        parts.append(logs[idx].encoded())
+    return b''.join(parts)
+
+
+def snapentry(index, term):
+    return LogEntry(term, '', {}, index, True)
+
+
+def logentry(term, uuid, msg, raw=None):
+    return LogEntry(term, uuid, msg, raw=raw)
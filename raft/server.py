@@ -4,6 +4,7 @@ import time
 import uuid
 import copy
 import random
+import collections
 import logging
 import threading
 try:
@@ -16,34 +17,170 @@ import msgpack
 import raft.store as store
 import raft.tcp as channel
 import raft.log as log
+import raft.statemachine as statemachine
 
 
-def make_server(port=9289, bootstraps=None):
-    queue = Queue.Queue()
-    server = Server(queue, port, bootstraps)
+def make_server(port=9289, bootstraps=None, sm=None):
+    # without a state machine, committed commands show up on the queue
+    # this returns; with one, it's the server that's returned
+    if sm is None:
+        queue = Queue.Queue()
+        server = Server(queue, port, bootstraps)
+        server.start()
+        return queue
+    server = Server(sm, port, bootstraps)
     server.start()
-    return queue
+    return server
 
 def iteritems(dictobj):
     if sys.version_info[0] == 2:
-        return dictobj.itemsiter()
+        return dictobj.iteritems()
     else:
         return dictobj.items()
 
 class Server(threading.Thread):
-    def __init__(self, queue, port, bootstraps):
+    snapshot_chunk_size = 64 * 1024
+    # once this much is queued up unsent to a peer we stop feeding it
+    # entries (heartbeats still go out) until it drains below the low mark
+    send_high_water = channel.HIGH_WATER
+    send_low_water = channel.LOW_WATER
+    # the most entries, and encoded bytes of entries, in one append entries
+    ae_max_entries = 1000
+    ae_max_bytes = 1024 * 1024
+    # how many append entries batches can be unacknowledged to a peer at
+    # once, and how long we wait on them before starting over
+    ae_window = 4
+    ae_timeout = 1.0
+    # client commands that arrive together are written and replicated
+    # together: once per pass through the event loop, or as soon as this
+    # many are waiting
+    cq_max_batch = 1000
+    # how the log gets to disk; see raft.store.  nobody hears about an
+    # entry, us included when we count acks, until it's durable.
+    durability = store.BATCH
+    # how many committed entries to keep in memory; older ones are read
+    # back from the wal if a follower needs them
+    log_cache = 10000
+    # how many entries can go into the wal after the last checkpoint
+    # before we write another; startup scans everything after it
+    checkpoint_every = 100000
+    # how many of the latest entries' msgids we use to catch retried
+    # client commands
+    dedupe_window = log.DEDUPE_WINDOW
+    # how long a follower waits to hear from the leader before calling an
+    # election, plus up to follower_jitter more, drawn afresh every
+    # election, so they don't all call one at once.  a candidate gives an
+    # election between election_timeout_min and _max before calling
+    # another.  timers are checked, and an idle leader sends heartbeats,
+    # every poll_interval; a leader busy with messages sends them every
+    # heartbeat_interval as well.
+    follower_timeout = 0.5
+    follower_jitter = 0.0
+    election_timeout_min = 0.5
+    election_timeout_max = 1.0
+    heartbeat_interval = 0.3
+    poll_interval = 0.15
+    # with read_lease, a leader answers reads on its own for as long as
+    # no other leader can have been elected: follower_timeout from when
+    # it sent the last heartbeats a quorum answered, less lease_drift of
+    # that to allow for clocks running at different rates.  followers
+    # then ignore candidates while they're still hearing from a leader.
+    read_lease = False
+    lease_drift = 0.1
+    # with pre_vote, a follower that stops hearing from the leader first
+    # asks whether it could win an election, without moving to a new
+    # term, and only calls one if a quorum says it could.  nobody says so
+    # while they're still hearing from a leader, so a node that's been
+    # cut off can't come back and depose one.  with check_quorum, a leader
+    # that a quorum hasn't answered for follower_timeout steps down.
+    pre_vote = False
+    check_quorum = False
+    # committed entries are applied on a thread of their own, handed
+    # over this many at most at a time, with at most apply_max_lag of
+    # them waiting to be applied.  while it has any, we check back for
+    # results every apply_poll seconds
+    apply_max_batch = 1000
+    apply_max_lag = 100000
+    apply_poll = 0.001
+
+    def __init__(self, sm, port, bootstraps, transport=None, storage=None,
+                 clock=None, rng=None):
+        # sm is a StateMachine, or a queue for committed commands to go on.
+        # the rest default to the real thing: a raft.tcp.TCP listening on
+        # port, a raft.store.Store for port, time.time and the random
+        # module.  raft.sim has stand-ins for all four.
+        if not isinstance(sm, statemachine.StateMachine):
+            sm = statemachine.QueueStateMachine(sm)
+        self.statemachine = sm
+        self.applier = statemachine.Applier(sm)
         self.port = port
+        self.store = storage
+        self.clock = clock if clock is not None else time.time
+        self.rng = rng if rng is not None else random
         self.load()
         self.bootstraps = bootstraps
-        self.queue = queue
         self.role = 'follower'
-        self.channel = channel.start(port, self.uuid)
-        self.last_update = time.time()
+        if transport is None:
+            transport = channel.start(port, self.uuid, self.send_high_water,
+                                      self.send_low_water)
+        self.channel = transport
+        self.last_update = self.clock()
         self.commitidx = 0
         self.update_uuid = None
         self.leader = None
         self.newpeers = None
         self.oldpeers = None
+        self.pending_snapshot = None
+        self.snapshot_offset = {}
+        # per peer: the index our next batch follows, the highest index
+        # they're known to have, (previdx, last index) of every batch
+        # we're waiting to hear back about, and when we last heard back
+        self.next_index = {}
+        self.match_index = {}
+        self.inflight = {}
+        self.last_ack = {}
+        # (index, msgid, client) for commands in the log that haven't
+        # been written out yet
+        self.pending_cq = []
+        # (index, new, msgid, client) for commands written but not yet
+        # durable, and as a follower, (index, term) of the ack we owe
+        # the leader once what it sent us is durable
+        self.unsynced_cq = []
+        self.unsynced_ae = None
+        # the client to send each result to, by msgid, for commands we
+        # took as leader that haven't been applied yet
+        self.clients = {}
+        # reads: (msgid, query) for those waiting on the next round of
+        # heartbeats; (round, read index, reads, followers) for rounds not
+        # yet confirmed by a quorum, and (read index, reads) for confirmed
+        # ones waiting on the applier.  pending_ri is (uuid, request) for
+        # followers after a read index.  round_acks is the latest round
+        # each peer has answered, and as a follower, round_seen is the
+        # (term, round) we last answered and forwarded holds our reads
+        # waiting on a read index from the leader, by request.
+        self.pending_reads = []
+        self.pending_ri = []
+        self.reads_waiting = []
+        self.reads_ready = []
+        self.forwarded = {}
+        self.read_round = 0
+        self.round_start = 0
+        self.round_times = collections.deque()
+        self.lease_start = None
+        self.round_acks = {}
+        self.round_seen = None
+        self.incoming_index = None
+        self.incoming_chunks = []
+        self.incoming_size = 0
+        # how far into follower_jitter our election timer runs, the
+        # elections we've called and when we last won one
+        self.jitter = self.rng.random()
+        self.housekept = self.clock()
+        self.elections = 0
+        self.elected = None
+        # with pre_vote, who's said they'd vote for us in the round we're
+        # running, if we're running one
+        self.prevotes = None
         threading.Thread.__init__(self)
         self.daemon = True
 
@@ -52,29 +189,115 @@ class Server(threading.Thread):
     #
 
     def load(self):
+        if self.store is None:
+            self.store = store.Store(self.port, durability=self.durability,
+                                     window=self.dedupe_window)
         self.term, self.voted, llog, self.peers, \
-            self.uuid = store.read_state(self.port)
-        self.log = log.RaftLog(llog)
+            self.uuid = self.store.read_state()
+        self.log = log.RaftLog(llog, self.store, self.dedupe_window)
+        self.snapshot = self.store.read_snapshot()
+        if self.snapshot is not None:
+            self.applier.restore(self.snapshot[0], self.snapshot[2])
+        # the last entry handed to the applier, and the last we know to
+        # be committed and to match the leader's log
+        self.applying = self.log.snapidx
+        self.apply_limit = self.log.snapidx
 
     def save(self):
-        store.write_state(self.port, self.term, self.voted,
-                          self.log.dump(), self.peers, self.uuid)
+        # only entries added since the last save are appended to the wal
+        self.store.write_state(self.term, self.voted,
+                               self.log.take_unsaved(), self.peers,
+                               self.uuid, self.log.get_commit_index())
 
     def run(self):
         self.running = True
+        self.applier.start()
         while self.running:
-            for peer in self.peers:
-                if not peer in self.channel and peer != self.uuid:
-                    self.channel.connect(self.peers[peer])
-            for addr in self.bootstraps:
-                self.channel.connectbs(addr, self.bootstrap_cb)
-            channelans = self.channel.recv(0.15)
-            if channelans:
-                for peer, msgs in channelans:
-                    for msg in msgs:
-                        self.handle_message(msg, peer)
-            else:
-                self.housekeeping()
+            self.tick()
+        self.applier.stop()
+
+    def tick(self):
+        # one pass through the event loop: wait up to poll_timeout for
+        # messages and handle them, and do housekeeping when it's due
+        self.compact_log()
+        for peer in self.peers:
+            if not peer in self.channel and peer != self.uuid:
+                self.channel.connect(self.peers[peer])
+        for addr in self.bootstraps:
+            self.channel.connectbs(addr, self.bootstrap_cb)
+        timeout = self.poll_timeout()
+        channelans = self.channel.recv(timeout)
+        if channelans:
+            for peer, msgs in channelans:
+                for msg in msgs:
+                    self.handle_message(msg, peer)
+        now = self.clock()
+        if (not channelans and timeout >= self.poll_interval) or \
+                now - self.housekept >= self.poll_interval:
+            # timers get checked after a whole poll with nothing to do,
+            # and at least that often however busy we are; a follower
+            # kept busy by clients still has to notice the leader's gone
+            self.housekept = now
+            self.housekeeping()
+        self.flush_commands()
+        self.release_durable()
+        self.flush_reads()
+        self.apply_committed()
+        durable = min(self.commitidx, self.store.durable_index)
+        self.log.release(durable - self.log_cache)
+        self.checkpoint()
+
+    def poll_timeout(self):
+        timeout = self.poll_interval
+        wait = self.store.sync_wait()
+        if wait is not None:
+            # don't sit on entries that are due to be synced
+            timeout = min(wait, timeout)
+        if self.applier.working() or self.applier.finished:
+            # nor on results the applier is about to hand back
+            timeout = min(self.apply_poll, timeout)
+        return timeout
+
+    def checkpoint(self):
+        if self.log.maxindex() - self.store.checkpointed < \
+                self.checkpoint_every:
+            return
+        self.save()
+        self.store.write_checkpoint(*self.log.index_state())
+
+    def take_snapshot(self, index, data):
+        # called by the state machine, from any thread, with a blob that
+        # captures every committed entry up to and including index.  the
+        # log is compacted from the server thread on its next pass.
+        self.pending_snapshot = (index, data)
+
+    def compact_log(self):
+        snap = self.pending_snapshot
+        if snap is None:
+            return
+        self.pending_snapshot = None
+        index, data = snap
+        if index <= self.log.snapidx or index > self.log.get_commit_index():
+            return
+        term = self.log.get_term_of(index)
+        self.store.write_snapshot(index, term, data)
+        self.snapshot = (index, term, data)
+        self.log.compact(index)
+
+    def install_snapshot(self, index, term, data):
+        # a leader has sent us a snapshot; it replaces our log up to index
+        # and the state machine's state wholesale
+        if index <= self.log.snapidx:
+            return
+        self.store.write_snapshot(index, term, data)
+        self.snapshot = (index, term, data)
+        self.log.reset(index, term)
+        self.save()
+        if index > self.commitidx:
+            self.commitidx = index
+        self.applier.restore(index, data)
+        self.applying = index
+        self.apply_limit = max(self.apply_limit, index)
 
     #
     ## message handling
@@ -85,6 +308,7 @@ class Server(threading.Thread):
         # update our term if applicable, and dispatch the message
         # to the appropriate handler.  finally, if we are still
         # (or have become) the leader, send out heartbeats
+        raw = msg
         try:
             msg = msgpack.unpackb(msg, use_list=False, encoding='utf-8')
         except msgpack.UnpackException:
@@ -92,9 +316,17 @@ class Server(threading.Thread):
         mtype = msg['type']
         term = msg.get('term', None)
         msg['src'] = addr
+        # the encoded form, so client queries can go into the log as-is
+        msg['raw'] = raw
         uuid = msg.get('id', None)
-        # no matter what, if our term is old, update and step down
-        if term and term > self.term and self.valid_peer(uuid):
+        if mtype == 'rv' and self.read_lease and self.leader_alive():
+            # a leader could be serving reads off its lease; whoever this
+            # is can't have heard from it in a while, and mustn't win
+            return
+        # no matter what, if our term is old, update and step down.  a
+        # pre-vote doesn't count; it's for a term nobody's in yet.
+        if term and term > self.term and mtype != 'pv' and \
+                self.valid_peer(uuid):
             # okay, well, only if it's from a valid source
             self.term = term
             self.voted = None
@@ -102,7 +334,8 @@ class Server(threading.Thread):
         mname = 'handle_msg_%s_%s' % (self.role, mtype)
         if hasattr(self, mname):
             getattr(self, mname)(msg)
-        if self.role == 'leader' and time.time() - self.last_update > 0.3:
+        if self.role == 'leader' and \
+                self.clock() - self.last_update > self.heartbeat_interval:
             self.send_ae()
 
     def handle_msg_candidate_bootstrap(self, msg):
@@ -126,23 +359,73 @@ class Server(threading.Thread):
         uuid = msg['id']
         if not self.valid_peer(uuid):
             return
+        if msg['term'] != self.term:
+            # a reply to something we sent as leader of an earlier term,
+            # about a log that may since have changed
+            return
         success = msg['success']
-        index = msg['index']
+        # they can't have more of our log than there is
+        index = min(msg['index'], self.log.maxindex())
+        inflight = self.inflight.setdefault(uuid, [])
         if success:
-            self.next_index[uuid] = index
+            self.last_ack[uuid] = self.clock()
+            # index is the last entry of the batch they've taken; any
+            # batches we've sent since are still on their way
+            self.match_index[uuid] = max(self.match_index.get(uuid, 0), index)
+            self.next_index[uuid] = max(self.next_index.get(uuid, 0), index)
+            while inflight and inflight[0][1] <= index:
+                inflight.pop(0)
             if self.log.get_commit_index() < index:
                 self.msg_recorded(msg)
+            if index < self.log.maxindex():
+                # they're still behind; don't wait for the next heartbeat
+                self.fill_window(uuid)
         else:
-            # exponentially reduce the index for peers
-            # this way if they're only missing a couple log entries,
-            # we only have to send 2 or 4, but if they're missing
-            # a couple thousand we'll find out in less than 2k round
-            # trips
-            oldidx = self.next_index.get(uuid, 0)
-            diff = self.log.maxindex() - oldidx
-            diff = max(diff, 1)
-            oldidx -= diff
+            # index is the previdx they couldn't match.  only the oldest
+            # thing we're waiting on counts; the rest of the window was
+            # sent after it and is going to be refused too.
+            if inflight:
+                current = inflight[0][0]
+            else:
+                current = self.next_index.get(uuid, 0)
+            if index != current:
+                # this doesn't tell us the window's still moving; if it
+                # was lost, send_ae will start it over
+                return
+            self.last_ack[uuid] = self.clock()
+            if msg.get('conflict_index') is not None:
+                oldidx = self.conflict_rollback(msg)
+            else:
+                # an older peer that doesn't send hints.
+                # exponentially reduce the index for peers
+                # this way if they're only missing a couple log entries,
+                # we only have to send 2 or 4, but if they're missing
+                # a couple thousand we'll find out in less than 2k round
+                # trips.
+                oldidx = self.next_index.get(uuid, 0)
+                diff = self.log.maxindex() - oldidx
+                diff = max(diff, 1)
+                oldidx -= diff
+            # never go below what they've already acked
+            oldidx = max(oldidx, self.match_index.get(uuid, 0))
             self.next_index[uuid] = max(oldidx, 0)
+            del inflight[:]
+            self.fill_window(uuid)
+
+    def conflict_rollback(self, msg):
+        # where to send from after a rejection carrying the follower's
+        # conflicting term and the first index they have of it.  if we
+        # have that term too, our entries match theirs through the end of
+        # it; otherwise everything they have of it has to go.  either way
+        # we skip a whole term per round trip instead of guessing.
+        index = msg['index']
+        cterm = msg.get('conflict_term')
+        cidx = msg['conflict_index']
+        if cterm is not None:
+            last = self.log.last_index_of_term(cterm)
+            if last is not None:
+                return min(last, index - 1)
+        return min(cidx - 1, index - 1)
 
     def handle_msg_follower_ae(self, msg):
         # we are a follower who just got an append entries rpc
@@ -153,13 +436,29 @@ class Server(threading.Thread):
         term = msg['term']
         if term < self.term:
             return
-        self.last_update = time.time()
+        self.last_update = self.clock()
         self.leader = msg['id']
+        rnd = msg.get('round')
+        if rnd and (term, rnd) != self.round_seen:
+            # the leader wants to know it still is one, for some reads;
+            # that doesn't depend on whether our logs agree
+            self.round_seen = (term, rnd)
+            self.send_to_peer(self.round_reply_rpc(rnd), self.leader)
         logs = msg['entries']
         previdx = msg['previdx']
         prevterm = msg['prevterm']
         if not self.log.exists(previdx, prevterm):
-            rpc = self.ae_rpc_reply(previdx, prevterm, False)
+            # tell the leader where our log stops agreeing with theirs: the
+            # term we have at previdx and where it starts, or, if we don't
+            # have previdx at all, where our log ends
+            ent = self.log.get(previdx)
+            if ent is None:
+                cterm = None
+                cidx = min(previdx, self.log.maxindex() + 1)
+            else:
+                cterm = ent.term
+                cidx = self.log.term_start(previdx)
+            rpc = self.ae_rpc_reply(previdx, False, cterm, cidx)
             self.send_to_peer(rpc, self.leader)
             return
         cidx = msg['commitidx']
@@ -169,15 +468,26 @@ class Server(threading.Thread):
             if self.update_uuid:
                 self.check_update_committed()
         if not logs:
-            # heartbeat
+            # heartbeat; up to previdx we're known to match the leader
+            self.apply_committed(previdx)
             return
         for ent in sorted(logs):
             val = logs[ent]
+            if self.log.exists(ent, val['term']):
+                # we've got it already, maybe along with entries from
+                # later batches we don't want to throw away
+                continue
             self.process_possible_update(val)
             self.log.add(val)
-        maxmsg = self.log.get_by_index(self.log.maxindex())
-        rpc = self.ae_rpc_reply(maxmsg['index'], maxmsg['term'], True)
-        self.send_to_peer(rpc, self.leader)
+        self.save()
+        # ack exactly what this batch covered; anything after it in our
+        # log hasn't been checked against the leader's yet.  the ack goes
+        # out once the batch is durable, as long as the leader who sent it
+        # still is one.
+        last = max(logs)
+        self.unsynced_ae = (last, self.leader, self.term)
+        self.release_durable()
+        self.apply_committed(last)
 
     def handle_msg_candidate_ae(self, msg):
         # someone else was elected during our candidacy
@@ -191,6 +501,70 @@ class Server(threading.Thread):
         self.role = 'follower'
         self.handle_msg_follower_ae(msg)
 
+    def handle_msg_follower_is(self, msg):
+        # install snapshot rpc; the leader sends the snapshot in chunks and
+        # we only ever accept the chunk that starts where we left off
+        uuid = msg['id']
+        if not self.valid_peer(uuid):
+            return
+        if msg['term'] < self.term:
+            return
+        self.last_update = self.clock()
+        self.leader = uuid
+        index = msg['index']
+        offset = msg['offset']
+        if offset == 0:
+            self.incoming_index = index
+            self.incoming_chunks = []
+            self.incoming_size = 0
+        if index != self.incoming_index or offset != self.incoming_size:
+            # a stale or out of order chunk; tell the leader where we are
+            size = self.incoming_size if index == self.incoming_index else 0
+            rpc = self.is_rpc_reply(index, size, False)
+            self.send_to_peer(rpc, uuid)
+            return
+        self.incoming_chunks.append(msg['data'])
+        self.incoming_size += len(msg['data'])
+        if msg['done']:
+            data = b''.join(self.incoming_chunks)
+            self.incoming_index = None
+            self.incoming_chunks = []
+            self.install_snapshot(index, msg['lastterm'], data)
+        rpc = self.is_rpc_reply(index, self.incoming_size, msg['done'])
+        self.send_to_peer(rpc, uuid)
+
+    def handle_msg_candidate_is(self, msg):
+        # someone else was elected during our candidacy
+        uuid = msg['id']
+        if not self.valid_peer(uuid):
+            return
+        if msg['term'] < self.term:
+            return
+        self.role = 'follower'
+        self.handle_msg_follower_is(msg)
+
+    def handle_msg_leader_is_reply(self, msg):
+        uuid = msg['id']
+        if not self.valid_peer(uuid) or self.snapshot is None:
+            return
+        if msg['index'] != self.snapshot[0]:
+            # they were getting a snapshot we've since replaced
+            self.snapshot_offset[uuid] = 0
+        elif msg['done']:
+            # a snapshot sent again with a heartbeat can be acked twice
+            if self.snapshot_offset.pop(uuid, None) is None:
+                return
+            self.next_index[uuid] = max(self.next_index.get(uuid, 0),
+                                        msg['index'])
+            self.match_index[uuid] = max(self.match_index.get(uuid, 0),
+                                         msg['index'])
+            self.inflight[uuid] = []
+            self.fill_window(uuid)
+            return
+        else:
+            self.snapshot_offset[uuid] = msg['offset']
+        self.send_snapshot(uuid)
+
     def handle_msg_follower_cq(self, msg):
         try:
             rpc = self.cr_rdr_rpc(msg['id'])
@@ -201,14 +575,267 @@ class Server(threading.Thread):
             # so if we crashed for some reason, just ignore it
             return
 
+    def handle_msg_follower_rq(self, msg):
+        # followers take reads too: right away if the client will put up
+        # with what we have, otherwise once we've caught up to a read
+        # index from the leader
+        if msg['id'] is None or self.leader is None or \
+                self.no_reads(msg):
+            return
+        self.clients[msg['id']] = msg['src']
+        read = (msg['id'], msg['data'])
+        if self.fresh_enough(msg.get('max_lag'), msg.get('max_age')):
+            self.reads_ready.append((self.applying, [read]))
+        else:
+            self.pending_reads.append(read)
+
+    def no_reads(self, msg):
+        # a state machine with nothing to read from can't answer; the
+        # client hears so rather than waiting on an answer never coming
+        if self.applier.sm.answers_reads:
+            return False
+        info = {'status': 'unsupported'}
+        self.send_to_peer(self.cr_rpc_ack(msg['id'], info), msg['src'])
+        return True
+
+    def fresh_enough(self, max_lag, max_age):
+        # how many entries we are behind the commit index the leader last
+        # told us, and how long ago that was
+        if max_lag is None and max_age is None:
+            return False
+        if max_lag is not None and self.commitidx - self.applying > max_lag:
+            return False
+        if max_age is not None and \
+                self.clock() - self.last_update > max_age:
+            return False
+        return True
+
+    def forward_reads(self):
+        # one read index request for every read since the last; an answer
+        # covers every request we sent before it, too
+        now = self.clock()
+        if self.pending_reads:
+            self.read_round += 1
+            self.forwarded[self.read_round] = self.pending_reads
+            self.pending_reads = []
+        elif not self.forwarded or now - self.round_start < self.ae_timeout:
+            return
+        self.round_start = now
+        self.send_to_peer(self.ri_rpc(self.read_round), self.leader)
+
+    def handle_msg_follower_ri_reply(self, msg):
+        if not self.valid_peer(msg['id']):
+            return
+        for req in sorted(self.forwarded):
+            if req > msg['round']:
+                break
+            self.reads_ready.append((msg['index'], self.forwarded.pop(req)))
+        self.apply_committed()
+
+    def handle_msg_leader_ri(self, msg):
+        # a follower wants a read index, which we give it the same way we
+        # would answer a read
+        if not self.valid_peer(msg['id']):
+            return
+        self.pending_ri.append((msg['id'], msg['round']))
+
+    def handle_msg_leader_rq(self, msg):
+        # a read.  it's answered, without going through the log, once a
+        # quorum has confirmed we were still the leader after it came in,
+        # and the state machine has caught up to our commit index as of
+        # then (see flush_reads).
+        if msg['id'] is None or self.no_reads(msg):
+            return
+        self.clients[msg['id']] = msg['src']
+        self.pending_reads.append((msg['id'], msg['data']))
+
+    def flush_reads(self):
+        # one round of heartbeats for every read since the last round
+        if self.role != 'leader' and self.reads_waiting:
+            self.redirect_reads()
+        if self.role == 'follower' and self.leader is not None:
+            self.forward_reads()
+        if self.role != 'leader':
+            return
+        now = self.clock()
+        if (self.pending_reads or self.pending_ri) and \
+                self.log.get_term_of(self.commitidx) == self.term:
+            # until something from our own term is committed, we can't be
+            # sure our commit index is as far along as the last leader's
+            reads, self.pending_reads = self.pending_reads, []
+            remote, self.pending_ri = self.pending_ri, []
+            if self.lease_valid(now):
+                self.reads_ready.append((self.commitidx, reads))
+                self.send_read_index(self.commitidx, remote)
+                self.apply_committed()
+                return
+            self.next_round(now)
+            self.reads_waiting.append((self.read_round, self.commitidx,
+                                       reads, remote))
+        elif not self.reads_waiting or \
+                now - self.round_start < self.ae_timeout:
+            self.confirm_reads()
+            return
+        else:
+            # the heartbeats or the replies got lost.  a later round
+            # confirms earlier ones too, so just start another.
+            self.next_round(now)
+        self.send_ae()
+        self.confirm_reads()
+
+    def redirect_reads(self):
+        # reads we took as leader whose round never got confirmed; we've
+        # stepped down since, so the clients are sent on to whoever leads
+        # now, as soon as we know who that is.  followers waiting on a
+        # read index ask again by themselves.
+        if self.leader is None:
+            return
+        for _, _, reads, _ in self.reads_waiting:
+            for msgid, _ in reads:
+                src = self.clients.pop(msgid, None)
+                if src is not None:
+                    self.send_to_peer(self.cr_rdr_rpc(msgid), src)
+        self.reads_waiting = []
+
+    def next_round(self, now):
+        self.read_round += 1
+        self.round_start = now
+        self.round_times.append((self.read_round, now))
+        # a round sent longer than follower_timeout ago can't give us a
+        # lease, or tell check_quorum anything, so a leader nobody's
+        # answering doesn't keep piling them up
+        while now - self.round_times[0][1] > self.follower_timeout:
+            self.round_times.popleft()
+
+    def lease_valid(self, now):
+        if not self.read_lease or self.lease_start is None:
+            return False
+        lease = self.follower_timeout * (1 - self.lease_drift)
+        return now < self.lease_start + lease
+
+    def quorum_heard(self):
+        # when we sent the latest heartbeats a quorum has answered, or
+        # when we were elected if they haven't answered any yet
+        if self.lease_start is None:
+            return self.elected
+        return self.lease_start
+
+    def leader_alive(self):
+        now = self.clock()
+        if self.role == 'leader':
+            return self.lease_valid(now)
+        return self.leader is not None and \
+            now - self.last_update < self.follower_timeout
+
+    def handle_msg_leader_round_reply(self, msg):
+        uuid = msg['id']
+        if not self.valid_peer(uuid) or msg['term'] != self.term:
+            return
+        self.round_acks[uuid] = max(self.round_acks.get(uuid, 0),
+                                    msg['round'])
+        self.confirm_reads()
+
+    def confirmed_round(self):
+        # the latest round a quorum has answered; we answer our own
+        rounds = [self.read_round]
+        for uuid in set(self.all_peers()):
+            if uuid != self.uuid:
+                rounds.append(self.round_acks.get(uuid, 0))
+        for rnd in sorted(set(rounds), reverse=True):
+            if sum(1 for r in rounds if r >= rnd) >= self.quorum():
+                return rnd
+        return 0
+
+    def confirm_reads(self):
+        confirmed = self.confirmed_round()
+        while self.round_times and self.round_times[0][0] <= confirmed:
+            self.lease_start = self.round_times.popleft()[1]
+        while self.reads_waiting and self.reads_waiting[0][0] <= confirmed:
+            _, readidx, reads, remote = self.reads_waiting.pop(0)
+            self.reads_ready.append((readidx, reads))
+            self.send_read_index(readidx, remote)
+        self.apply_committed()
+
+    def send_read_index(self, readidx, remote):
+        for uuid, req in remote:
+            self.send_to_peer(self.ri_rpc_reply(req, readidx), uuid)
+
     def handle_msg_leader_cq(self, msg):
         src = msg['src']
+        raw = msg['raw']
         if msg['id'] is None:
             msgid = uuid.uuid4().hex
             msg['id'] = msgid
-        self.add_to_log(msg)
-        rpc = self.cr_rpc_ack(msg['id'])
-        self.send_to_peer(rpc, src)
+            raw = None
+        index = self.add_to_log(msg, raw)
+        if index is not None:
+            self.clients[msg['id']] = src
+        else:
+            # a retry of something already in the log, perhaps put there
+            # by the leader before us; if it's still to be applied, the
+            # result goes to whoever asked last
+            ent = self.log.get_by_uuid(msg['id'])
+            if ent is not None and ent.index > self.applying:
+                self.clients[msg['id']] = src
+        # the client hears back once the command is on disk, and again
+        # with the result once it's been applied
+        self.pending_cq.append((index, msg['id'], src))
+        if len(self.pending_cq) >= self.cq_max_batch:
+            self.flush_commands()
+
+    def flush_commands(self):
+        # one wal write, and one round of append entries, for every
+        # client command since the last flush
+        pending = self.pending_cq
+        if not pending:
+            return
+        self.pending_cq = []
+        self.save()
+        for index, msgid, src in pending:
+            new = index is not None
+            if not new:
+                # a retry of something we have; it's acked with that
+                ent = self.log.get_by_uuid(msgid)
+                index = ent.index if ent is not None else -1
+            self.unsynced_cq.append((index, new, msgid, src))
+        if self.role == 'leader':
+            # followers can write while we wait on our own disk
+            for uuid in self.all_peers():
+                if uuid != self.uuid:
+                    self.fill_window(uuid)
+        self.release_durable()
+
+    def release_durable(self):
+        # send whatever was waiting on entries reaching the disk
+        durable = self.store.sync_if_due()
+        if self.unsynced_ae is not None and self.unsynced_ae[0] <= durable:
+            index, leader, term = self.unsynced_ae
+            self.unsynced_ae = None
+            if (leader, term) == (self.leader, self.term):
+                rpc = self.ae_rpc_reply(index, True)
+                self.send_to_peer(rpc, self.leader)
+        if not self.unsynced_cq:
+            return
+        waiting = []
+        maxnew = None
+        for item in self.unsynced_cq:
+            index, new, msgid, src = item
+            if index > durable:
+                waiting.append(item)
+                continue
+            if new:
+                maxnew = index
+            if src is not None:
+                self.send_to_peer(self.cr_rpc_ack(msgid), src)
+        self.unsynced_cq = waiting
+        if maxnew is not None and self.role == 'leader':
+            # our own copy counts towards a quorum once it's on disk
+            self.match_index[self.uuid] = max(
+                self.match_index.get(self.uuid, 0), maxnew)
+            if maxnew > self.log.get_commit_index():
+                # followers may have gotten there before we did
+                self.msg_recorded(dict(term=self.term, index=maxnew,
+                                       id=self.uuid))
 
     def handle_msg_leader_cq_inq(self, msg):
         src = msg['src']
@@ -240,30 +867,70 @@ class Server(threading.Thread):
         uuid = msg['id']
         if not self.valid_peer(uuid):
             return
-        olog = {msg['log_index']: {
-                    'index': msg['log_index'],
-                    'term': msg['log_term'],
-                    'msgid': '',
-                    'msg': {}}}
-        olog = log.RaftLog(olog)
         if term < self.term:
             # someone with a smaller term wants to get elected
             # as if
             rpc = self.rv_rpc_reply(False)
             self.send_to_peer(rpc, uuid)
             return
-        if (self.voted is None or self.voted == uuid) and self.log <= olog:
+        if (self.voted is None or self.voted == uuid) and \
+                self.log_behind(msg):
             # we can vote for this guy
             self.voted = uuid
             self.save()
             rpc = self.rv_rpc_reply(True)
-            self.last_update = time.time()
+            self.last_update = self.clock()
             self.send_to_peer(rpc, uuid)
             return
         # we probably voted for somebody else, or the log is old
         rpc = self.rv_rpc_reply(False)
         self.send_to_peer(rpc, uuid)
 
+    def log_behind(self, msg):
+        # whether our log is no more up to date than a candidate's
+        olog = {msg['log_index']: {
+                    'index': msg['log_index'],
+                    'term': msg['log_term'],
+                    'msgid': '',
+                    'msg': {}}}
+        return self.log <= log.RaftLog(olog)
+
+    def handle_msg_follower_pv(self, msg):
+        # would we vote for them at the term they're asking about?  not
+        # if we're still hearing from a leader, or the term's not ahead
+        # of ours, or their log's behind ours.  who we've voted for
+        # doesn't come into it; nothing's changed until they call a
+        # real election.
+        uuid = msg['id']
+        if not self.valid_peer(uuid):
+            return
+        granted = msg['term'] > self.term and not self.leader_alive() and \
+            self.log_behind(msg)
+        self.send_to_peer(self.pv_rpc_reply(msg['term'], granted), uuid)
+
+    def handle_msg_candidate_pv(self, msg):
+        self.handle_msg_follower_pv(msg)
+
+    def handle_msg_leader_pv(self, msg):
+        # they haven't heard from us, but we're still here
+        uuid = msg['id']
+        if self.valid_peer(uuid):
+            self.send_to_peer(self.pv_rpc_reply(msg['term'], False), uuid)
+
+    def handle_msg_follower_pv_reply(self, msg):
+        uuid = msg['id']
+        if not self.valid_peer(uuid) or self.prevotes is None:
+            return
+        if msg['prevote'] != self.term + 1 or not msg['granted']:
+            return
+        if self.leader_alive():
+            # we've heard from a leader since we asked
+            self.prevotes = None
+            return
+        self.prevotes.add(uuid)
+        if len(self.prevotes) >= self.quorum():
+            self.call_election()
+
     def handle_msg_candidate_rv_reply(self, msg):
         uuid = msg['id']
         if not self.valid_peer(uuid):
@@ -276,13 +943,34 @@ class Server(threading.Thread):
         if len(self.cronies) >= self.quorum():
             # won the election
             self.role = 'leader'
+            self.elected = self.clock()
             self.next_index = {}
+            self.match_index = {}
+            self.inflight = {}
+            self.clients = {}
+            self.pending_reads = []
+            self.pending_ri = []
+            self.reads_waiting = []
+            self.reads_ready = []
+            self.forwarded = {}
+            self.round_acks = {}
+            self.round_times = collections.deque()
+            self.lease_start = None
             self.commitidx = self.log.get_commit_index()
             maxidx = self.log.maxindex()
             for uuid in self.all_peers():
                 # just start by pretending everyone is caught up,
                 # they'll let us know if not
                 self.next_index[uuid] = maxidx
+            self.append_noop()
+
+    def append_noop(self):
+        # a new leader commits an entry of its own term straight away, so
+        # it knows what's committed; it's written out with the next batch
+        # of commands
+        msgid = uuid.uuid4().hex
+        index = self.add_to_log({'type': 'noop', 'id': msgid})
+        self.pending_cq.append((index, msgid, None))
 
     def handle_msg_leader_pu(self, msg):
         if self.update_uuid:
@@ -300,16 +988,23 @@ class Server(threading.Thread):
         if not self.newpeers:
             return
         self.update_uuid = uuid
-        self.add_to_log(msg)
+        # written and counted along with any client commands
+        index = self.add_to_log(msg)
+        self.pending_cq.append((index, uuid, None))
 
     def housekeeping(self):
-        now = time.time()
+        now = self.clock()
         if self.role == 'candidate':
             elapsed = now - self.election_start
-        if now - self.last_update > 0.5 and self.role == 'follower':
+        timeout = self.follower_timeout + self.follower_jitter * self.jitter
+        if now - self.last_update > timeout and self.role == 'follower':
             # got no heartbeats; leader is probably dead
             # establish candidacy and run for election
-            self.call_election()
+            if self.pre_vote:
+                # once we know we could win
+                self.call_prevote(now)
+            else:
+                self.call_election()
         elif self.role == 'candidate' and elapsed < self.election_timeout:
             # we're in an election and haven't won, but the
             # timeout isn't expired.  repoll peers that haven't
@@ -319,6 +1014,13 @@ class Server(threading.Thread):
             # the election timeout *has* expired, and we *still*
             # haven't won or lost.  call a new election.
             self.call_election()
+        elif self.role == 'leader' and self.check_quorum and \
+                now - self.quorum_heard() > self.follower_timeout:
+            # nobody can have voted us out, but for all we know someone
+            # else is leading by now; stop taking commands we can't commit
+            self.role = 'follower'
+            self.leader = None
+            self.last_update = now
         elif self.role == 'leader':
             # send a heartbeat
             self.send_ae()
@@ -328,27 +1030,108 @@ class Server(threading.Thread):
     #
 
     def send_ae(self):
-        self.last_update = time.time()
+        now = self.clock()
+        self.last_update = now
+        if self.read_lease or self.check_quorum:
+            # every heartbeat that's answered extends the lease, and tells
+            # us a quorum still follows us
+            self.next_round(now)
         for uuid in self.all_peers():
             if uuid == self.uuid:  # no selfies
                 continue
-            ni = self.next_index.get(uuid, self.log.maxindex())
-            logs = self.log.logs_after_index(ni)
-            rpc = self.ae_rpc(uuid, logs)
-            self.send_to_peer(rpc, uuid)
+            inflight = self.inflight.get(uuid)
+            if inflight and now - self.last_ack.get(uuid, 0) > self.ae_timeout:
+                # nothing's come back for a while; assume what we had in
+                # flight is lost and start again from the oldest of it
+                self.next_index[uuid] = inflight[0][0]
+                del inflight[:]
+            self.send_ae_to(uuid)
+
+    def fill_window(self, uuid):
+        # keep up to ae_window batches in flight to a follower that's
+        # behind, rather than waiting a round trip between batches
+        inflight = self.inflight.setdefault(uuid, [])
+        while len(inflight) < self.ae_window:
+            if self.next_index.get(uuid, 0) >= self.log.maxindex():
+                return
+            if not self.channel.writable(uuid):
+                return
+            if not self.send_ae_to(uuid):
+                return
+
+    def send_ae_to(self, uuid):
+        # send the batch following next_index, or just a heartbeat if
+        # there's nothing to send or we can't send more yet.  returns
+        # whether we sent any entries.
+        ni = self.next_index.get(uuid, self.log.maxindex())
+        inflight = self.inflight.setdefault(uuid, [])
+        backlogged = not self.channel.writable(uuid)
+        if ni < self.log.snapidx and self.snapshot is not None:
+            # we've compacted the entries they need
+            if not backlogged:
+                self.send_snapshot(uuid)
+            return False
+        if backlogged or len(inflight) >= self.ae_window:
+            # they're not keeping up; just let them know we're alive
+            logs = {}
+        else:
+            logs = self.log.logs_after_index(ni, self.ae_max_entries,
+                                             self.ae_max_bytes)
+        rpc = self.ae_rpc(ni, logs)
+        self.send_to_peer(rpc, uuid)
+        if not logs:
+            return False
+        if not inflight:
+            # the clock on a window starts when it opens
+            self.last_ack[uuid] = self.clock()
+        last = max(logs)
+        inflight.append((ni, last))
+        self.next_index[uuid] = last
+        return True
+
+    def send_snapshot(self, uuid):
+        offset = self.snapshot_offset.setdefault(uuid, 0)
+        rpc = self.is_rpc(offset)
+        self.send_to_peer(rpc, uuid)
 
     def call_election(self):
         self.term += 1
         self.voted = self.uuid
         self.save()
+        self.elections += 1
+        self.jitter = self.rng.random()
+        self.prevotes = None
         self.cronies = set()
         self.refused = set()
         self.cronies.add(self.uuid)
-        self.election_start = time.time()
-        self.election_timeout = 0.5 * random.random() + 0.5
+        self.election_start = self.clock()
+        self.election_timeout = self.rng.uniform(self.election_timeout_min,
+                                                 self.election_timeout_max)
         self.role = 'candidate'
         self.campaign()
 
+    def call_prevote(self, now):
+        # ask for votes at the term we'd stand in, leaving our own term
+        # and vote alone.  a round that doesn't get a quorum is given an
+        # election timeout before we start another.
+        if self.prevotes is not None and \
+                now - self.election_start < self.election_timeout:
+            return
+        self.prevotes = set([self.uuid])
+        self.election_start = now
+        self.election_timeout = self.rng.uniform(self.election_timeout_min,
+                                                 self.election_timeout_max)
+        if len(self.prevotes) >= self.quorum():
+            self.call_election()
+            return
+        voters = set(self.peers)
+        if self.newpeers:
+            voters = voters.union(set(self.newpeers))
+        voters.discard(self.uuid)
+        rpc = self.pv_rpc()
+        for uuid in sorted(voters):
+            self.send_to_peer(rpc, uuid)
+
     def campaign(self):
         voted = self.cronies.union(self.refused)  # everyone who voted
         voters = set(self.peers)
@@ -356,7 +1139,7 @@ class Server(threading.Thread):
             voters = voters.union(set(self.newpeers))
         remaining = voters.difference(voted)  # peers who haven't
         rpc = self.rv_rpc()
-        for uuid in remaining:
+        for uuid in sorted(remaining):
             self.send_to_peer(rpc, uuid)
 
     def check_update_committed(self):
@@ -416,8 +1199,8 @@ class Server(threading.Thread):
             self.oldpeers = self.peers
             self.peers = self.newpeers
             self.newpeers = None
-            logentry = log.logentry(self.term, newid, data)
-            self.log.add(logentry)
+            index = self.add_to_log(data)
+            self.pending_cq.append((index, newid, None))
         else:
             # the *second* phase is now committed.  tell all our
             # current peers about the successful commit, drop
@@ -461,46 +1244,114 @@ class Server(threading.Thread):
     def quorum(self):
         peers = set(self.peers)
         if self.newpeers:
-            peers.union(set(self.newpeers))
+            peers = peers.union(set(self.newpeers))
         # oldpeers don't get a vote
-        # use sets because there could be dupes
+        # use sets because there could be dupes, and we may or may not
+        # be in our own list of peers
+        peers.add(self.uuid)
         np = len(peers)
-        return np/2 + 1
+        return np // 2 + 1
 
     def msg_recorded(self, msg):
-        # we're a leader and we just got an ack from
-        # a follower who might have been the one to
-        # commit an entry
-        term = msg['term']
-        index = msg['index']
-        uuid = msg['id']
-        self.log.add_ack(index, term, uuid)
-        if self.log.num_acked(index) >= self.quorum() and term == self.term:
-            self.log.commit(index, term)
-            assert index >= self.commitidx
-            oldidx = self.commitidx
-            self.commitidx = index
-            if self.update_uuid:
-                # if there's an update going on, see if our commit
-                # is actionable
-                self.possible_update_commit()
-            # otherwise just see what messages are now runnable
-            self.run_committed_messages(oldidx)
+        # we're a leader and a follower, or we ourselves, just got further
+        # along with the log.  everything up to where a quorum has got to
+        # is committed, provided the entry there is from our term; each
+        # follower only tells us the last index of each batch it takes,
+        # and the batches are cut differently for every one of them.
+        if msg['term'] != self.term:
+            return
+        voters = set(self.peers)
+        if self.newpeers:
+            voters = voters.union(set(self.newpeers))
+        voters.add(self.uuid)
+        matched = sorted((self.match_index.get(uuid, 0) for uuid in voters),
+                         reverse=True)
+        index = matched[self.quorum() - 1]
+        if index <= self.log.get_commit_index() or \
+                self.log.get_term_of(index) != self.term:
+            return
+        self.log.commit(index, self.term)
+        self.commitidx = index
+        if self.update_uuid:
+            # if there's an update going on, see if our commit
+            # is actionable
+            self.possible_update_commit()
+        # otherwise just see what messages are now runnable
+        self.apply_committed()
 
-    def add_to_log(self, msg):
+    def add_to_log(self, msg, raw=None):
+        # raw, if we have it, is msg as the client encoded it.  it's up to
+        # the caller to get the entry saved, and counted as ours once it's
+        # durable, by putting it on pending_cq.
         uuid = msg['id']
-        logentry = log.logentry(self.term, uuid, msg)
-        index = self.log.add(logentry)
-        self.save()
-        self.log.add_ack(index, self.term, self.uuid)
+        if raw is None:
+            msg = dict((k, v) for k, v in iteritems(msg)
+                       if k not in ('src', 'raw'))
+        else:
+            # it may be a view into the channel's receive buffer
+            if isinstance(raw, memoryview):
+                raw = raw.tobytes()
+
+        logentry = log.logentry(self.term, uuid, msg, raw)
+        return self.log.add(logentry)
 
-    def run_committed_messages(self, oldidx):
-        committed = self.log.committed_logs_after_index(oldidx)
-        for _, val in sorted(iteritems(committed)):
-            msg = val['msg']
-            msgid = msg['id']
-            data = msg['data']
-            self.queue.put((msgid, data))
+    def apply_committed(self, upto=None):
+        # hand the applier committed entries it hasn't seen, and any reads
+        # they were holding up.  a follower passes how far its log is known
+        # to match the leader's, since the leader's commit index can run
+        # ahead of that.
+        if upto is not None:
+            self.apply_limit = max(self.apply_limit,
+                                   min(upto, self.commitidx))
+        elif self.role == 'leader':
+            self.apply_limit = self.commitidx
+        self.submit_entries()
+        # reads go in behind the entries they have to see
+        waiting = []
+        for readidx, reads in self.reads_ready:
+            if readidx <= self.applying:
+                if reads:
+                    self.applier.read(reads)
+            else:
+                waiting.append((readidx, reads))
+        self.reads_ready = waiting
+        self.send_results()
+
+    def submit_entries(self):
+        # in runs of up to apply_max_batch, keeping no more than
+        # apply_max_lag of them waiting on the applier; the rest go on a
+        # later pass
+        last = min(self.apply_limit,
+                   self.applier.applied + self.apply_max_lag)
+        while self.applying < last:
+            stop = min(last, self.applying + self.apply_max_batch)
+            raws = []
+            for index in range(self.applying + 1, stop + 1):
+                ent = self.log.get(index)
+                if ent is not None and ent.raw is not None:
+                    raws.append(ent.raw)
+            self.applier.submit(stop, raws)
+            self.applying = stop
+
+    def send_results(self):
+        finished = self.applier.finished
+        while finished:
+            for msgid, result in finished.popleft():
+                src = self.clients.pop(msgid, None)
+                if src is not None:
+                    self.send_to_peer(self.cr_rpc(msgid, result), src)
+
+    def apply_stats(self):
+        applier = self.applier
+        return {
+            'commitidx': self.commitidx,
+            'applied': applier.applied,
+            'lag': max(self.commitidx - applier.applied, 0),
+            'batches': applier.batches,
+            'entries': applier.entries,
+            'reads': applier.reads,
+            'busy': applier.busy,
+        }
 
     def bootstrap_cb(self, uuid, addr):
         self.bootstraps.remove(addr)
@@ -530,26 +1381,108 @@ class Server(threading.Thread):
         }
         return msgpack.packb(rpc)
 
-    def ae_rpc(self, peeruuid, append={}):
-        previdx = self.next_index.get(peeruuid, self.log.maxindex())
+    def pv_rpc(self):
+        # a pre-vote, for the term we'd call an election in
+        log_index, log_term = self.log.get_max_index_term()
+        rpc = {
+            'type': 'pv',
+            'term': self.term + 1,
+            'id': self.uuid,
+            'log_index': log_index,
+            'log_term': log_term,
+        }
+        return msgpack.packb(rpc)
+
+    def pv_rpc_reply(self, prevote, granted):
+        rpc = {
+            'type': 'pv_reply',
+            'id': self.uuid,
+            'term': self.term,
+            'prevote': prevote,
+            'granted': granted,
+        }
+        return msgpack.packb(rpc)
+
+    def ae_rpc(self, previdx, append={}):
         rpc = {
             'type': 'ae',
             'term': self.term,
             'id': self.uuid,
             'previdx': previdx,
             'prevterm': self.log.get_term_of(previdx),
-            'entries': append,
             'commitidx': self.commitidx,
+            'round': self.read_round,
         }
-        return msgpack.packb(rpc)
+        # entries carry their own encoding, so splice those in rather
+        # than packing every entry again for every follower
+        return log.packmap(rpc, {'entries': log.pack_entries(append)})
 
-    def ae_rpc_reply(self, index, term, success):
+    def ae_rpc_reply(self, index, success, conflict_term=None,
+                     conflict_index=None):
         rpc = {
             'type': 'ae_reply',
-            'term': term,
+            'term': self.term,
+            'id': self.uuid,
+            'index': index,
+            'success': success,
+            'conflict_term': conflict_term,
+            'conflict_index': conflict_index,
+        }
+        return msgpack.packb(rpc)
+
+    def round_reply_rpc(self, rnd):
+        rpc = {
+            'type': 'round_reply',
+            'term': self.term,
+            'id': self.uuid,
+            'round': rnd,
+        }
+        return msgpack.packb(rpc)
+
+    def ri_rpc(self, req):
+        # read index request
+        rpc = {
+            'type': 'ri',
+            'term': self.term,
+            'id': self.uuid,
+            'round': req,
+        }
+        return msgpack.packb(rpc)
+
+    def ri_rpc_reply(self, req, index):
+        rpc = {
+            'type': 'ri_reply',
+            'term': self.term,
+            'id': self.uuid,
+            'round': req,
+            'index': index,
+        }
+        return msgpack.packb(rpc)
+
+    def is_rpc(self, offset):
+        index, term, data = self.snapshot
+        chunk = data[offset:offset + self.snapshot_chunk_size]
+        rpc = {
+            'type': 'is',
+            'term': self.term,
+            'id': self.uuid,
+            'index': index,
+            'lastterm': term,
+            'offset': offset,
+            'data': chunk,
+            'done': offset + len(chunk) >= len(data),
+        }
+        # the snapshot is an opaque blob, so keep it binary on the wire
+        return msgpack.packb(rpc, use_bin_type=True)
+
+    def is_rpc_reply(self, index, offset, done):
+        rpc = {
+            'type': 'is_reply',
+            'term': self.term,
             'id': self.uuid,
             'index': index,
-            'success': success
+            'offset': offset,
+            'done': done,
         }
         return msgpack.packb(rpc)
 
@@ -0,0 +1,406 @@
+from __future__ import print_function
+import heapq
+import random
+
+import msgpack
+
+from raft import log as rlog
+from raft import server as rserver
+from raft import statemachine
+
+
+# a whole cluster in one process, on a simulated clock.  the servers are
+# real ones; what's simulated is what they're handed in place of a socket,
+# a store, a clock and a source of randomness.  nothing sleeps and nothing
+# touches the network or the disk, so a run takes as long as the servers
+# take to do their work, and the same seed gives the same run.
+
+
+class Clock(object):
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class Network(object):
+    # carries messages between endpoints, each taking between min_latency
+    # and max_latency seconds.  loss of them go missing, as does anything
+    # sent to an endpoint that's down or on the other side of a partition
+    # when it would have arrived.  messages between two endpoints arrive
+    # in the order they were sent, as over tcp, unless reorder is set.
+
+    def __init__(self, clock, rng, min_latency=0.0005, max_latency=0.0015,
+                 loss=0.0, reorder=False):
+        self.clock = clock
+        self.rng = rng
+        self.min_latency = min_latency
+        self.max_latency = max_latency
+        self.loss = loss
+        self.reorder = reorder
+        self.endpoints = {}
+        # (arrival, seq, dst, src, msg), and the latest arrival on each
+        # (src, dst) link so far
+        self.queue = []
+        self.seq = 0
+        self.last = {}
+        self.groups = None
+        self.sent = 0
+        self.dropped = 0
+
+    def endpoint(self, uuid):
+        if uuid not in self.endpoints:
+            self.endpoints[uuid] = Endpoint(self, uuid)
+        return self.endpoints[uuid]
+
+    def partition(self, *groups):
+        # endpoints can only reach others in the same group; anything not
+        # in a group can only reach the rest of the ungrouped
+        self.groups = {}
+        for num, group in enumerate(groups):
+            for uuid in group:
+                self.groups[uuid] = num
+
+    def heal(self):
+        self.groups = None
+
+    def connected(self, src, dst):
+        if self.groups is None:
+            return True
+        return self.groups.get(src) == self.groups.get(dst)
+
+    def send(self, src, dst, msg):
+        self.sent += 1
+        if self.loss and self.rng.random() < self.loss:
+            self.dropped += 1
+            return
+        now = self.clock()
+        when = now + self.rng.uniform(self.min_latency, self.max_latency)
+        if not self.reorder:
+            when = max(when, self.last.get((src, dst), now))
+            self.last[(src, dst)] = when
+        self.seq += 1
+        if isinstance(msg, memoryview):
+            msg = msg.tobytes()
+        heapq.heappush(self.queue, (when, self.seq, dst, src, msg))
+
+    def next_arrival(self):
+        return self.queue[0][0] if self.queue else None
+
+    def deliver(self, now):
+        # everything due by now goes into its endpoint's inbox
+        while self.queue and self.queue[0][0] <= now:
+            _, _, dst, src, msg = heapq.heappop(self.queue)
+            ep = self.endpoints.get(dst)
+            if ep is None or not ep.up or not self.connected(src, dst):
+                self.dropped += 1
+                continue
+            ep.inbox.append((src, msg))
+
+
+class Endpoint(object):
+    # what a server or client gets in place of a raft.tcp.TCP.  everyone
+    # on the network is always connected to everyone else, so addresses
+    # are just uuids, and recv never waits; the cluster only runs a
+    # server's loop when its poll would have returned.
+
+    def __init__(self, network, uuid):
+        self.network = network
+        self.uuid = uuid
+        self.inbox = []
+        self.up = True
+
+    def __contains__(self, uuid):
+        return True
+
+    def connect(self, addr):
+        pass
+
+    def connectbs(self, addr, callback):
+        pass
+
+    def send(self, msg, uuid):
+        if self.up:
+            self.network.send(self.uuid, uuid, msg)
+
+    def writable(self, uuid):
+        return True
+
+    def recv(self, timeout=0):
+        # [(uuid, [msg, ...]), ...] like TCP.recv, consecutive messages
+        # from the same sender grouped together
+        ans = []
+        for src, msg in self.inbox:
+            if ans and ans[-1][0] == src:
+                ans[-1][1].append(msg)
+            else:
+                ans.append((src, [msg]))
+        self.inbox = []
+        return ans
+
+
+class MemoryStore(object):
+    # what a server gets in place of a raft.store.Store: the same state,
+    # kept in memory, so it survives the server being restarted but not
+    # the process.  writes are durable as soon as they're made.
+
+    def __init__(self, uuid, peers):
+        self.meta = (0, None, dict(peers), uuid, 0)
+        # encoded entries, entries[i] holding index base + i
+        self.entries = []
+        self.base = 0
+        self.snapshot = None
+        self.durable_index = -1
+        self.checkpointed = 0
+
+    def read_state(self):
+        term, voted, peers, uuid, commitidx = self.meta
+        log = {}
+        if self.snapshot is not None:
+            index, snapterm, _ = self.snapshot
+            log[index] = rlog.snapentry(index, snapterm)
+        for enc in self.entries:
+            ent = rlog.LogEntry.from_encoded(enc)
+            ent.committed = ent.index <= commitidx
+            log[ent.index] = ent
+        return term, voted, log, dict(peers), uuid
+
+    def read_snapshot(self):
+        return self.snapshot
+
+    def first_index_term(self):
+        # everything comes back from read_state, so there's nothing for
+        # the log to go looking for on its own
+        return None
+
+    def read(self, index):
+        pos = index - self.base
+        if 0 <= pos < len(self.entries):
+            return rlog.LogEntry.from_encoded(self.entries[pos])
+        return None
+
+    def write_state(self, term, voted, entries, peers, uuid, commitidx=0):
+        for ent in entries:
+            pos = ent.index - self.base
+            if not 0 <= pos <= len(self.entries):
+                # a snapshot's stub, or the start of the log
+                self.entries = []
+                self.base = ent.index
+                pos = 0
+            # an entry replaces everything from its index on
+            del self.entries[pos:]
+            self.entries.append(ent.encoded())
+            self.durable_index = ent.index
+        self.meta = (term, voted, dict(peers), uuid, commitidx)
+
+    def write_snapshot(self, index, term, data):
+        self.snapshot = (index, term, data)
+        drop = index + 1 - self.base
+        if drop > 0:
+            del self.entries[:drop]
+            self.base = index + 1
+
+    def write_checkpoint(self, termstarts, termids, msgids):
+        self.checkpointed = self.durable_index
+
+    def sync(self):
+        return self.durable_index
+
+    def sync_wait(self, now=None):
+        return None
+
+    def sync_if_due(self, now=None):
+        return self.durable_index
+
+    def close(self):
+        pass
+
+
+class KeyValue(statemachine.StateMachine):
+    # commands are (key, value) and set key, reads are a key
+    def __init__(self):
+        self.data = {}
+
+    def apply_batch(self, entries):
+        results = []
+        for _, (key, value) in entries:
+            self.data[key] = value
+            results.append(value)
+        return results
+
+    def restore(self, data):
+        self.data = msgpack.unpackb(data, encoding='utf-8')
+
+    def read(self, query):
+        return self.data.get(query)
+
+
+class Client(object):
+    # sends commands and reads into the cluster and times them.  it
+    # follows redirects, and anything that goes unanswered for retry
+    # seconds is sent again, to the next node along; the server's msgid
+    # window stops a retried command from being applied twice.
+
+    def __init__(self, cluster, uuid, retry=0.5):
+        self.cluster = cluster
+        self.uuid = uuid
+        self.endpoint = cluster.network.endpoint(uuid)
+        self.retry = retry
+        self.target = cluster.uuids[0]
+        self.count = 0
+        # msgid -> [rpc, when we last sent it, when we first did]
+        self.outstanding = {}
+        # msgid -> (started, finished, result)
+        self.done = {}
+
+    def send(self, data):
+        return self.request({'type': 'cq', 'data': data})
+
+    def read(self, query, max_lag=None, max_age=None):
+        return self.request({'type': 'rq', 'data': query,
+                             'max_lag': max_lag, 'max_age': max_age})
+
+    def request(self, rpc):
+        self.count += 1
+        msgid = '%s-%d' % (self.uuid, self.count)
+        rpc['id'] = msgid
+        rpc = msgpack.packb(rpc)
+        now = self.cluster.clock()
+        self.outstanding[msgid] = [rpc, now, now]
+        self.endpoint.send(rpc, self.target)
+        return msgid
+
+    def tick(self):
+        now = self.cluster.clock()
+        for _, msgs in self.endpoint.recv():
+            for raw in msgs:
+                msg = msgpack.unpackb(raw, use_list=False, encoding='utf-8')
+                item = self.outstanding.get(msg['id'])
+                if item is None:
+                    continue
+                if msg['type'] == 'cr':
+                    del self.outstanding[msg['id']]
+                    self.done[msg['id']] = (item[2], now, msg['data'])
+                elif msg['type'] == 'cr_rdr':
+                    self.target = msg['leader']
+                    item[1] = now
+                    self.endpoint.send(item[0], self.target)
+        stale = [msgid for msgid, item in sorted(self.outstanding.items())
+                 if now - item[1] >= self.retry]
+        if stale:
+            uuids = self.cluster.uuids
+            self.target = uuids[(uuids.index(self.target) + 1) % len(uuids)]
+        for msgid in stale:
+            item = self.outstanding[msgid]
+            item[1] = now
+            self.endpoint.send(item[0], self.target)
+
+    def poll_timeout(self):
+        return self.retry
+
+
+class Cluster(object):
+    # size servers, n0 to n(size - 1), each with a MemoryStore and an
+    # Endpoint, plus whatever clients are added, driven one event at a
+    # time.  a server runs a pass of its event loop, at that moment on the
+    # clock, whenever a message arrives for it or its poll would have
+    # timed out.  options override Server's class settings for every
+    # server, before it loads its store, and network keywords go to the
+    # Network.  durability is the store's business; a MemoryStore's
+    # writes are durable as soon as they're made, so it can't be set.
+
+    def __init__(self, size=3, seed=0, sm=KeyValue, options=None,
+                 **network):
+        self.clock = Clock()
+        self.rng = random.Random(seed)
+        self.network = Network(self.clock, random.Random(self.rng.random()),
+                               **network)
+        self.sm = sm
+        self.options = options or {}
+        for name in self.options:
+            if name == 'durability' or not hasattr(rserver.Server, name):
+                raise ValueError("can't set %r on a simulated server"
+                                 % (name,))
+        self.server = type('Server', (rserver.Server,), dict(self.options))
+        self.uuids = ['n%d' % i for i in range(size)]
+        self.stores = {}
+        for uuid in self.uuids:
+            peers = dict((peer, peer) for peer in self.uuids if peer != uuid)
+            self.stores[uuid] = MemoryStore(uuid, peers)
+        self.servers = {}
+        self.clients = {}
+        # when each server or client next runs, if nothing arrives first
+        self.wakeups = {}
+        for uuid in self.uuids:
+            self.start(uuid)
+
+    def start(self, uuid):
+        # bring a server up, from whatever its store has
+        ep = self.network.endpoint(uuid)
+        ep.up = True
+        ep.inbox = []
+        srv = self.server(self.sm(), 0, [], transport=ep,
+                          storage=self.stores[uuid], clock=self.clock,
+                          rng=random.Random(self.rng.random()))
+        self.servers[uuid] = srv
+        self.wakeups[uuid] = self.clock()
+        return srv
+
+    def stop(self, uuid):
+        # crash a server: it stops, and so does anything on its way to it
+        self.network.endpoint(uuid).up = False
+        del self.servers[uuid]
+        del self.wakeups[uuid]
+
+    def client(self, uuid=None, retry=0.5):
+        uuid = uuid or 'c%d' % len(self.clients)
+        cl = Client(self, uuid, retry)
+        self.clients[uuid] = cl
+        self.wakeups[uuid] = self.clock()
+        return cl
+
+    def leader(self):
+        # the leader in the latest term, if there is one
+        leaders = [srv for srv in self.servers.values()
+                   if srv.role == 'leader']
+        if not leaders:
+            return None
+        return max(leaders, key=lambda srv: srv.term)
+
+    def step(self):
+        # run everything that happens next
+        when = min(self.wakeups.values())
+        arrival = self.network.next_arrival()
+        if arrival is not None and arrival < when:
+            when = arrival
+        self.clock.now = max(self.clock.now, when)
+        self.network.deliver(self.clock.now)
+        for uuid in sorted(self.wakeups):
+            ep = self.network.endpoints[uuid]
+            if self.wakeups[uuid] > self.clock.now and not ep.inbox:
+                continue
+            if uuid in self.servers:
+                srv = self.servers[uuid]
+                srv.tick()
+                srv.applier.apply_pending()
+                srv.send_results()
+                timeout = srv.poll_timeout()
+            else:
+                cl = self.clients[uuid]
+                cl.tick()
+                timeout = cl.poll_timeout()
+            self.wakeups[uuid] = self.clock.now + timeout
+
+    def run(self, duration):
+        self.run_until(lambda: False, duration)
+
+    def run_until(self, done, timeout):
+        # step until done() is true, or timeout seconds go by; returns
+        # whether it was done
+        end = self.clock() + timeout
+        while not done():
+            if self.clock() >= end:
+                return False
+            self.step()
+        return True
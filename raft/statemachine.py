@@ -0,0 +1,155 @@
+import time
+import logging
+import threading
+import collections
+try:
+    import Queue
+except ImportError: # for python3
+    import queue as Queue
+
+import msgpack
+
+
+class StateMachine(object):
+    # what committed client commands are applied to.  apply_batch is
+    # called, always from the same thread (see Applier), with runs of
+    # (msgid, data) pairs in log order, each run directly following the
+    # last; it returns one result per entry, and the leader sends each
+    # back to the client that asked for it as the data of a 'cr'.  one
+    # without any state to read says so with answers_reads.
+
+    answers_reads = True
+
+    def apply_batch(self, entries):
+        raise NotImplementedError
+
+    def restore(self, data):
+        # state from a snapshot (ours on startup, or one a leader sent us)
+        # replaces whatever we had; the entries that follow come through
+        # apply_batch as usual
+        raise NotImplementedError
+
+    def read(self, query):
+        # answer a query from the current state, without changing it.  by
+        # the time this is called everything committed before the query
+        # came in has been applied.
+        raise NotImplementedError
+
+
+class QueueStateMachine(StateMachine):
+    # the original interface: every command goes on a queue as
+    # (msgid, data), and a snapshot as (None, data), for some other
+    # thread to deal with.  the results are all None, and there's no
+    # state here to read.
+
+    answers_reads = False
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def apply_batch(self, entries):
+        for entry in entries:
+            self.queue.put(entry)
+        return [None] * len(entries)
+
+    def restore(self, data):
+        self.queue.put((None, data))
+
+
+class Applier(threading.Thread):
+    # runs a state machine on a thread of its own, so however long it
+    # takes, elections and heartbeats don't wait on it.  the server
+    # submits committed entries in runs, as the client encoded them, and
+    # reads once what they need has been submitted, and collects
+    # (msgid, result) pairs from finished.  applied is the last
+    # index the state machine has seen; the rest are counters for anyone
+    # watching.
+
+    def __init__(self, sm):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.sm = sm
+        self.work = Queue.Queue()
+        self.finished = collections.deque()
+        self.applied = 0
+        self.batches = 0
+        self.entries = 0
+        self.reads = 0
+        self.busy = 0.0
+        # work handed over and work done, so the server can tell when
+        # results are on their way
+        self.queued = 0
+        self.processed = 0
+
+    def submit(self, last, raws):
+        # raws are the payloads of the entries following applied, up to
+        # and including last
+        self.put(('apply', last, raws))
+
+    def restore(self, index, data):
+        self.put(('restore', index, data))
+
+    def read(self, queries):
+        # (msgid, query) pairs, answered after everything submitted so far
+        self.put(('read', None, queries))
+
+    def put(self, item):
+        self.queued += 1
+        self.work.put(item)
+
+    def working(self):
+        return self.processed < self.queued
+
+    def stop(self):
+        self.work.put(None)
+
+    def run(self):
+        while True:
+            item = self.work.get()
+            if item is None:
+                return
+            self.process(*item)
+
+    def apply_pending(self):
+        # whatever's been submitted, on the calling thread
+        while True:
+            try:
+                item = self.work.get_nowait()
+            except Queue.Empty:
+                return
+            if item is not None:
+                self.process(*item)
+
+    def process(self, kind, last, payload):
+        start = time.time()
+        try:
+            self.call(kind, payload)
+        except Exception:
+            # the state machine's problem, not ours; whatever it was
+            # working on is done with, and the next thing goes ahead
+            logging.exception('state machine failed on %s', kind)
+        self.busy += time.time() - start
+        if last is not None:
+            self.applied = last
+        self.processed += 1
+
+    def call(self, kind, payload):
+        if kind == 'restore':
+            self.sm.restore(payload)
+        elif kind == 'read':
+            self.reads += len(payload)
+            self.finished.append([(msgid, self.sm.read(query))
+                                  for msgid, query in payload])
+        else:
+            batch = []
+            for raw in payload:
+                msg = msgpack.unpackb(raw, use_list=False, encoding='utf-8')
+                # config changes are the server's, not the state machine's
+                if 'data' in msg:
+                    batch.append((msg['id'], msg['data']))
+            if batch:
+                self.batches += 1
+                self.entries += len(batch)
+                results = self.sm.apply_batch(batch)
+                self.finished.append([(msgid, result) for (msgid, _), result
+                                      in zip(batch, results)])
@@ -1,23 +1,550 @@
 import os
+import mmap
+import time
+import array
 import errno
+import bisect
 import uuid
+import struct
+import zlib
 
 import msgpack  # we're using it anyway...
 
+from raft import log as rlog
 
-def read_state(port):
-    sfile = "/tmp/raft-state-%d" % port
-    try:
-        with open(sfile) as r:
-            return msgpack.unpackb(r.read())
-    except IOError as e:
-        if not e.errno == errno.ENOENT:
-            raise
-    # no state file exists; initialize with fresh values
-    return 0, None, None, {}, uuid.uuid4().hex
 
+# every record in a segment is framed as (payload length, crc32 of payload)
+header = struct.Struct("!II")
 
-def write_state(port, term, voted, log, peers, uuid):
-    sfile = "/tmp/raft-state-%d" % port
-    with open(sfile, 'w') as w:
-        w.write(msgpack.packb((term, voted, log, peers, uuid)))
+# how hard we try to get writes onto the disk: not at all (the os gets to
+# it when it gets to it), batched (fsync once sync_interval has passed
+# or sync_bytes have been written since the last one), or strict (fsync
+# every write)
+NONE = 'none'
+BATCH = 'batch'
+STRICT = 'strict'
+
+# everything a checkpoint has to have to be any use
+CHECKPOINT_KEYS = ('pos', 'maxidx', 'first', 'segmax', 'runstarts',
+                   'runseqs', 'runs', 'itemsize', 'terms', 'msgids')
+
+
+class Store(object):
+    # the on-disk state is a directory holding a small metadata file
+    # (term, vote, peers, our uuid and the commit index) that is rewritten
+    # whole, and a write-ahead log of entries split across fixed-size
+    # append-only segment files.  a record for index i replaces index i
+    # and everything after it, which is exactly how followers truncate
+    # their logs, so replaying the segments in order rebuilds the log.
+    #
+    # entries only count as written once durable_index covers them;
+    # callers that promise anything about an entry (acking a client,
+    # acking a leader) have to wait for that.
+    def __init__(self, port, path=None, segsize=4*1024*1024,
+                 durability=BATCH, sync_interval=0.005,
+                 sync_bytes=1024*1024, window=rlog.DEDUPE_WINDOW):
+        if path is None:
+            path = "/tmp/raft-state-%d" % port
+        if durability not in (NONE, BATCH, STRICT):
+            raise ValueError("unknown durability %r" % (durability,))
+        self.port = port
+        self.path = path
+        self.segsize = segsize
+        self.segments = []
+        self.segmax = {}
+        self.active = None
+        self.meta = None
+        self.durability = durability
+        self.sync_interval = sync_interval
+        self.sync_bytes = sync_bytes
+        # the last index written, the last one that's safely on disk, and
+        # how much is waiting on an fsync and since when
+        self.written_index = -1
+        self.durable_index = -1
+        self.unsynced = 0
+        self.unsynced_since = None
+        # where each record lives: runs of consecutive indexes in the
+        # same segment, with the first index of every run in runstarts
+        # and (segment, offsets) in runs.  entries are read back through
+        # a read-only map of their segment.
+        self.runstarts = []
+        self.runs = []
+        self.maps = {}
+        self.first = None
+        # what replay learned about the log, until it's taken
+        self.termstarts = []
+        self.termids = []
+        self.window = window
+        self.msgids = rlog.MsgidWindow(window)
+        # the last index the checkpoint covers
+        self.checkpointed = -1
+
+    #
+    ## reading
+    #
+
+    def read_state(self):
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if not e.errno == errno.EEXIST:
+                raise
+        self.segments = self.list_segments()
+        meta = self.read_meta()
+        commitidx = meta[4] if meta is not None else 0
+        log = self.replay(commitidx)
+        if meta is None:
+            # no state exists; initialize with fresh values
+            return 0, None, log, {}, uuid.uuid4().hex
+        term, voted, peers, uuid_, commitidx = meta
+        if log:
+            for idx in log:
+                if idx <= commitidx:
+                    log[idx]['committed'] = True
+        peers = dict((k, tuple(v)) for k, v in peers.items())
+        return term, voted, log, peers, uuid_
+
+    def read_meta(self):
+        try:
+            with open(self.metafile(), 'rb') as r:
+                return msgpack.unpackb(r.read(), encoding='utf-8')
+        except IOError as e:
+            if not e.errno == errno.ENOENT:
+                raise
+
+    def read_snapshot(self):
+        # (index, term, data) of the latest snapshot, or None
+        try:
+            with open(self.snapfile(), 'rb') as r:
+                return msgpack.unpackb(r.read(), use_list=False,
+                                       encoding='utf-8')
+        except IOError as e:
+            if not e.errno == errno.ENOENT:
+                raise
+
+    def replay(self, commitidx=0):
+        # find every record in the segments, and the terms and msgids of
+        # the log they add up to.  only entries from commitidx on come
+        # back as objects; older ones stay on disk until they're read.
+        # with a checkpoint, only what was written after it is scanned.
+        log = {}
+        maxidx = -1
+        snap = self.read_snapshot()
+        if snap is not None:
+            snapidx, snapterm, _ = snap
+        resume = self.load_checkpoint(snap)
+        if resume is not None:
+            maxidx = self.written_index
+            for idx in range(max(commitidx, self.first[0]), maxidx + 1):
+                ent = self.read(idx)
+                if ent is not None:
+                    log[idx] = ent
+        elif snap is not None:
+            # everything up to the snapshot is gone; the snapshot point
+            # stands in for it the way index 0 does in a fresh log
+            self.first = (snapidx, snapterm)
+            self.note_term(snapidx, snapterm)
+            maxidx = snapidx
+        if snap is not None and snapidx >= commitidx:
+            log[snapidx] = rlog.snapentry(snapidx, snapterm)
+        startseq, startpos = resume or (-1, 0)
+        for num, seq in enumerate(self.segments):
+            if seq < startseq:
+                continue
+            torn = False
+            segmax = self.segmax.get(seq, -1)
+            pos = startpos if seq == startseq else 0
+            for off, payload in self.read_segment(seq, pos):
+                if payload is None:
+                    torn = True
+                    break
+                ent = rlog.LogEntry.from_encoded(payload)
+                idx = ent.index
+                segmax = max(segmax, idx)
+                if snap is not None and idx < snapidx:
+                    continue
+                if self.first is None:
+                    self.first = (idx, ent.term)
+                for rem in range(idx, maxidx + 1):
+                    log.pop(rem, None)
+                self.note_offset(idx, seq, off)
+                self.note_term(idx, ent.term)
+                self.msgids.truncate(idx)
+                if snap is not None and idx == snapidx:
+                    # the snapshot point still truncates what came before
+                    # it: that's how a reset throws away a log that
+                    # disagreed with the snapshot.  the snapshot stands in
+                    # for the entry itself.
+                    if not ent.msgid:
+                        self.msgids = rlog.MsgidWindow(self.window)
+                    if idx >= commitidx:
+                        log[idx] = rlog.snapentry(snapidx, snapterm)
+                else:
+                    self.msgids.add(ent.msgid, idx)
+                    if idx >= commitidx:
+                        log[idx] = ent
+                maxidx = idx
+            self.segmax[seq] = segmax
+            if torn:
+                # anything written after a torn record is unreliable
+                for later in self.segments[num + 1:]:
+                    os.remove(self.segfile(later))
+                    self.segmax.pop(later, None)
+                self.segments = self.segments[:num + 1]
+                break
+        self.written_index = self.durable_index = maxidx
+        if self.first is None:
+            return None
+        return log
+
+    def load_checkpoint(self, snap):
+        # pick up what a checkpoint knew about the segments, and return
+        # (segment, offset) of where it left off.  if there's no usable
+        # checkpoint, return None and leave everything to the scan.
+        try:
+            with open(self.checkpointfile(), 'rb') as r:
+                state = msgpack.unpackb(r.read(), encoding='utf-8')
+        except IOError as e:
+            if not e.errno == errno.ENOENT:
+                raise
+            return None
+        except (ValueError, TypeError, msgpack.UnpackException):
+            # torn or garbled; it's only ever a shortcut
+            return None
+        if not isinstance(state, dict) or \
+                [key for key in CHECKPOINT_KEYS if key not in state]:
+            return None
+        seq, pos = state['pos']
+        if seq not in self.segments or \
+                os.path.getsize(self.segfile(seq)) < pos:
+            # the wal lost writes the checkpoint saw
+            return None
+        if state['itemsize'] != array.array('L').itemsize:
+            # written somewhere else
+            return None
+        self.first = tuple(state['first'])
+        self.written_index = state['maxidx']
+        self.checkpointed = self.written_index
+        # a snapshot taken since may have deleted segments
+        for num, seq_ in enumerate(state['runseqs']):
+            if seq_ in self.segments:
+                self.runstarts.append(state['runstarts'][num])
+                self.runs.append((seq_, frombytes(state['runs'][num])))
+        self.segmax = dict((k, v) for k, v in state['segmax'].items()
+                           if k in self.segments)
+        self.termstarts, self.termids = state['terms']
+        self.msgids = rlog.MsgidWindow(self.window, state['msgids'])
+        if snap is not None and snap[0] > self.first[0]:
+            snapidx, snapterm, _ = snap
+            self.first = (snapidx, snapterm)
+            start = bisect.bisect_right(self.termstarts, snapidx) - 1
+            self.termstarts = [snapidx] + self.termstarts[start + 1:]
+            self.termids = [snapterm] + self.termids[start + 1:]
+        return seq, pos
+
+    def read_segment(self, seq, pos=0):
+        # yield (offset, payload) for every intact record in a segment
+        # from pos on.  if we hit a torn or corrupt record, chop the
+        # segment there and yield (offset, None).
+        fname = self.segfile(seq)
+        if os.path.getsize(fname) <= pos:
+            return
+        with open(fname, 'rb') as r:
+            data = mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            while pos < len(data):
+                end = pos + header.size
+                if end > len(data):
+                    break
+                size, crc = header.unpack_from(data, pos)
+                payload = data[end:end + size]
+                if len(payload) < size or \
+                        zlib.crc32(payload) & 0xffffffff != crc:
+                    break
+                yield pos, payload
+                pos = end + size
+            else:
+                return
+        finally:
+            data.close()
+        with open(fname, 'r+b') as w:
+            w.truncate(pos)
+        yield pos, None
+
+    def first_index_term(self):
+        # (index, term) of the first thing in the log we have, snapshot
+        # point included, or None if we have nothing at all
+        return self.first
+
+    def maxindex(self):
+        return self.written_index
+
+    def take_index(self):
+        # the term starts and msgid window replay built; they're the
+        # log's to maintain from here on
+        index = (self.termstarts, self.termids, self.msgids)
+        self.termstarts, self.termids = [], []
+        self.msgids = rlog.MsgidWindow(self.window)
+        return index
+
+    def read(self, index):
+        # the entry at index, straight out of the segment holding it
+        pos = bisect.bisect_right(self.runstarts, index) - 1
+        if pos < 0:
+            return None
+        seq, offsets = self.runs[pos]
+        num = index - self.runstarts[pos]
+        if num >= len(offsets):
+            return None
+        off = offsets[num]
+        data = self.segment_map(seq, off + header.size)
+        size, _ = header.unpack_from(data, off)
+        start = off + header.size
+        data = self.segment_map(seq, start + size)
+        return rlog.LogEntry.from_encoded(data[start:start + size])
+
+    def segment_map(self, seq, size):
+        # a read-only map of a segment at least size bytes long.  the
+        # active segment keeps growing, so it gets remapped as needed.
+        data = self.maps.get(seq)
+        if data is None or len(data) < size:
+            if data is not None:
+                data.close()
+            with open(self.segfile(seq), 'rb') as r:
+                data = mmap.mmap(r.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[seq] = data
+        return data
+
+    def unmap(self, seq):
+        data = self.maps.pop(seq, None)
+        if data is not None:
+            data.close()
+
+    def note_offset(self, idx, seq, off):
+        # the record for idx is at off in seq, and it replaces whatever
+        # we had for idx and after
+        pos = bisect.bisect_right(self.runstarts, idx) - 1
+        if pos >= 0:
+            del self.runs[pos][1][idx - self.runstarts[pos]:]
+            if not self.runs[pos][1]:
+                pos -= 1
+        del self.runstarts[pos + 1:]
+        del self.runs[pos + 1:]
+        if self.runs and self.runs[-1][0] == seq and \
+                self.runstarts[-1] + len(self.runs[-1][1]) == idx:
+            self.runs[-1][1].append(off)
+        else:
+            self.runstarts.append(idx)
+            self.runs.append((seq, array.array('L', [off])))
+
+    def note_term(self, idx, term):
+        pos = bisect.bisect_left(self.termstarts, idx)
+        del self.termstarts[pos:]
+        del self.termids[pos:]
+        if not self.termids or self.termids[-1] != term:
+            self.termstarts.append(idx)
+            self.termids.append(term)
+
+    #
+    ## writing
+    #
+
+    def write_state(self, term, voted, entries, peers, uuid, commitidx=0):
+        if entries:
+            self.append(entries)
+        meta = (term, voted, peers, uuid, commitidx)
+        if meta != self.meta:
+            self.write_meta(meta)
+
+    def write_meta(self, meta):
+        # our term and vote have to survive a crash before anybody hears
+        # about them.  the file always reaches the disk before it's renamed
+        # into place, or a crash could leave it empty; but the commit index
+        # can always be learned again, so a change to just that doesn't
+        # wait on the directory.
+        sync = self.durability != NONE
+        tmp = self.metafile() + '.tmp'
+        with open(tmp, 'wb') as w:
+            w.write(msgpack.packb(meta))
+            if sync:
+                w.flush()
+                os.fsync(w.fileno())
+        os.rename(tmp, self.metafile())
+        if sync and (self.meta is None or meta[:4] != self.meta[:4]):
+            self.sync_dir()
+        self.meta = meta
+
+    def append(self, entries):
+        for ent in entries:
+            if self.active is None or self.active.tell() >= self.segsize:
+                self.roll()
+            # acks and commit flags are transient; the commit index lives
+            # in the metadata file
+            data = frame(ent.encoded())
+            seq = self.segments[-1]
+            self.note_offset(ent.index, seq, self.active.tell())
+            if self.first is None:
+                self.first = (ent.index, ent.term)
+            self.active.write(data)
+            self.unsynced += len(data)
+            self.segmax[seq] = max(self.segmax[seq], ent['index'])
+            # a record can replace ones we've already synced
+            self.durable_index = min(self.durable_index, ent['index'] - 1)
+            self.written_index = ent['index']
+        self.active.flush()
+        if self.unsynced_since is None:
+            self.unsynced_since = time.time()
+        if self.durability == STRICT or self.unsynced >= self.sync_bytes:
+            self.sync()
+        elif self.durability == NONE:
+            self.durable_index = self.written_index
+
+    def sync(self):
+        # everything written so far is on disk when this returns
+        if self.active is not None and self.durability != NONE:
+            os.fsync(self.active.fileno())
+        self.durable_index = self.written_index
+        self.unsynced = 0
+        self.unsynced_since = None
+        return self.durable_index
+
+    def sync_wait(self, now=None):
+        # seconds until sync_if_due has something to do, or None if
+        # nothing is waiting on the disk
+        if self.unsynced_since is None:
+            return None
+        now = time.time() if now is None else now
+        return max(self.unsynced_since + self.sync_interval - now, 0)
+
+    def sync_if_due(self, now=None):
+        # call this regularly; returns the durable index
+        if self.sync_wait(now) == 0:
+            self.sync()
+        return self.durable_index
+
+    def sync_dir(self):
+        # make renames and new files in our directory stick
+        fd = os.open(self.path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def write_snapshot(self, index, term, data):
+        tmp = self.snapfile() + '.tmp'
+        with open(tmp, 'wb') as w:
+            w.write(msgpack.packb((index, term, data), use_bin_type=True))
+            if self.durability != NONE:
+                # the segments it replaces are about to go
+                w.flush()
+                os.fsync(w.fileno())
+        os.rename(tmp, self.snapfile())
+        if self.durability != NONE:
+            self.sync_dir()
+        # sealed segments that hold nothing past the snapshot are garbage
+        for seq in self.segments[:-1]:
+            if self.segmax[seq] <= index:
+                self.unmap(seq)
+                os.remove(self.segfile(seq))
+                del self.segmax[seq]
+        self.segments = [seq for seq in self.segments if seq in self.segmax]
+        keep = [pos for pos, (seq, _) in enumerate(self.runs)
+                if seq in self.segmax]
+        self.runstarts = [self.runstarts[pos] for pos in keep]
+        self.runs = [self.runs[pos] for pos in keep]
+        self.first = (index, term)
+
+    def write_checkpoint(self, termstarts, termids, msgids):
+        # save everything replay would otherwise have to scan the whole
+        # wal to learn, as of now, so the next startup only scans what
+        # comes after.  the terms and msgids are the log's, which has to
+        # have nothing unsaved.
+        if self.active is None:
+            return
+        self.sync()
+        state = {
+            'pos': (self.segments[-1], self.active.tell()),
+            'maxidx': self.written_index,
+            'first': self.first,
+            'segmax': self.segmax,
+            'runstarts': self.runstarts,
+            'runseqs': [seq for seq, _ in self.runs],
+            'runs': [tobytes(offsets) for _, offsets in self.runs],
+            'itemsize': array.array('L').itemsize,
+            'terms': (termstarts, termids),
+            'msgids': msgids.pairs(),
+        }
+        tmp = self.checkpointfile() + '.tmp'
+        with open(tmp, 'wb') as w:
+            w.write(msgpack.packb(state, use_bin_type=True))
+            if self.durability != NONE:
+                w.flush()
+                os.fsync(w.fileno())
+        os.rename(tmp, self.checkpointfile())
+        self.checkpointed = self.written_index
+
+    def roll(self):
+        # seal the current segment and start a new one
+        if self.active is not None:
+            if self.durability != NONE:
+                os.fsync(self.active.fileno())
+            self.active.close()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        seq = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(seq)
+        self.segmax[seq] = -1
+        self.active = open(self.segfile(seq), 'ab')
+        if self.durability != NONE:
+            self.sync_dir()
+
+    def close(self):
+        if self.active is not None:
+            self.sync()
+            self.active.close()
+            self.active = None
+        for seq in list(self.maps):
+            self.unmap(seq)
+
+    #
+    ## file names
+    #
+
+    def metafile(self):
+        return os.path.join(self.path, 'meta')
+
+    def snapfile(self):
+        return os.path.join(self.path, 'snapshot')
+
+    def checkpointfile(self):
+        return os.path.join(self.path, 'checkpoint')
+
+    def segfile(self, seq):
+        return os.path.join(self.path, 'wal-%08d' % seq)
+
+    def list_segments(self):
+        segs = []
+        for name in os.listdir(self.path):
+            if name.startswith('wal-'):
+                segs.append(int(name[4:]))
+        return sorted(segs)
+
+
+def tobytes(offsets):
+    if hasattr(offsets, 'tobytes'):
+        return offsets.tobytes()
+    return offsets.tostring()  # python 2
+
+
+def frombytes(data):
+    offsets = array.array('L')
+    if hasattr(offsets, 'frombytes'):
+        offsets.frombytes(data)
+    else:
+        offsets.fromstring(data)  # python 2
+    return offsets
+
+
+def frame(payload):
+    return header.pack(len(payload), zlib.crc32(payload) & 0xffffffff) + \
+        payload
@@ -2,31 +2,67 @@ import socket
 import errno
 import struct
 try:
-    import thread
-except ImportError: # for python3
-    import _thread as thread
-import select
+    import selectors
+except ImportError: # for python2
+    import selectors34 as selectors
 
 from raft.bijectivemap import create_map
 
 
-def start(port, uuid):
-    tcp = TCP(port, uuid)
+# once this many bytes are queued for a connection it stops being
+# writable, and it stays that way until it drains below the low mark
+HIGH_WATER = 4 * 1024 * 1024
+LOW_WATER = 1024 * 1024
+# how much we ask the kernel for per read
+READ_SIZE = 256 * 1024
+
+header = struct.Struct("!I")
+
+
+def start(port, uuid, high_water=HIGH_WATER, low_water=LOW_WATER,
+          readsize=READ_SIZE):
+    tcp = TCP(port, uuid, high_water, low_water, readsize)
     tcp.start()
     return tcp
 
 
+def nodelay(conn):
+    # we write whole messages and wait on the answers; nagle would hold
+    # a small one back until the last was acked, which the other end
+    # delays by up to 40ms
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
 class TCP(object):
-    greeting = 'howdy!'
+    greeting = b'howdy!'
 
-    def __init__(self, port, uuid):
+    def __init__(self, port, uuid, high_water=HIGH_WATER,
+                 low_water=LOW_WATER, readsize=READ_SIZE):
         self.port = port
         self.connections = {}
         self.c2u, self.u2c = create_map()
+        # who's on the other end of every connection that's greeted us.
+        # two of us can connect to each other at once, so there can be two
+        # connections to a uuid; u2c holds the one we send on, but what
+        # comes in on either is theirs
+        self.names = {}
+        # an Inbox per connection
         self.data = {}
+        self.readsize = readsize
+        # whatever the kernel wouldn't take yet, per connection
+        self.outbuf = {}
+        self.waiting = set()
+        self.throttled = set()
+
+        self.high_water = high_water
+        self.low_water = low_water
         self.unknowns = set()
         self.a2c, self.c2a = create_map()
         self.uuid = uuid
+        # the listening socket and every connection stay registered for
+        # as long as they're open, so a pass through recv costs one
+        # select no matter how many connections we have
+        self.sel = selectors.DefaultSelector()
 
     def __contains__(self, uuid):
         return uuid in self.u2c
@@ -36,7 +72,9 @@ class TCP(object):
         self.srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.srv.bind(("", self.port))
-        thread.start_new_thread(self.accept, ())
+        self.srv.listen(128)
+        self.srv.setblocking(0)
+        self.sel.register(self.srv, selectors.EVENT_READ)
 
     def connect(self, addr):
         if addr in self.a2c:
@@ -49,118 +87,166 @@ class TCP(object):
                 return None
             raise
         conn.setblocking(0)
+        nodelay(conn)
         self.a2c[addr] = conn
         self.add_unknown(conn)
         return True
 
     def accept(self):
-        self.srv.listen(5)
-        while self.running:
+        # the listener is non-blocking; take everybody who's waiting
+        while True:
             try:
                 conn, addr = self.srv.accept()
-                self.a2c[addr] = conn
-                conn.setblocking(0)
-                self.add_unknown(conn)
             except socket.error as e:
                 if e.errno == errno.ECONNABORTED:
                     continue
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise
+            conn.setblocking(0)
+            nodelay(conn)
+            self.a2c[addr] = conn
+            self.add_unknown(conn)
 
     def recv(self, timeout=0):
         try:
-            recv, _, _ = select.select(list(self.c2u.keys()), [], [], timeout)
-        except select.error as e:
+            events = self.sel.select(timeout)
+        except (OSError, IOError) as e:
             if e.args[0] == errno.EINTR:
                 return
             raise
         rcvd = []
-        for conn in recv:
+        for key, mask in events:
+            conn = key.fileobj
+            if conn is self.srv:
+                self.accept()
+                continue
+            if mask & selectors.EVENT_WRITE:
+                self.flush(conn)
+            if not mask & selectors.EVENT_READ:
+                continue
             msgs = self.read_conn_msg(conn)
-            if msgs is not None:
-                uuid = self.c2u[conn]
-                rcvd.append((uuid, msgs))
-        self.read_unknowns()
+            if msgs:
+                rcvd.append((self.names[conn], msgs))
         return rcvd
 
     def add_unknown(self, conn):
+        # we don't know who's on the other end until they greet us; in
+        # the meantime, greet them
         self.unknowns.add(conn)
-        msgsize = struct.pack("!I", len(self.greeting) +
-                              len(self.uuid) + struct.calcsize("!I"))
+        self.sel.register(conn, selectors.EVENT_READ)
+        self.write(conn, self.greeting + self.uuid.encode('utf-8'))
+
+    def identify(self, conn, msg):
+        # bytes() of a view on python 2 is its repr, not its contents
+        msg = msg.tobytes()
+        assert msg.startswith(self.greeting)
+        uuid = msg[len(self.greeting):].decode('utf-8')
+        self.u2c[uuid] = conn
+        self.names[conn] = uuid
+        self.unknowns.remove(conn)
+
+    def read_conn_msg(self, conn):
+        # messages come back as memoryviews into the connection's inbox
+        inbox = self.data.get(conn)
+        if inbox is None:
+            inbox = self.data[conn] = Inbox(self.readsize)
         try:
-            sent = 0
-            msg = msgsize + self.greeting + self.uuid
-            while sent < len(msg):
-                sent += conn.send(msg[sent:], socket.MSG_DONTWAIT)
-        except socket.error:
-            self.unknowns.remove(conn)
+            size = inbox.fill(conn, self.readsize)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            self.remconn(conn)
             return
-        self.read_unknowns()
-
-    def read_unknowns(self):
-        recv, _, _ = select.select(list(self.unknowns), [], [], 0)
-        for conn in recv:
-            uuid = self.read_conn_msg(conn, 1)
-            if uuid:
-                uuid = uuid[0]
-                assert uuid.startswith(self.greeting)
-                uuid = uuid[len(self.greeting):]
-                self.u2c[uuid] = conn
-                self.unknowns.remove(conn)
-
-    def read_conn_msg(self, conn, msgnum=0):
-        try:
-            data = conn.recv(4092)
-        except socket.error:
+        if not size:
             self.remconn(conn)
             return
-        if data == '':
+        try:
+            msgs = list(self.extract_msg(conn))
+        except ValueError:
+            # they're not speaking our protocol
             self.remconn(conn)
-            if conn in self.c2u:
-                del self.c2u[conn]
-            if conn in self.data:
-                del self.data[conn]
             return
-        buff = self.data.get(conn, '')
-        buff += data
-        self.data[conn] = buff
-        msgs = []
-        for count, msg in enumerate(self.extract_msg(conn)):
-            msgs.append(msg)
-            if msgnum and count >= msgnum:
-                return msgs
+
+        if conn in self.unknowns and msgs:
+            # the first thing anybody sends is their greeting
+            self.identify(conn, msgs.pop(0))
+        if conn in self.unknowns:
+            return
         return msgs
 
     def extract_msg(self, conn):
-        buff = self.data[conn]
-        isize = struct.calcsize("!I")
-        if len(buff) < isize:
-            # can't even get the length of the next message
-            return
-        while len(buff) > isize:
-            size = struct.unpack("!I", buff[0:isize])[0]
-            if len(buff) < size:
-                return
-            msg = buff[isize:size]
-            buff = buff[size:]
-            self.data[conn] = buff
-            yield msg
+        return self.data[conn].frames()
 
     def send(self, msg, uuid):
-        msgsize = struct.pack("!I", len(msg) + struct.calcsize("!I"))
         try:
             conn = self.u2c[uuid]
         except KeyError:
             return
+        self.write(conn, msg)
+
+    def writable(self, uuid):
+        # false while too much is queued up for uuid; callers that can
+        # hold off (like a leader feeding a slow follower) should
+        conn = self.u2c.get(uuid)
+        return conn not in self.throttled
+
+    def buffered(self, uuid):
+        conn = self.u2c.get(uuid)
+        return len(self.outbuf.get(conn, b''))
+
+    def write(self, conn, msg):
+        # frames are never split or dropped: whatever can't be sent now
+        # is queued behind anything already waiting, and flushed when the
+        # socket becomes writable
+        msgsize = header.pack(len(msg) + header.size)
+        buf = self.outbuf.get(conn)
+        queued = buf is not None
+        if not queued:
+            buf = self.outbuf[conn] = bytearray()
+        buf += msgsize
+        buf += msg
+        if len(buf) > self.high_water:
+            self.throttled.add(conn)
+        if not queued:
+            # nothing ahead of us, so try to get it out right away
+            self.flush(conn)
+
+    def flush(self, conn):
+        buf = self.outbuf.get(conn)
+        if buf is None:
+            return
         try:
-            sent = 0
-            msg = msgsize + msg
-            while sent < len(msg):
-                sent += conn.send(msg[sent:], socket.MSG_DONTWAIT)
+            while buf:
+                sent = conn.send(buf)
+                del buf[:sent]
         except socket.error as e:
-            if e.errno == errno.EPIPE:
-                addr = conn.getsockname()
-                self.connect(addr)
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                self.remconn(conn)
+                return
+        if len(buf) < self.low_water:
+            self.throttled.discard(conn)
+        if buf and conn not in self.waiting:
+            # only ask about writability while we have something to write
+            self.sel.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+            self.waiting.add(conn)
+        elif not buf:
+            del self.outbuf[conn]
+            if conn in self.waiting:
+                self.sel.modify(conn, selectors.EVENT_READ)
+                self.waiting.remove(conn)
 
     def remconn(self, conn):
+        try:
+            self.sel.unregister(conn)
+        except (KeyError, ValueError):
+            pass
+        conn.close()
+        self.unknowns.discard(conn)
+        self.throttled.discard(conn)
+        self.waiting.discard(conn)
+        self.outbuf.pop(conn, None)
+        self.names.pop(conn, None)
         if conn in self.c2u:
             del self.c2u[conn]
         if conn in self.c2a:
@@ -171,7 +257,53 @@ class TCP(object):
     def shutdown(self):
         try:
             self.running = False
-            self.srv.shutdown(socket.SHUT_RDWR)
-            self.sock.close()
+            self.sel.unregister(self.srv)
+            self.srv.close()
+            self.sel.close()
         except:
             pass
+
+
+class Inbox(object):
+    # a receive buffer that messages are framed out of in place.  bytes
+    # only ever land past the ones already there; when we run out of room
+    # the unread tail moves to a fresh buffer rather than getting shuffled
+    # down, so the memoryviews we've handed out never change under anybody
+    # and we never resize a buffer that has views on it.
+    def __init__(self, size):
+        self.buf = bytearray(size)
+        self.start = 0  # first byte not yet handed out
+        self.end = 0  # first byte not yet read into
+        self.need = 0  # how big the frame at start is, once we know
+
+    def reserve(self, size):
+        if len(self.buf) - self.end >= size:
+            return
+        pending = self.end - self.start
+        buf = bytearray(max(len(self.buf), pending + size))
+        buf[:pending] = self.buf[self.start:self.end]
+        self.buf = buf
+        self.start = 0
+        self.end = pending
+
+    def fill(self, conn, readsize):
+        # read whatever's available, with room for at least readsize
+        # bytes or the rest of a partially read frame
+        self.reserve(max(readsize, self.need - (self.end - self.start)))
+        view = memoryview(self.buf)[self.end:]
+        size = conn.recv_into(view)
+        self.end += size
+        return size
+
+    def frames(self):
+        view = memoryview(self.buf)
+        while self.end - self.start >= header.size:
+            size = header.unpack_from(self.buf, self.start)[0]
+            if size < header.size:
+                raise ValueError("bad frame size %d" % size)
+            if self.end - self.start < size:
+                self.need = size
+                return
+            yield view[self.start + header.size:self.start + size]
+            self.start += size
+        self.need = 0
@@ -29,4 +29,5 @@ setup(name='py-raft',
       classifiers = filter(None, classifiers.split('\n')),
       package_data={'': ['version.txt']},
       packages=['raft'],
-      install_requires=('msgpack-python'))
+      install_requires=['msgpack-python',
+                        'selectors34; python_version < "3.4"'])
@@ -127,26 +127,6 @@ def test_add():
     assert rl.get_by_uuid('abcd') == None
     assert rl.get_by_uuid('abcde') == None
 
-def test_add_ack():
-    rl = log.RaftLog(None)
-    le = log.logentry(6, 'xyz', {})
-    rl.add(le)
-    rl.add_ack(1, 6, 'f')
-    assert 'f' in rl.get_by_uuid('xyz')['acked']
-
-def test_num_acked():
-    rl = log.RaftLog(None)
-    le = log.logentry(6, 'xyz', {})
-    rl.add(le)
-    assert rl.num_acked(1) == 0
-    rl.add_ack(1, 6, 'f')
-    assert rl.num_acked(1) == 1
-    # double acks don't increase our count
-    rl.add_ack(1, 6, 'f')
-    assert rl.num_acked(1) == 1
-    rl.add_ack(1, 6, 'g')
-    assert rl.num_acked(1) == 2
-
 def test_commit():
     rl = log.RaftLog(None)
     le = log.logentry(6, 'xyz', {})
@@ -243,3 +223,187 @@ def test_exists():
     assert rl.exists(1, 2) == True
     assert rl.exists(1, 1) == False
     assert rl.exists(3, 4) == True
+
+def test_take_unsaved():
+    rl = log.RaftLog(None)
+    le1 = log.logentry(2, 'abcd', {})
+    le2 = log.logentry(2, 'abcde', {})
+    rl.add(le1)
+    assert [e['index'] for e in rl.take_unsaved()] == [0, 1]
+    assert rl.take_unsaved() == []
+    rl.add(le2)
+    assert rl.take_unsaved() == [le2]
+
+def test_compact():
+    rl = log.RaftLog(None)
+    le1 = log.logentry(2, 'abcd', {})
+    le2 = log.logentry(2, 'abcde', {})
+    le3 = log.logentry(4, 'abcdef', {})
+    rl.add(le1)
+    rl.add(le2)
+    rl.add(le3)
+    rl.commit(2, 2)
+    rl.compact(2)
+    assert rl.snapidx == 2
+    assert rl.get(0) == None
+    assert rl.get(1) == None
+    assert rl.get_by_uuid('abcd') == None
+    assert rl.get_by_uuid('abcde') == None
+    assert rl.get_term_of(2) == 2
+    assert rl.exists(1, 2) == True
+    assert rl.exists(2, 2) == True
+    assert rl.exists(3, 4) == True
+    assert rl.maxindex() == 3
+    assert rl.get_commit_index() == 2
+    # adding entries the snapshot already covers does nothing
+    le = log.logentry(9, 'xyz', {})
+    le['index'] = 2
+    rl.add(le)
+    assert rl.get_term_of(2) == 2
+    assert rl.maxindex() == 3
+
+def test_reset():
+    rl = log.RaftLog(None)
+    le1 = log.logentry(2, 'abcd', {})
+    le2 = log.logentry(2, 'abcde', {})
+    le3 = log.logentry(4, 'abcdef', {})
+    rl.add(le1)
+    rl.add(le2)
+    rl.add(le3)
+    rl.take_unsaved()
+    # our log agrees with the snapshot; keep the tail
+    rl.reset(2, 2)
+    assert rl.snapidx == 2
+    assert rl.get_by_uuid('abcdef') == le3
+    assert rl.take_unsaved() == []
+    # it doesn't; throw everything away
+    rl.reset(5, 6)
+    assert rl.snapidx == 5
+    assert rl.maxindex() == 5
+    assert rl.get_by_uuid('abcdef') == None
+    assert rl.get_max_index_term() == (5, 6)
+    assert [e['index'] for e in rl.take_unsaved()] == [5]
+
+def test_term_index():
+    rl = log.RaftLog(None)
+    for term in (1, 1, 3, 3, 3, 4):
+        rl.add(log.logentry(term, 'm%d' % rl.maxindex(), {}))
+    assert rl.term_start(4) == 3
+    assert rl.term_start(6) == 6
+    assert rl.last_index_of_term(1) == 2
+    assert rl.last_index_of_term(3) == 5
+    assert rl.last_index_of_term(4) == 6
+    assert rl.last_index_of_term(2) == None
+    # a follower overwriting a conflicting tail
+    rl.add(dict(index=4, term=5, msgid='x', msg={}))
+    assert rl.last_index_of_term(3) == 3
+    assert rl.last_index_of_term(4) == None
+    assert rl.term_start(4) == 4
+    # compaction keeps the term of the snapshot point
+    rl.compact(2)
+    assert rl.term_start(3) == 3
+    assert rl.last_index_of_term(1) == 2
+    assert rl.term_start(2) == 2
+    # and so does a rebuilt log
+    rl = log.RaftLog(rl.dump())
+    assert rl.last_index_of_term(3) == 3
+    assert rl.term_start(4) == 4
+
+def test_msgid_window():
+    rl = log.RaftLog(None, window=3)
+    for msgid in ('a', 'b', 'c', 'd'):
+        rl.add(log.logentry(1, msgid, {}))
+    # 'a' went in at 1 and the window only covers 2 through 4
+    assert rl.has_uuid('a') == False
+    assert rl.add(log.logentry(1, 'b', {})) == None
+    assert rl.get_by_uuid('c')['index'] == 3
+    assert len(rl.log_by_msgid) == 3
+    # a follower overwriting its tail forgets what was there
+    rl.add(dict(index=3, term=2, msgid='x', msg={}))
+    assert rl.has_uuid('c') == False
+    assert rl.has_uuid('d') == False
+    assert rl.get_by_uuid('x')['index'] == 3
+    assert rl.log_by_msgid.pairs() == [(2, 'b'), (3, 'x')]
+    # compacted entries are still remembered as duplicates
+    rl.commit(3, 2)
+    rl.compact(3)
+    assert rl.has_uuid('b') == True
+    assert rl.get_by_uuid('b') == None
+
+def test_counters_follow_removal():
+    rl = log.RaftLog(None)
+    for msgid in ('a', 'b', 'c', 'd'):
+        rl.add(log.logentry(2, msgid, {}))
+    rl.commit(2, 2)
+    rl.remove(4)
+    assert rl.maxindex() == 3
+    assert rl.get_commit_index() == 2
+    rl.remove(2)
+    assert rl.get_commit_index() == 0
+    # truncating a follower's log pulls the max index back
+    le = log.logentry(3, 'e', {})
+    le['index'] = 2
+    rl.add(le)
+    assert rl.maxindex() == 2
+    assert rl.get(3) == None
+
+def test_logentry():
+    le = log.logentry(2, 'abcd', {'data': 1})
+    assert 'index' not in le
+    assert le['term'] == 2
+    assert le.get('index', 7) == 7
+    le['index'] = 4
+    assert le.index == 4
+    with pytest.raises(KeyError):
+        le['bogus']
+    with pytest.raises(KeyError):
+        le['bogus'] = 1
+    assert le.to_dict() == dict(mle(4, 2, msgid='abcd', msg={'data': 1}),
+                                acked=[])
+    assert log.LogEntry.from_dict(le.to_dict()).to_dict() == le.to_dict()
+
+def test_dicts_are_converted():
+    rl = log.RaftLog({3: mle(3, 1, msgid='a'), 4: mle(4, 1, msgid='b')})
+    assert isinstance(rl.get(4), log.LogEntry)
+    rl.add(mle(5, 2, msgid='c'))
+    assert rl.get_by_uuid('c').term == 2
+
+def test_encoded():
+    import msgpack
+    le = log.logentry(2, 'abcd', {'data': 'x'})
+    le['index'] = 3
+    enc = le.encoded()
+    assert le.encoded() is enc
+    assert msgpack.unpackb(enc, encoding='utf-8') == \
+        dict(index=3, term=2, msgid='abcd', msg={'data': 'x'})
+    # a payload that came in pre-encoded goes out byte for byte
+    raw = msgpack.packb({'type': 'cq', 'id': 'abcd', 'data': 'x'})
+    le = log.logentry(2, 'abcd', None, raw)
+    assert le['msg'] == {'type': 'cq', 'id': 'abcd', 'data': 'x'}
+    assert le.raw is raw
+    le['index'] = 4
+    assert raw in le.encoded()
+
+def test_pack_entries():
+    import msgpack
+    rl = log.RaftLog(None)
+    rl.add(log.logentry(2, 'abcd', {'data': 1}))
+    rl.add(log.logentry(2, 'abcde', {'data': 2}))
+    logs = rl.logs_after_index(0)
+    rpc = log.packmap({'type': 'ae', 'term': 2},
+                      {'entries': log.pack_entries(logs)})
+    assert msgpack.unpackb(rpc, encoding='utf-8') == {
+        'type': 'ae', 'term': 2, 'entries': {
+            1: dict(index=1, term=2, msgid='abcd', msg={'data': 1}),
+            2: dict(index=2, term=2, msgid='abcde', msg={'data': 2})}}
+
+def test_logs_after_index_limits():
+    rl = log.RaftLog(None)
+    for i in range(10):
+        rl.add(log.logentry(2, 'msg%d' % i, {'data': 'x' * 10}))
+    assert sorted(rl.logs_after_index(0, maxcount=4)) == [1, 2, 3, 4]
+    size = len(rl.get(1).encoded())
+    assert sorted(rl.logs_after_index(2, maxbytes=3 * size)) == [3, 4, 5]
+    # a batch always has something in it, even if it's over the limit
+    assert sorted(rl.logs_after_index(2, maxbytes=1)) == [3]
+    assert rl.logs_after_index(10) == {}
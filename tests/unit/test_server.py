@@ -10,11 +10,15 @@ def server(monkeypatch):
     channel = MagicMock()
     monkeypatch.setattr(srv, 'store', store)
     monkeypatch.setattr(srv, 'channel', channel)
-    store.read_state.return_value = (27, None,
+    store.Store().read_state.return_value = (27, None,
                 {32: dict(index=32, term=25, committed=True, msgid='one', msg={}),
                  33: dict(index=33, term=26, committed=False, msgid='two', msg={})},
                 {'otherobj': ('1.2.3.4', 5678)},
                 'thisobj')
+    store.Store().read_snapshot.return_value = None
+    store.Store().sync_wait.return_value = None
+    store.Store().first_index_term.return_value = None
+    store.Store().sync_if_due.return_value = 1000
     queue = Mock()
     server = srv.Server(queue, 9999, None)
     return server, store, channel
@@ -51,6 +55,8 @@ def test_handle_message_1(server, monkeypatch):
     monkeypatch.setattr(server, 'handle_msg_candidate_ae', hmca)
     server.handle_message(rpc, None)
     msg['src'] = None  # it should also always pick this up
+    msg['raw'] = rpc
+
     hmca.assert_called_with(msg)
 
 def test_handle_message_2(server):
@@ -97,7 +103,7 @@ def test_handle_msg_leader_ae_reply_1(server, monkeypatch):
     server, _, _ = server
     server.next_index = {}
     server.next_index['otherobj'] = 12
-    msg = dict(id='otherobj', success=False, index=12)
+    msg = dict(id='otherobj', term=27, success=False, index=12)
     server.handle_msg_leader_ae_reply(msg)
     assert server.next_index['otherobj'] == 11
 
@@ -106,19 +112,39 @@ def test_handle_msg_leader_ae_reply_1(server, monkeypatch):
     server, _, _ = server
     server.next_index = {}
     server.next_index['otherobj'] = 12
-    msg = dict(id='otherobj', success=True, index=14)
+    server.fill_window = Mock()
+    msg = dict(id='otherobj', term=27, success=True, index=14)
     server.handle_msg_leader_ae_reply(msg)
     server.log = Mock()
     server.msg_recorded = mr = Mock()
     server.log.get_commit_index.return_value = 55
+    server.log.maxindex.return_value = 100
     server.handle_msg_leader_ae_reply(msg)
+    assert server.match_index['otherobj'] == 14
     assert server.next_index['otherobj'] == 14
     assert mr.called == False
-    msg = dict(id='otherobj', success=True, index=82)
+    msg = dict(id='otherobj', term=27, success=True, index=82)
     server.handle_msg_leader_ae_reply(msg)
+    assert server.match_index['otherobj'] == 82
     assert server.next_index['otherobj'] == 82
     assert mr.called == True
 
+def test_handle_msg_leader_ae_reply_bad(server):
+    # a success from an earlier term is ignored, and one past the end of
+    # our log only counts up to the end
+    server, _, _ = server
+    server.role = 'leader'
+    server.send_to_peer = Mock()
+    server.next_index = {'otherobj': 30}
+    msg = dict(id='otherobj', term=26, success=True, index=33)
+    server.handle_msg_leader_ae_reply(msg)
+    assert server.match_index == {} and server.next_index['otherobj'] == 30
+    msg = dict(id='otherobj', term=27, success=True, index=35)
+    server.handle_msg_leader_ae_reply(msg)
+    assert server.match_index['otherobj'] == 33
+    assert server.next_index['otherobj'] == 33
+    server.send_ae()
+
 def test_handle_msg_follower_ae0(server):
     # return if bad uuid
     server, _, _ = server
@@ -150,7 +176,8 @@ def test_handle_msg_follower_ae3(server):
     server, _, _ = server
     msg = dict(term=27, id='otherobj', entries=[],
                previdx=32, prevterm=27, commitidx=5)
-    rpc = server.ae_rpc_reply(32, 27, False)
+    # we have term 25 at 32, starting from 32
+    rpc = server.ae_rpc_reply(32, False, 25, 32)
     server.send_to_peer = stp = Mock()
     server.handle_msg_follower_ae(msg)
     stp.assert_called_with(rpc, 'otherobj')
@@ -256,7 +283,787 @@ def test_handle_msg_rev_reply_3(server):
     server.refused = set()
     server.handle_message(msg, None)
     assert server.role == 'leader'
+    # with an entry of its own to commit
+    assert server.log.get(34).msg['type'] == 'noop'
 
 def test_rv_rpc_reply(server):
     server, _, _ = server
     assert server.rv_rpc_reply(False) == mk_rv_rpc_reply('thisobj', 27, False)
+
+def test_send_snapshot(server):
+    # peers behind our snapshot get it in chunks instead of entries
+    server, _, _ = server
+    server.role = 'leader'
+    server.snapshot_chunk_size = 4
+    server.snapshot = (32, 25, b'0123456789')
+    server.next_index = {'otherobj': 12}
+    server.send_to_peer = stp = Mock()
+    server.send_ae()
+    rpc = msgpack.unpackb(stp.call_args[0][0])
+    assert rpc[b'type'] == b'is'
+    assert rpc[b'offset'] == 0
+    assert rpc[b'data'] == b'0123'
+    assert rpc[b'done'] == False
+    reply = dict(type='is_reply', id='otherobj', index=32, offset=4,
+                 done=False)
+    server.handle_msg_leader_is_reply(reply)
+    rpc = msgpack.unpackb(stp.call_args[0][0])
+    assert rpc[b'offset'] == 4
+    reply = dict(type='is_reply', id='otherobj', index=32, offset=10,
+                 done=True)
+    server.handle_msg_leader_is_reply(reply)
+    assert server.match_index['otherobj'] == 32
+    assert 'otherobj' not in server.snapshot_offset
+
+def test_snapshot_acked_twice(server):
+    # a single chunk snapshot goes out again with the next heartbeat, and
+    # the follower says it's done both times
+    server, _, _ = server
+    server.role = 'leader'
+    server.snapshot = (32, 25, b'0123')
+    server.next_index = {'otherobj': 12}
+    server.send_to_peer = Mock()
+    server.send_ae()
+    server.send_ae()
+    reply = dict(type='is_reply', id='otherobj', index=32, offset=4,
+                 done=True)
+    server.handle_msg_leader_is_reply(reply)
+    server.match_index['otherobj'] = 33
+    server.handle_msg_leader_is_reply(reply)
+    assert server.match_index['otherobj'] == 33
+    assert 'otherobj' not in server.snapshot_offset
+
+def test_install_snapshot(server):
+    server, store, _ = server
+    server.send_to_peer = stp = Mock()
+    base = dict(type='is', term=27, id='otherobj', index=40, lastterm=27)
+    server.handle_msg_follower_is(dict(base, offset=0, data=b'0123',
+                                       done=False))
+    stp.assert_called_with(server.is_rpc_reply(40, 4, False), 'otherobj')
+    # out of order chunks are refused
+    server.handle_msg_follower_is(dict(base, offset=8, data=b'89',
+                                       done=True))
+    stp.assert_called_with(server.is_rpc_reply(40, 4, False), 'otherobj')
+    server.handle_msg_follower_is(dict(base, offset=4, data=b'456789',
+                                       done=True))
+    stp.assert_called_with(server.is_rpc_reply(40, 10, True), 'otherobj')
+    store.Store().write_snapshot.assert_called_with(40, 27, b'0123456789')
+    server.applier.apply_pending()
+    server.statemachine.queue.put.assert_called_with((None, b'0123456789'))
+    assert server.log.snapidx == 40
+    assert server.log.maxindex() == 40
+    assert server.commitidx == 40
+
+def test_take_snapshot(server):
+    server, store, _ = server
+    server.take_snapshot(33, b'state')
+    server.compact_log()
+    # 33 isn't committed yet
+    assert server.log.snapidx == 32
+    server.log.commit(33, 26)
+    server.take_snapshot(33, b'state')
+    server.compact_log()
+    assert server.log.snapidx == 33
+    store.Store().write_snapshot.assert_called_with(33, 26, b'state')
+
+def test_handle_msg_leader_cq(server):
+    # client queries go into the log exactly as the client encoded them
+    server, _, _ = server
+    server.role = 'leader'
+    server.last_update = float('inf')
+    rpc = arbrpc(type='cq', id='abcd', data='x')
+    server.handle_message(rpc, 'client')
+    ent = server.log.get_by_uuid('abcd')
+    assert ent.raw is rpc
+    assert ent['msg'] == {'type': 'cq', 'id': 'abcd', 'data': 'x'}
+    # or as a copy, when it's a view into the channel's buffer
+    rpc = arbrpc(type='cq', id='efgh', data='y')
+    server.handle_message(memoryview(rpc), 'client')
+    ent = server.log.get_by_uuid('efgh')
+    assert type(ent.raw) is bytes and ent.raw == rpc
+
+def test_group_commit(server):
+    # commands that come in together share a write and an append entries
+    server, store, _ = server
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.next_index = {'otherobj': 33}
+    server.send_to_peer = stp = Mock()
+    writes = store.Store().write_state
+    writes.reset_mock()
+    for qid in ('a', 'b', 'c'):
+        server.handle_message(arbrpc(type='cq', id=qid, data='x'), 'client')
+    assert writes.called == False
+    assert stp.called == False
+    server.flush_commands()
+    assert writes.call_count == 1
+    assert [e.msgid for e in writes.call_args[0][2]] == ['a', 'b', 'c']
+    sent = [(msgpack.unpackb(c[0][0]), c[0][1]) for c in stp.call_args_list]
+    assert sent[0][1] == 'otherobj'
+    assert list(sent[0][0][b'entries']) == [34, 35, 36]
+    assert [(m[b'type'], m[b'id'], to) for m, to in sent[1:]] == \
+        [(b'cr_ack', b'a', 'client'), (b'cr_ack', b'b', 'client'),
+         (b'cr_ack', b'c', 'client')]
+    assert server.match_index['thisobj'] == 36
+    # a full batch doesn't wait for the end of the pass
+    server.cq_max_batch = 2
+    server.handle_message(arbrpc(type='cq', id='d', data='x'), 'client')
+    assert writes.call_count == 1
+    server.handle_message(arbrpc(type='cq', id='e', data='x'), 'client')
+    assert writes.call_count == 2
+
+def test_send_ae_backlogged(server):
+    # peers that aren't draining their send buffer just get heartbeats
+    server, _, channel = server
+    server.role = 'leader'
+    server.next_index = {'otherobj': 32}
+    server.send_to_peer = stp = Mock()
+    server.channel.writable.return_value = False
+    server.send_ae()
+    rpc = msgpack.unpackb(stp.call_args[0][0])
+    assert rpc[b'entries'] == {}
+    server.channel.writable.return_value = True
+    server.send_ae()
+    rpc = msgpack.unpackb(stp.call_args[0][0])
+    assert list(rpc[b'entries']) == [33]
+
+def test_ae_reply_sends_more(server):
+    # a follower that's still behind gets its next batch right away
+    server, _, _ = server
+    server.role = 'leader'
+    server.next_index = {'otherobj': 31}
+    server.send_to_peer = stp = Mock()
+    server.ae_max_entries = 1
+    msg = dict(id='otherobj', success=True, index=32, term=27)
+    server.handle_msg_leader_ae_reply(msg)
+    rpc = msgpack.unpackb(stp.call_args[0][0])
+    assert list(rpc[b'entries']) == [33]
+    stp.reset_mock()
+    msg['index'] = 33
+    server.handle_msg_leader_ae_reply(msg)
+    assert stp.called == False
+
+def test_pipeline_window(server):
+    # several batches go out without waiting on each other, up to the window
+    server, _, _ = server
+    server.role = 'leader'
+    for i in range(34, 40):
+        server.log.add(dict(index=i, term=27, msgid='m%d' % i, msg={}))
+    server.next_index = {'otherobj': 31}
+    server.send_to_peer = stp = Mock()
+    server.ae_max_entries = 1
+    server.ae_window = 3
+    msg = dict(id='otherobj', success=True, index=32, term=27)
+    server.handle_msg_leader_ae_reply(msg)
+    sent = [list(msgpack.unpackb(c[0][0])[b'entries']) for c in stp.call_args_list]
+    assert sent == [[33], [34], [35]]
+    assert server.inflight['otherobj'] == [(32, 33), (33, 34), (34, 35)]
+    # an ack opens up one more slot
+    stp.reset_mock()
+    server.handle_msg_leader_ae_reply(dict(msg, index=33))
+    rpc = msgpack.unpackb(stp.call_args[0][0])
+    assert list(rpc[b'entries']) == [36]
+    assert server.match_index['otherobj'] == 33
+
+def test_pipeline_rejection(server):
+    # a rejection rolls back to what they've acked and drops the window,
+    # and rejections of batches sent before that are ignored
+    server, _, _ = server
+    server.role = 'leader'
+    for i in range(34, 40):
+        server.log.add(dict(index=i, term=27, msgid='m%d' % i, msg={}))
+    server.next_index = {'otherobj': 35}
+    server.match_index = {'otherobj': 32}
+    server.inflight = {'otherobj': [(33, 34), (34, 35)]}
+    server.send_to_peer = stp = Mock()
+    server.ae_max_entries = 1
+    server.ae_window = 2
+    msg = dict(id='otherobj', success=False, index=33, term=27)
+    server.handle_msg_leader_ae_reply(msg)
+    sent = [list(msgpack.unpackb(c[0][0])[b'entries']) for c in stp.call_args_list]
+    assert sent == [[33], [34]]
+    assert server.inflight['otherobj'] == [(32, 33), (33, 34)]
+    stp.reset_mock()
+    server.handle_msg_leader_ae_reply(dict(msg, index=34))
+    assert stp.called == False
+
+def test_pipeline_timeout(server):
+    # a window nobody answers gets resent from what they've acked
+    server, _, _ = server
+    server.role = 'leader'
+    server.next_index = {'otherobj': 33}
+    server.match_index = {'otherobj': 32}
+    server.inflight = {'otherobj': [(32, 33)]}
+    server.last_ack = {'otherobj': 0}
+    server.send_to_peer = stp = Mock()
+    server.send_ae()
+    rpc = msgpack.unpackb(stp.call_args[0][0])
+    assert list(rpc[b'entries']) == [33]
+    assert server.inflight['otherobj'] == [(32, 33)]
+
+def test_follower_ae_acks_batch(server):
+    # a batch we already have doesn't truncate what came after it, and
+    # the ack covers just the batch
+    server, _, _ = server
+    server.send_to_peer = stp = Mock()
+    server.leader = 'otherobj'
+    ent = server.log.get(33)
+    server.log.add(dict(index=34, term=26, msgid='three', msg={}))
+    rpc = dict(type='ae', term=27, id='otherobj', previdx=32, prevterm=25,
+               entries={33: ent.to_dict()}, commitidx=32)
+    server.handle_msg_follower_ae(rpc)
+    assert server.log.maxindex() == 34
+    reply = msgpack.unpackb(stp.call_args[0][0])
+    assert reply[b'success'] == True
+    assert reply[b'index'] == 33
+
+def test_ae_reply_conflict_hints(server):
+    # a rejection with hints skips straight past the conflicting term
+    server, _, _ = server
+    server.role = 'leader'
+    for i in range(34, 40):
+        server.log.add(dict(index=i, term=27, msgid='m%d' % i, msg={}))
+    server.send_to_peer = Mock()
+    server.ae_max_entries = 1
+    # they have term 26 from 30 on; ours ends at 33
+    server.next_index = {'otherobj': 39}
+    msg = dict(id='otherobj', success=False, index=39, term=27,
+               conflict_term=26, conflict_index=30)
+    server.handle_msg_leader_ae_reply(msg)
+    assert server.inflight['otherobj'][0] == (33, 34)
+    # they have a term we never saw, from 35 on
+    server.inflight = {}
+    server.next_index = {'otherobj': 39}
+    msg.update(conflict_term=20, conflict_index=35)
+    server.handle_msg_leader_ae_reply(msg)
+    assert server.inflight['otherobj'][0] == (34, 35)
+    # their log is short
+    server.inflight = {}
+    server.next_index = {'otherobj': 39}
+    msg.update(conflict_term=None, conflict_index=36)
+    server.handle_msg_leader_ae_reply(msg)
+    assert server.inflight['otherobj'][0] == (35, 36)
+
+def test_acks_wait_for_durability(server):
+    # neither clients nor the leader hear about entries that aren't on disk
+    server, store, _ = server
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.next_index = {'otherobj': 33}
+    server.send_to_peer = stp = Mock()
+    store.Store().sync_if_due.return_value = 33
+    server.handle_message(arbrpc(type='cq', id='a', data='x'), 'client')
+    server.flush_commands()
+    assert [c[0][1] for c in stp.call_args_list] == ['otherobj']
+    assert 'thisobj' not in server.match_index
+    store.Store().sync_if_due.return_value = 34
+    server.release_durable()
+    assert stp.call_args[0][1] == 'client'
+    assert server.match_index['thisobj'] == 34
+    # a follower holds its ack the same way
+    server.role = 'follower'
+    server.leader = 'otherobj'
+    stp.reset_mock()
+    rpc = dict(type='ae', term=27, id='otherobj', previdx=34, prevterm=27,
+               entries={35: dict(index=35, term=27, msgid='b', msg={})},
+               commitidx=33)
+    server.handle_msg_follower_ae(rpc)
+    assert stp.called == False
+    store.Store().sync_if_due.return_value = 35
+    server.release_durable()
+    stp.assert_called_with(server.ae_rpc_reply(35, True), 'otherobj')
+    # but not to a leader that didn't send what it covers
+    stp.reset_mock()
+    server.peers['third'] = ('1.2.3.5', 5678)
+    rpc = dict(rpc, previdx=35, entries={
+        36: dict(index=36, term=27, msgid='c', msg={})})
+    server.handle_msg_follower_ae(rpc)
+    server.handle_message(arbrpc(type='ae', term=28, id='third', previdx=34,
+                                 prevterm=27, entries={}, commitidx=33),
+                          None)
+    store.Store().sync_if_due.return_value = 36
+    server.release_durable()
+    assert [c for c in stp.call_args_list
+            if msgpack.unpackb(c[0][0])[b'type'] == b'ae_reply'] == []
+
+def test_apply_committed(server):
+    # committed commands reach the state machine in runs, and each
+    # result goes back to the client that sent the command
+    from raft import statemachine
+    server, _, _ = server
+
+    class Upper(statemachine.StateMachine):
+        def __init__(self):
+            self.batches = []
+
+        def apply_batch(self, entries):
+            self.batches.append(entries)
+            return [data.upper() for _, data in entries]
+
+    server.applier.sm = sm = Upper()
+    server.applying = server.applier.applied = 33
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.next_index = {'otherobj': 33}
+    server.send_to_peer = stp = Mock()
+    for qid in ('a', 'b', 'c'):
+        server.handle_message(arbrpc(type='cq', id=qid, data=qid), 'client')
+    server.flush_commands()
+    stp.reset_mock()
+    server.handle_msg_leader_ae_reply(dict(type='ae_reply', term=27,
+                                           id='otherobj', index=36,
+                                           success=True))
+    # nothing's applied on the server's thread
+    assert sm.batches == []
+    assert server.apply_stats()['lag'] == 36 - 33
+    server.apply_committed()
+    # results on their way back mean a short poll
+    assert server.poll_timeout() == server.apply_poll
+    server.applier.apply_pending()
+    server.apply_committed()
+    assert server.poll_timeout() > server.apply_poll
+    assert sm.batches == [[('a', 'a'), ('b', 'b'), ('c', 'c')]]
+    sent = [(msgpack.unpackb(c[0][0]), c[0][1]) for c in stp.call_args_list
+            if msgpack.unpackb(c[0][0])[b'type'] == b'cr']
+    assert [(m[b'id'], m[b'data'], to) for m, to in sent] == \
+        [(b'a', b'A', 'client'), (b'b', b'B', 'client'),
+         (b'c', b'C', 'client')]
+    assert server.apply_stats()['applied'] == 36
+    assert server.clients == {}
+    # a follower only applies what it knows matches the leader's log
+    server.role = 'follower'
+    server.apply_max_batch = 1
+    rpc = dict(type='ae', term=27, id='otherobj', previdx=36, prevterm=27,
+               entries={37: dict(index=37, term=27, msgid='d',
+                                 msg={'id': 'd', 'data': 'd'}),
+                        38: dict(index=38, term=27, msgid='e',
+                                 msg={'id': 'e', 'data': 'e'})},
+               commitidx=40)
+    server.handle_msg_follower_ae(rpc)
+    assert server.applying == 38
+    server.applier.apply_pending()
+    assert sm.batches[1:] == [[('d', 'd')], [('e', 'e')]]
+    # no more than apply_max_lag entries wait on the applier
+    server.apply_max_lag = 1
+    rpc = dict(rpc, previdx=38, entries={
+        39: dict(index=39, term=27, msgid='f', msg={'id': 'f', 'data': 'f'}),
+        40: dict(index=40, term=27, msgid='g', msg={'id': 'g', 'data': 'g'})})
+    server.handle_msg_follower_ae(rpc)
+    assert server.applying == 39
+    server.applier.apply_pending()
+    server.apply_committed()
+    assert server.applying == 40
+    server.applier.apply_pending()
+    assert server.apply_stats()['applied'] == 40
+    assert server.apply_stats()['entries'] == 7
+
+def test_read_index(server):
+    # reads skip the log: they're answered once a quorum confirms we're
+    # still the leader and everything committed before them is applied
+    from raft import statemachine
+    server, _, _ = server
+
+    class Store(statemachine.StateMachine):
+        def __init__(self):
+            self.state = {}
+
+        def apply_batch(self, entries):
+            for _, data in entries:
+                self.state[data] = True
+            return [None] * len(entries)
+
+        def read(self, query):
+            return query in self.state
+
+    server.applier.sm = sm = Store()
+    server.applying = server.applier.applied = 33
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.next_index = {'otherobj': 33}
+    server.send_to_peer = stp = Mock()
+    server.handle_message(arbrpc(type='cq', id='a', data='k'), 'client')
+    server.handle_message(arbrpc(type='rq', id='r1', data='k'), 'client')
+    server.flush_commands()
+    server.flush_reads()
+    # nothing from our term is committed yet
+    assert server.read_round == 0
+    server.handle_msg_leader_ae_reply(dict(type='ae_reply', term=27,
+                                           id='otherobj', index=34,
+                                           success=True))
+    stp.reset_mock()
+    server.flush_reads()
+    assert server.read_round == 1
+    ae = msgpack.unpackb(stp.call_args[0][0])
+    assert (ae[b'type'], ae[b'round']) == (b'ae', 1)
+    # reads that come in meanwhile wait for a round of their own
+    server.handle_message(arbrpc(type='rq', id='r2', data='j'), 'client')
+    server.flush_reads()
+    assert server.read_round == 2
+    server.applier.apply_pending()
+    server.apply_committed()
+    assert server.applier.reads == 0
+    # confirming the later round confirms both
+    server.handle_message(arbrpc(type='round_reply', term=27, id='otherobj',
+                                 round=2), 'otherobj')
+    server.applier.apply_pending()
+    stp.reset_mock()
+    server.apply_committed()
+    sent = [msgpack.unpackb(c[0][0]) for c in stp.call_args_list]
+    assert [(m[b'type'], m[b'id'], m[b'data']) for m in sent] == \
+        [(b'cr', b'r1', True), (b'cr', b'r2', False)]
+    # a follower answers each round once
+    server.role = 'follower'
+    stp.reset_mock()
+    hb = dict(type='ae', term=27, id='otherobj', previdx=34, prevterm=27,
+              entries={}, commitidx=34, round=5)
+    server.handle_msg_follower_ae(hb)
+    server.handle_msg_follower_ae(hb)
+    stp.assert_called_once_with(server.round_reply_rpc(5), 'otherobj')
+
+def test_lease_reads(server):
+    # with a lease, reads don't wait on a round of heartbeats, for as long
+    # as no one else can have been elected
+    server, _, _ = server
+    now = [100.0]
+    server.clock = lambda: now[0]
+    server.read_lease = True
+    server.applier.sm = Mock()
+    server.applier.sm.apply_batch = lambda entries: [None] * len(entries)
+    server.applier.sm.read.return_value = True
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.next_index = {'otherobj': 33}
+    server.send_to_peer = stp = Mock()
+    server.handle_message(arbrpc(type='cq', id='a', data='k'), 'client')
+    server.flush_commands()
+    server.handle_msg_leader_ae_reply(dict(type='ae_reply', term=27,
+                                           id='otherobj', index=34,
+                                           success=True))
+    # no lease yet: the first read takes a round, and the answer to it
+    # starts the lease from when the round went out
+    server.handle_message(arbrpc(type='rq', id='r1', data='k'), 'client')
+    server.flush_reads()
+    assert len(server.reads_waiting) == 1
+    now[0] = 100.2
+    server.handle_message(arbrpc(type='round_reply', term=27, id='otherobj',
+                                 round=server.read_round), 'otherobj')
+    assert server.lease_start == 100.0
+    assert server.reads_waiting == []
+    server.handle_message(arbrpc(type='rq', id='r2', data='k'), 'client')
+    server.flush_reads()
+    assert server.reads_waiting == []
+    server.applier.apply_pending()
+    assert server.applier.reads == 2
+    # it runs out short of when a follower could time out
+    now[0] = 100.0 + server.follower_timeout * (1 - server.lease_drift)
+    server.handle_message(arbrpc(type='rq', id='r3', data='k'), 'client')
+    server.flush_reads()
+    assert len(server.reads_waiting) == 1
+    # and candidates get nowhere while it might still be held
+    server.role = 'follower'
+    server.leader = 'otherobj'
+    server.last_update = now[0]
+    server.handle_message(mk_rv_rpc(28, 'otherobj', 40, 28), 'otherobj')
+    assert server.term == 27
+    now[0] += server.follower_timeout
+    server.handle_message(mk_rv_rpc(28, 'otherobj', 40, 28), 'otherobj')
+    assert server.term == 28
+
+def test_follower_reads(server):
+    # followers answer reads: straight away within the client's bound on
+    # staleness, otherwise at a read index they get from the leader
+    server, _, _ = server
+    server.applier.sm = sm = Mock()
+    sm.apply_batch = lambda entries: [None] * len(entries)
+    sm.read.return_value = 'v'
+    server.send_to_peer = stp = Mock()
+    server.leader = 'otherobj'
+    server.applying = server.applier.applied = 33
+    server.commitidx = 35
+    server.handle_message(arbrpc(type='rq', id='r1', data='k', max_lag=2),
+                          'client')
+    server.handle_message(arbrpc(type='rq', id='r2', data='k', max_lag=1),
+                          'client')
+    server.handle_message(arbrpc(type='rq', id='r3', data='k'), 'client')
+    server.flush_reads()
+    server.apply_committed()
+    server.applier.apply_pending()
+    server.apply_committed()
+    sent = [(msgpack.unpackb(c[0][0]), c[0][1]) for c in stp.call_args_list]
+    assert [(m[b'type'], m.get(b'id'), to) for m, to in sent] == \
+        [(b'ri', b'thisobj', 'otherobj'), (b'cr', b'r1', 'client')]
+    req = sent[0][0][b'round']
+    # the leader gives out read indexes once it's confirmed it still is one
+    stp.reset_mock()
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.log.commit(33, 26)
+    server.commitidx = 33
+    server.term = 26
+    server.handle_message(arbrpc(type='ri', term=26, id='otherobj',
+                                 round=7), 'otherobj')
+    server.flush_reads()
+    assert stp.call_args[0][1] == 'otherobj'
+    stp.reset_mock()
+    server.handle_message(arbrpc(type='round_reply', term=26, id='otherobj',
+                                 round=server.read_round), 'otherobj')
+    stp.assert_called_with(server.ri_rpc_reply(7, 33), 'otherobj')
+    # back on the follower, the reads wait until it's applied that far
+    server.role = 'follower'
+    server.commitidx = 35
+    stp.reset_mock()
+    server.handle_message(arbrpc(type='ri_reply', term=26, id='otherobj',
+                                 round=req, index=34), 'otherobj')
+    server.applier.apply_pending()
+    server.apply_committed()
+    assert stp.called == False
+    server.apply_committed(34)
+    server.applier.apply_pending()
+    server.apply_committed()
+    sent = [msgpack.unpackb(c[0][0]) for c in stp.call_args_list]
+    assert [(m[b'type'], m[b'id']) for m in sent] == \
+        [(b'cr', b'r2'), (b'cr', b'r3')]
+
+def test_election_timings(server):
+    # a follower waits follower_timeout and up to follower_jitter more,
+    # and a candidate gives an election between election_timeout_min and
+    # _max, each drawn from the server's rng
+    server, _, _ = server
+    server.rng = Mock()
+    server.rng.random.return_value = 0.5
+    server.rng.uniform.side_effect = lambda a, b: (a + b) / 2.0
+    server.follower_jitter = 0.2
+    server.election_timeout_min = 0.2
+    server.election_timeout_max = 0.4
+    server.jitter = 0.5
+    server.send_to_peer = Mock()
+    now = [100.0]
+    server.clock = lambda: now[0]
+    server.last_update = now[0]
+    now[0] += 0.59
+    server.housekeeping()
+    assert server.role == 'follower'
+    now[0] += 0.02
+    server.housekeeping()
+    assert server.role == 'candidate'
+    assert server.term == 28
+    assert server.elections == 1
+    assert server.election_timeout == pytest.approx(0.3)
+    now[0] += 0.29
+    server.housekeeping()
+    assert server.term == 28
+    now[0] += 0.02
+    server.housekeeping()
+    assert server.term == 29
+    assert server.elections == 2
+
+def test_pre_vote(server):
+    # a follower that stops hearing from the leader asks before it stands,
+    # and nobody bumps their term over a pre-vote
+    server, _, _ = server
+    server.pre_vote = True
+    server.send_to_peer = stp = Mock()
+    now = [100.0]
+    server.clock = lambda: now[0]
+    server.last_update = now[0]
+    now[0] += server.follower_timeout + 0.01
+    server.housekeeping()
+    assert server.role == 'follower' and server.term == 27
+    sent = msgpack.unpackb(stp.call_args[0][0])
+    assert stp.call_args[0][1] == 'otherobj'
+    assert (sent[b'type'], sent[b'term']) == (b'pv', 28)
+    # a refusal, or a grant for some other round, changes nothing
+    server.handle_message(arbrpc(type='pv_reply', id='otherobj', term=27,
+                                 prevote=28, granted=False), None)
+    server.handle_message(arbrpc(type='pv_reply', id='otherobj', term=27,
+                                 prevote=29, granted=True), None)
+    assert server.role == 'follower' and server.term == 27
+    server.handle_message(arbrpc(type='pv_reply', id='otherobj', term=27,
+                                 prevote=28, granted=True), None)
+    assert server.role == 'candidate' and server.term == 28
+
+def test_handle_msg_pv(server):
+    server, _, _ = server
+    server.send_to_peer = stp = Mock()
+    now = [100.0]
+    server.clock = lambda: now[0]
+    server.leader = 'otherobj'
+    server.last_update = now[0]
+    # we've heard from the leader lately, so no
+    msg = arbrpc(type='pv', id='otherobj', term=28, log_index=33, log_term=26)
+    server.handle_message(msg, None)
+    assert server.term == 27 and server.voted is None
+    assert stp.call_args[0] == (server.pv_rpc_reply(28, False), 'otherobj')
+    # we haven't, so yes, but still without a new term or a vote
+    now[0] += server.follower_timeout + 0.01
+    server.handle_message(msg, None)
+    assert server.term == 27 and server.voted is None
+    assert stp.call_args[0] == (server.pv_rpc_reply(28, True), 'otherobj')
+    # not with a log behind ours
+    msg = arbrpc(type='pv', id='otherobj', term=28, log_index=32, log_term=25)
+    server.handle_message(msg, None)
+    assert stp.call_args[0] == (server.pv_rpc_reply(28, False), 'otherobj')
+
+def test_check_quorum(server):
+    # a leader steps down once a quorum hasn't answered for
+    # follower_timeout
+    server, _, _ = server
+    server.check_quorum = True
+    server.send_to_peer = Mock()
+    now = [100.0]
+    server.clock = lambda: now[0]
+    server.role = 'leader'
+    server.elected = now[0]
+    server.housekeeping()
+    assert server.role == 'leader'
+    now[0] += server.follower_timeout + 0.01
+    server.housekeeping()
+    assert server.role == 'follower' and server.leader is None
+
+def test_cq_retry_to_new_leader(server):
+    # a command the last leader took, retried with us, gets its result
+    # once we apply it, if we haven't already
+    server, _, _ = server
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.applying = 32
+    for msgid in ('one', 'two'):
+        server.handle_message(arbrpc(type='cq', id=msgid, data='x'), 'client')
+    assert server.clients == {'two': 'client'}
+    assert server.log.maxindex() == 33
+
+def test_unanswerable_reads(server):
+    # with the queue for a state machine there's nothing to read from, so
+    # reads are turned away, and never get as far as the applier
+    server, _, _ = server
+    server.send_to_peer = stp = Mock()
+    for role in ('leader', 'follower'):
+        server.role = role
+        server.leader = 'otherobj'
+        server.last_update = float('inf')
+        server.handle_message(arbrpc(type='rq', id='r', data='x'), 'client')
+        sent = msgpack.unpackb(stp.call_args[0][0])
+        assert sent[b'type'] == b'cr_ack'
+        assert sent[b'info'] == {b'status': b'unsupported'}
+    assert server.clients == {}
+    assert server.pending_reads == [] and server.reads_ready == []
+
+def test_applier_survives_errors():
+    # a state machine that fails doesn't stop what comes after it
+    from raft import statemachine
+
+    class Flaky(statemachine.StateMachine):
+        def apply_batch(self, entries):
+            if entries[0][1] == 'bad':
+                raise ValueError
+            return [data for _, data in entries]
+
+    applier = statemachine.Applier(Flaky())
+    applier.submit(1, [arbrpc(id='a', data='bad')])
+    applier.read([('q', 'x')])
+    applier.submit(2, [arbrpc(id='b', data='good')])
+    applier.apply_pending()
+    assert not applier.working()
+    assert applier.applied == 2
+    assert list(applier.finished) == [[('b', 'good')]]
+
+def test_commit_by_match_index(server):
+    # followers ack the ends of batches cut differently for each of them;
+    # whatever a quorum has, counting everything before what they acked,
+    # is committed
+    server, _, _ = server
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.peers = dict((uuid, ('1.2.3.4', 5678))
+                        for uuid in ('otherobj', 'a', 'b', 'c'))
+    server.send_to_peer = Mock()
+    for qid in 'defghij':
+        server.add_to_log({'type': 'cq', 'id': qid, 'data': qid})
+    server.match_index = {'thisobj': 40}
+    before = server.commitidx
+    server.handle_msg_leader_ae_reply(dict(id='a', term=27, index=36,
+                                           success=True))
+    assert server.commitidx == before
+    server.handle_msg_leader_ae_reply(dict(id='b', term=27, index=38,
+                                           success=True))
+    assert server.commitidx == 36
+    server.handle_msg_leader_ae_reply(dict(id='otherobj', term=27, index=39,
+                                           success=True))
+    assert server.commitidx == 38
+    # an entry from an earlier term only commits along with one of ours
+    server.match_index = {'thisobj': 33, 'a': 33}
+    server.commitidx = server.log.commitidx = 32
+    server.handle_msg_leader_ae_reply(dict(id='b', term=27, index=33,
+                                           success=True))
+    assert server.commitidx == 32
+
+def test_update_waits_for_disk(server):
+    # a config change is written and counted as ours the same way as a
+    # client's command: once it's durable
+    server, store, _ = server
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.send_to_peer = Mock()
+    store.Store().sync_if_due.return_value = 33
+    server.handle_message(arbrpc(type='pu', id='up',
+                                 config={'newobj': ('1.2.3.6', 5678)}),
+                          'client')
+    assert server.log.get_by_uuid('up')['index'] == 34
+    server.flush_commands()
+    assert 'thisobj' not in server.match_index
+    store.Store().sync_if_due.return_value = 34
+    server.release_durable()
+    assert server.match_index['thisobj'] == 34
+
+def test_round_times_bounded(server):
+    # a leader with a lease that nobody answers only remembers the rounds
+    # that could still give it one
+    server, _, _ = server
+    server.role = 'leader'
+    server.read_lease = True
+    server.send_to_peer = Mock()
+    now = [100.0]
+    server.clock = lambda: now[0]
+    for _ in range(1000):
+        server.send_ae()
+        now[0] += server.heartbeat_interval
+    assert len(server.round_times) <= \
+        server.follower_timeout / server.heartbeat_interval + 1
+
+def test_reads_redirected_on_step_down(server):
+    # reads waiting on a round when we lose the leadership are sent on to
+    # the new leader
+    from raft import statemachine
+    server, _, _ = server
+
+    class Store(statemachine.StateMachine):
+        def apply_batch(self, entries):
+            return [None] * len(entries)
+
+        def read(self, query):
+            return None
+
+    server.applier.sm = Store()
+    server.applying = server.applier.applied = 33
+    server.role = 'leader'
+    server.last_update = float('inf')
+    server.next_index = {'otherobj': 33}
+    server.send_to_peer = stp = Mock()
+    server.handle_message(arbrpc(type='cq', id='a', data='k'), 'client')
+    server.flush_commands()
+    server.handle_msg_leader_ae_reply(dict(type='ae_reply', term=27,
+                                           id='otherobj', index=34,
+                                           success=True))
+    server.handle_message(arbrpc(type='rq', id='r', data='k'), 'client')
+    server.flush_reads()
+    assert len(server.reads_waiting) == 1
+    server.handle_message(arbrpc(type='ae', term=28, id='otherobj',
+                                 previdx=34, prevterm=27, entries={},
+                                 commitidx=34), 'otherobj')
+    stp.reset_mock()
+    server.flush_reads()
+    sent = [(msgpack.unpackb(c[0][0]), c[0][1]) for c in stp.call_args_list]
+    assert [(m[b'type'], m[b'id'], m[b'leader'], to) for m, to in sent
+            if m[b'type'] == b'cr_rdr'] == \
+        [(b'cr_rdr', b'r', b'otherobj', 'client')]
+    assert server.reads_waiting == [] and 'r' not in server.clients
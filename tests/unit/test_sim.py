@@ -0,0 +1,210 @@
+import msgpack
+
+from raft import sim
+
+
+def elect(cluster):
+    assert cluster.run_until(lambda: cluster.leader() is not None, 10)
+    return cluster.leader()
+
+
+def commit(cluster, client, count, prefix='k'):
+    ids = [client.send([prefix + str(i), i]) for i in range(count)]
+    assert cluster.run_until(lambda: all(i in client.done for i in ids), 10)
+    return ids
+
+
+def logs(cluster, upto):
+    return dict((uuid, [(srv.log.get(i).term, srv.log.get(i).msgid)
+                        for i in range(1, upto + 1)])
+                for uuid, srv in cluster.servers.items())
+
+
+def test_cluster_commits():
+    cluster = sim.Cluster(3, seed=1)
+    elect(cluster)
+    client = cluster.client()
+    commit(cluster, client, 20)
+    cluster.run(1)
+    states = [srv.applier.sm.data for srv in cluster.servers.values()]
+    assert states[0] == dict(('k%d' % i, i) for i in range(20))
+    assert states[0] == states[1] == states[2]
+
+
+def test_deterministic():
+    def run(seed):
+        cluster = sim.Cluster(5, seed=seed, max_latency=0.01)
+        client = cluster.client()
+        for i in range(10):
+            client.send(['k', i])
+        cluster.run(3)
+        return cluster.network.sent, sorted(client.done.items())
+    assert run(7) == run(7)
+    assert run(7) != run(8)
+
+
+def test_leader_partition():
+    cluster = sim.Cluster(5, seed=2)
+    old = elect(cluster)
+    client = cluster.client()
+    commit(cluster, client, 5, 'a')
+    rest = [uuid for uuid in cluster.uuids if uuid != old.uuid]
+    cluster.network.partition([old.uuid], rest + [client.uuid])
+    commit(cluster, client, 5, 'b')
+    new = cluster.leader()
+    assert new.uuid != old.uuid and new.term > old.term
+    cluster.network.heal()
+    cluster.run(2)
+    assert old.role == 'follower'
+    upto = cluster.leader().commitidx
+    assert len(set(map(tuple, logs(cluster, upto).values()))) == 1
+
+
+def test_busy_followers_elect():
+    # a client that keeps the followers busy doesn't stop them noticing
+    # the leader's gone
+    cluster = sim.Cluster(3, seed=0)
+    old = elect(cluster)
+    cluster.stop(old.uuid)
+    followers = [uuid for uuid in cluster.uuids if uuid != old.uuid]
+    rpc = msgpack.packb({'type': 'cq', 'id': None, 'data': ['k', 0]})
+    end = cluster.clock() + 3
+    sent = 0
+    while cluster.leader() is None and cluster.clock() < end:
+        if cluster.clock() > sent:
+            sent = cluster.clock()
+            for uuid in followers:
+                cluster.network.send('client', uuid, rpc)
+        cluster.step()
+    assert cluster.leader() is not None
+
+
+def test_pre_vote_rejoin():
+    # a follower cut off for a while comes back without having moved to
+    # a new term, and the leader carries on
+    cluster = sim.Cluster(5, seed=5, options={'pre_vote': True})
+    leader = elect(cluster)
+    term = leader.term
+    cut = [uuid for uuid in cluster.uuids if uuid != leader.uuid][0]
+    cluster.network.partition([cut], [uuid for uuid in cluster.uuids
+                                      if uuid != cut])
+    cluster.run(3)
+    assert cluster.servers[cut].term == term
+    cluster.network.heal()
+    cluster.run(2)
+    assert cluster.leader() is leader and leader.term == term
+    assert cluster.servers[cut].leader == leader.uuid
+
+
+def test_check_quorum():
+    # a leader that's been cut off stands down, and the rest still elect
+    # another with pre-votes
+    cluster = sim.Cluster(5, seed=2, options={'pre_vote': True,
+                                              'check_quorum': True})
+    old = elect(cluster)
+    client = cluster.client()
+    commit(cluster, client, 5, 'a')
+    rest = [uuid for uuid in cluster.uuids if uuid != old.uuid]
+    cluster.network.partition([old.uuid], rest + [client.uuid])
+    assert cluster.run_until(lambda: old.role == 'follower', 1)
+    commit(cluster, client, 5, 'b')
+    assert cluster.leader().term > old.term
+    cluster.network.heal()
+    cluster.run(2)
+    assert cluster.leader().uuid != old.uuid
+
+
+def test_catch_up():
+    # a follower that's been down catches up a batch per append entries,
+    # each sent as soon as an ack makes room in the window rather than
+    # on the next heartbeat
+    cluster = sim.Cluster(3, seed=6, options={'ae_max_entries': 50})
+    leader = elect(cluster)
+    client = cluster.client()
+    commit(cluster, client, 5)
+    down = [uuid for uuid in cluster.uuids if uuid != leader.uuid][0]
+    cluster.stop(down)
+    commit(cluster, client, 2000)
+    batches = []
+    send = cluster.network.send
+    def counting(src, dst, msg):
+        if (src, dst) == (leader.uuid, down):
+            rpc = msgpack.unpackb(msg, use_list=False, encoding='utf-8')
+            if rpc['type'] == 'ae' and rpc['entries']:
+                batches.append(cluster.clock())
+        send(src, dst, msg)
+    cluster.network.send = counting
+    srv = cluster.start(down)
+    assert cluster.run_until(
+        lambda: srv.log.maxindex() == leader.log.maxindex(), 10)
+    assert len(batches) == 2000 // 50
+    assert cluster.clock() - batches[0] < leader.heartbeat_interval
+
+
+def test_options():
+    # options are in place before a server loads its store, and ones a
+    # simulated server can't take are refused
+    cluster = sim.Cluster(3, seed=3, options={'dedupe_window': 7,
+                                              'pre_vote': True})
+    for srv in cluster.servers.values():
+        assert srv.log.log_by_msgid.size == 7
+        assert srv.pre_vote
+    for options in ({'durability': 'none'}, {'no_such_setting': 1}):
+        try:
+            sim.Cluster(3, options=options)
+        except ValueError:
+            pass
+        else:
+            assert False, options
+
+
+def test_restart():
+    cluster = sim.Cluster(3, seed=3)
+    leader = elect(cluster)
+    client = cluster.client()
+    commit(cluster, client, 5, 'a')
+    down = [uuid for uuid in cluster.uuids if uuid != leader.uuid][0]
+    cluster.stop(down)
+    commit(cluster, client, 5, 'b')
+    srv = cluster.start(down)
+    assert cluster.run_until(
+        lambda: srv.applier.applied == leader.applier.applied, 5)
+    assert srv.applier.sm.data == leader.applier.sm.data
+
+
+def check_no_stale_reads(options):
+    # the leader is cut off with a client that keeps reading; once a write
+    # made on the other side has finished, no read started after it may
+    # come back with the old value
+    cluster = sim.Cluster(3, seed=4, options=options)
+    old = elect(cluster)
+    writer = cluster.client()
+    commit(cluster, writer, 1)
+    reader = cluster.client()
+    reader.target = old.uuid
+    rest = [uuid for uuid in cluster.uuids if uuid != old.uuid]
+    cluster.network.partition([old.uuid, reader.uuid], rest + [writer.uuid])
+    write = writer.send(['k0', 'new'])
+    start = cluster.clock()
+    reads = []
+    while cluster.clock() < start + 6:
+        if cluster.clock() > start + 3:
+            cluster.network.heal()
+        reads.append(reader.read('k0'))
+        cluster.run(0.05)
+    written = writer.done[write][1]
+    answered = [reader.done[r] for r in reads if r in reader.done]
+    assert [r for r in answered if r[1] > start + 3]
+    assert [r for r in answered if r[0] > written and r[2] != 'new'] == []
+    return [r for r in answered if r[1] < written]
+
+
+def test_no_stale_reads():
+    # the old leader can't get a read confirmed
+    assert check_no_stale_reads({}) == []
+
+
+def test_no_stale_lease_reads():
+    # it answers on its lease for a while, but not for long enough to
+    # overlap with the new leader
+    assert check_no_stale_reads({'read_lease': True})
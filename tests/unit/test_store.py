@@ -1,21 +1,300 @@
+import os
 import pytest
-from mock import Mock, MagicMock
-
-def test_write(monkeypatch):
-    import os
-    import msgpack
-    import raft.store as store
-
-    mock_open = MagicMock()
-    monkeypatch.setattr(store, 'open', mock_open, raising=False)
-    fobj = MagicMock()
-    mock_open().__enter__.return_value = fobj
-
-    vals = (25,
-            'mr excalibur',
-            [(1, 1, 'a msg'), (2, 1, 'another msg')],
-            {'mr excalibur': ('192.168.0.15', 2995)},
-            'conan')
-    packed = msgpack.packb(vals)
-    store.write_state(0, *vals)
-    fobj.write.assert_called_with(packed)
+
+from raft import log
+import raft.store as store
+
+def mle(index, term, msgid='', msg={}):
+    return log.LogEntry(term, msgid, msg, index)
+
+
+def test_fresh(tmpdir):
+    st = store.Store(0, str(tmpdir))
+    term, voted, llog, peers, uuid = st.read_state()
+    assert (term, voted, llog, peers) == (0, None, None, {})
+    assert len(uuid) == 32
+
+def test_roundtrip(tmpdir):
+    st = store.Store(0, str(tmpdir))
+    st.read_state()
+    rl = log.RaftLog(None)
+    rl.add(log.logentry(1, 'abcd', {'data': 'a msg'}))
+    rl.add(log.logentry(1, 'abcde', {'data': 'another msg'}))
+    rl.commit(1, 1)
+    peers = {'mr excalibur': ('192.168.0.15', 2995)}
+    st.write_state(25, 'mr excalibur', rl.take_unsaved(), peers, 'conan',
+                   rl.get_commit_index())
+    st.close()
+    st = store.Store(0, str(tmpdir))
+    term, voted, llog, rpeers, uuid = st.read_state()
+    assert (term, voted, rpeers, uuid) == (25, 'mr excalibur', peers, 'conan')
+    # only entries from the commit index on are read in
+    assert sorted(llog) == [1, 2]
+    llog = log.RaftLog(llog, st).dump()
+    assert sorted(llog) == [0, 1, 2]
+    assert llog[1]['msg'] == {'data': 'a msg'}
+    assert llog[1]['committed'] == True
+    assert llog[2]['committed'] == False
+
+def test_incremental(tmpdir):
+    # each write only appends what it's given
+    st = store.Store(0, str(tmpdir))
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a')], {}, 'x')
+    size = os.path.getsize(st.segfile(0))
+    st.write_state(1, None, [mle(2, 1, 'b')], {}, 'x')
+    assert os.path.getsize(st.segfile(0)) < 2 * size
+    st.write_state(2, 'x', [], {}, 'x')
+    st.close()
+    term, voted, llog, _, _ = store.Store(0, str(tmpdir)).read_state()
+    assert (term, voted) == (2, 'x')
+    assert sorted(llog) == [0, 1, 2]
+
+def test_overwrite(tmpdir):
+    # a record for an earlier index truncates the log there
+    st = store.Store(0, str(tmpdir))
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a'), mle(2, 1, 'b'),
+                             mle(3, 1, 'c')], {}, 'x')
+    st.write_state(2, None, [mle(2, 2, 'd')], {}, 'x')
+    st.close()
+    _, _, llog, _, _ = store.Store(0, str(tmpdir)).read_state()
+    assert sorted(llog) == [0, 1, 2]
+    assert llog[2]['msgid'] == 'd'
+
+def test_segments(tmpdir):
+    st = store.Store(0, str(tmpdir), segsize=64)
+    st.read_state()
+    ents = [mle(i, 1, 'msg%d' % i) for i in range(20)]
+    for ent in ents:
+        st.write_state(1, None, [ent], {}, 'x')
+    st.close()
+    assert len(st.list_segments()) > 1
+    _, _, llog, _, _ = store.Store(0, str(tmpdir)).read_state()
+    assert sorted(llog) == list(range(20))
+
+def test_torn_tail(tmpdir):
+    st = store.Store(0, str(tmpdir))
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a'), mle(2, 1, 'b')],
+                   {}, 'x')
+    st.close()
+    fname = st.segfile(0)
+    size = os.path.getsize(fname)
+    with open(fname, 'r+b') as w:
+        w.truncate(size - 3)
+    st = store.Store(0, str(tmpdir))
+    _, _, llog, _, _ = st.read_state()
+    assert sorted(llog) == [0, 1]
+    # the torn record is gone from disk, and new writes land cleanly
+    st.write_state(1, None, [mle(2, 1, 'c')], {}, 'x')
+    st.close()
+    _, _, llog, _, _ = store.Store(0, str(tmpdir)).read_state()
+    assert llog[2]['msgid'] == 'c'
+
+def test_corrupt_record(tmpdir):
+    st = store.Store(0, str(tmpdir))
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a')], {}, 'x')
+    st.close()
+    fname = st.segfile(0)
+    with open(fname, 'r+b') as w:
+        w.seek(-1, os.SEEK_END)
+        w.write(b'\xff')
+    _, _, llog, _, _ = store.Store(0, str(tmpdir)).read_state()
+    assert sorted(llog) == [0]
+
+def test_snapshot(tmpdir):
+    st = store.Store(0, str(tmpdir), segsize=64)
+    st.read_state()
+    for i in range(20):
+        st.write_state(1, None, [mle(i, 1, 'msg%d' % i)], {}, 'x', i)
+    nsegs = len(st.list_segments())
+    st.write_snapshot(12, 1, b'\x00\xffstate')
+    assert len(st.list_segments()) < nsegs
+    st.close()
+    st = store.Store(0, str(tmpdir))
+    _, _, llog, _, _ = st.read_state()
+    assert st.read_snapshot() == (12, 1, b'\x00\xffstate')
+    llog = log.RaftLog(llog, st).dump()
+    assert sorted(llog) == list(range(12, 20))
+    assert llog[12]['msgid'] == ''
+    assert llog[12]['committed'] == True
+
+def test_durability(tmpdir, monkeypatch):
+    syncs = []
+    monkeypatch.setattr(os, 'fsync', lambda fd: syncs.append(fd))
+    # strict syncs every write
+    st = store.Store(0, str(tmpdir.join('strict')), durability=store.STRICT)
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a')], {}, 'x')
+    assert st.durable_index == 1
+    assert syncs
+    # the metadata is on disk before it replaces the old, even when only
+    # the commit index changed
+    del syncs[:]
+    renames = []
+    rename = os.rename
+    def renaming(src, dst):
+        renames.append(len(syncs))
+        rename(src, dst)
+    monkeypatch.setattr(os, 'rename', renaming)
+    st.write_state(1, None, [], {}, 'x', 1)
+    assert renames == [1]
+    monkeypatch.setattr(os, 'rename', rename)
+    # batch syncs once it's due
+    del syncs[:]
+    st = store.Store(0, str(tmpdir.join('batch')), durability=store.BATCH,
+                     sync_interval=10)
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a')], {}, 'x')
+    st.write_state(1, None, [mle(2, 1, 'b')], {}, 'x', 1)
+    assert st.durable_index == -1
+    assert st.sync_if_due() == -1
+    assert 0 < st.sync_wait() <= 10
+    assert st.sync_if_due(st.unsynced_since + 10) == 2
+    assert st.sync_wait() == None
+    # rewriting a synced entry makes it not durable again
+    st.write_state(1, None, [mle(1, 2, 'c')], {}, 'x', 1)
+    assert st.durable_index == 0
+    # or once enough is waiting
+    st.sync_bytes = 1
+    st.write_state(1, None, [mle(2, 2, 'd')], {}, 'x', 1)
+    assert st.durable_index == 2
+    # none never syncs, and everything counts as durable right away
+    del syncs[:]
+    st = store.Store(0, str(tmpdir.join('none')), durability=store.NONE)
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a')], {}, 'x')
+    assert st.durable_index == 1
+    assert syncs == []
+
+def test_read_from_disk(tmpdir):
+    # entries behind the commit index are read back from the segments
+    st = store.Store(0, str(tmpdir), segsize=64)
+    st.read_state()
+    rl = log.RaftLog(None, st)
+    for i in range(1, 30):
+        rl.add(log.logentry(i // 10, 'msg%d' % i, {'n': i}))
+    rl.commit(25, 2)
+    st.write_state(2, None, rl.take_unsaved(), {}, 'x', 25)
+    # a follower overwrote part of its tail
+    rl.add(dict(index=27, term=3, msgid='new', msg={'n': 'new'}))
+    st.write_state(3, None, rl.take_unsaved(), {}, 'x', 25)
+    rl.release(20)
+    assert rl.entries[0].index == 20
+    assert rl.get(5)['msg'] == {'n': 5}
+    assert rl.get(5)['committed'] == True
+    assert rl.get_by_uuid('msg3')['index'] == 3
+    assert list(rl.logs_after_index(10, 3)) == [11, 12, 13]
+    st.close()
+    st = store.Store(0, str(tmpdir))
+    _, _, llog, _, _ = st.read_state()
+    assert sorted(llog) == [25, 26, 27]
+    rl = log.RaftLog(llog, st)
+    assert rl.maxindex() == 27
+    assert rl.get_commit_index() == 25
+    assert rl.get(24)['msg'] == {'n': 24}
+    assert rl.get(27)['msgid'] == 'new'
+    assert rl.has_uuid('msg28') == False
+    assert rl.get_by_uuid('msg1')['index'] == 1
+    assert rl.last_index_of_term(2) == 26
+    assert rl.term_start(15) == 10
+    # what we send followers is what's on disk, byte for byte
+    assert rl.get(7).encoded() == log.LogEntry(0, 'msg7', {'n': 7}, 7).encoded()
+
+def test_checkpoint(tmpdir):
+    st = store.Store(0, str(tmpdir), segsize=256)
+    st.read_state()
+    rl = log.RaftLog(None, st)
+    for i in range(1, 30):
+        rl.add(log.logentry(i // 10, 'msg%d' % i, {'n': i}))
+    rl.commit(25, 2)
+    st.write_state(2, None, rl.take_unsaved(), {}, 'x', 25)
+    st.write_checkpoint(*rl.index_state())
+    assert st.checkpointed == 29
+    # written after the checkpoint: an overwrite and some new entries
+    rl.add(dict(index=27, term=3, msgid='new', msg={'n': 'new'}))
+    rl.add(dict(index=28, term=3, msgid='newer', msg={'n': 'newer'}))
+    st.write_state(3, None, rl.take_unsaved(), {}, 'x', 25)
+    st.close()
+    st = store.Store(0, str(tmpdir))
+    # the scan starts where the checkpoint left off
+    scanned = []
+    read_segment = st.read_segment
+    def counting(seq, pos=0):
+        for off, payload in read_segment(seq, pos):
+            scanned.append(off)
+            yield off, payload
+    st.read_segment = counting
+    _, _, llog, _, _ = st.read_state()
+    assert len(scanned) == 2
+    assert sorted(llog) == [25, 26, 27, 28]
+    rl = log.RaftLog(llog, st)
+    assert rl.maxindex() == 28
+    assert rl.get(12)['msg'] == {'n': 12}
+    assert rl.get(28)['msgid'] == 'newer'
+    assert rl.get_by_uuid('msg3')['index'] == 3
+    assert rl.has_uuid('msg29') == False
+    assert rl.last_index_of_term(3) == 28
+    assert rl.term_start(15) == 10
+    # a snapshot taken after the checkpoint
+    st.write_snapshot(20, 2, b'state')
+    st.close()
+    st = store.Store(0, str(tmpdir))
+    _, _, llog, _, _ = st.read_state()
+    rl = log.RaftLog(llog, st)
+    assert rl.snapidx == 20
+    assert rl.get_by_uuid('msg3') == None
+    assert rl.get(22)['msg'] == {'n': 22}
+    assert rl.term_start(22) == 20
+
+def test_stale_checkpoint(tmpdir):
+    # a checkpoint past the end of the wal is ignored
+    st = store.Store(0, str(tmpdir))
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a'), mle(2, 1, 'b')],
+                   {}, 'x')
+    st.write_checkpoint([0, 1], [0, 1],
+                        log.MsgidWindow(10, [(0, ''), (1, 'a'), (2, 'b')]))
+    st.close()
+    fname = st.segfile(0)
+    with open(fname, 'r+b') as w:
+        w.truncate(os.path.getsize(fname) - 3)
+    _, _, llog, _, _ = store.Store(0, str(tmpdir)).read_state()
+    assert sorted(llog) == [0, 1]
+
+def test_reset_survives_restart(tmpdir):
+    # a snapshot that throws away a log it disagrees with throws it away
+    # on disk too
+    st = store.Store(0, str(tmpdir))
+    st.read_state()
+    rl = log.RaftLog(None, st)
+    for i in range(1, 11):
+        rl.add(log.logentry(1, 'msg%d' % i, {'n': i}))
+    st.write_state(1, None, rl.take_unsaved(), {}, 'x')
+    st.write_snapshot(8, 2, b'state')
+    rl.reset(8, 2)
+    st.write_state(2, None, rl.take_unsaved(), {}, 'x', 8)
+    st.close()
+    st = store.Store(0, str(tmpdir))
+    _, _, llog, _, _ = st.read_state()
+    rl = log.RaftLog(llog, st)
+    assert rl.get_max_index_term() == (8, 2)
+    assert rl.last_index_of_term(1) is None
+    assert rl.has_uuid('msg9') == False
+    rl.add(log.logentry(2, 'msg9', {'n': 9}))
+    assert rl.get_max_index_term() == (9, 2)
+
+def test_bad_checkpoint(tmpdir):
+    # an empty, garbled or incomplete checkpoint means a full scan
+    st = store.Store(0, str(tmpdir))
+    st.read_state()
+    st.write_state(1, None, [mle(0, 0), mle(1, 1, 'a'), mle(2, 1, 'b')],
+                   {}, 'x')
+    st.close()
+    for data in (b'', b'\xc1garbage', b'\x81\xa3pos\x92\x00\x00'):
+        with open(st.checkpointfile(), 'wb') as w:
+            w.write(data)
+        _, _, llog, _, _ = store.Store(0, str(tmpdir)).read_state()
+        assert sorted(llog) == [0, 1, 2]
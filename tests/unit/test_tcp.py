@@ -5,22 +5,170 @@ from mock import Mock
 def tcp(monkeypatch):
     import raft.tcp as tcp
     socket = Mock()
-    thread = Mock()
+    selectors = Mock()
+    selectors.EVENT_READ = 1
+    selectors.EVENT_WRITE = 2
+
     monkeypatch.setattr(tcp, 'socket', socket)
-    monkeypatch.setattr(tcp, 'thread', thread)
+    monkeypatch.setattr(tcp, 'selectors', selectors)
     tcpobj = tcp.TCP(9990, 'uuid')
-    return tcpobj, socket, thread
+    return tcpobj, socket, selectors
 
 def test_start(tcp):
-    tcpo, sock, thread = tcp
+    tcpo, sock, selectors = tcp
     tcpo.start()
     assert sock.socket().bind.called == True
+    # the listener is registered once, up front
+    tcpo.sel.register.assert_called_with(sock.socket(),
+                                         selectors.EVENT_READ)
 
 def test_connect(tcp):
-    tcpo, sock, thread = tcp
+    tcpo, sock, _ = tcp
     addr = ('otherhost', 1234)
     # test that connect aborts when the addr already exists
     tcpo.a2c[addr] = 'hi'
     tcpo.connect(addr)
     assert sock.socket.called == False
     del tcpo.a2c[addr]
+
+def poll(tcpo, count):
+    msgs = []
+    for _ in range(50):
+        for uuid, ms in tcpo.recv(0.01) or []:
+            msgs.extend((uuid, bytes(m)) for m in ms)
+        if len(msgs) >= count:
+            break
+    return msgs
+
+def test_loopback():
+    import socket
+    import raft.tcp as tcp
+    a = tcp.start(0, 'a')
+    b = tcp.start(0, 'b')
+    try:
+        assert a.connect(('127.0.0.1', b.srv.getsockname()[1]))
+        for _ in range(50):
+            if 'b' in a and 'a' in b:
+                break
+            a.recv(0.01)
+            b.recv(0.01)
+        assert 'b' in a
+        assert 'a' in b
+        # both ends of the connection send small messages straight away
+        for conn in (a.u2c['b'], b.u2c['a']):
+            assert conn.getsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY)
+        a.send(b'hello', 'b')
+        a.send(b'there', 'b')
+        assert poll(b, 2) == [('a', b'hello'), ('a', b'there')]
+        b.send(b'back', 'a')
+        assert poll(a, 1) == [('b', b'back')]
+
+    finally:
+        a.shutdown()
+        b.shutdown()
+
+def test_crossed_connections():
+    # both ends connect at once: whichever connection each sends on,
+    # what arrives on the other is still from the right uuid
+    import raft.tcp as tcp
+    a = tcp.start(0, 'a')
+    b = tcp.start(0, 'b')
+    try:
+        assert a.connect(('127.0.0.1', b.srv.getsockname()[1]))
+        assert b.connect(('127.0.0.1', a.srv.getsockname()[1]))
+        for _ in range(50):
+            if len(a.names) == 2 and len(b.names) == 2:
+                break
+            a.recv(0.01)
+            b.recv(0.01)
+        assert sorted(a.names.values()) == ['b', 'b']
+        for conn in list(b.names):
+            b.write(conn, b'hello')
+        assert poll(a, 2) == [('b', b'hello'), ('b', b'hello')]
+    finally:
+        a.shutdown()
+        b.shutdown()
+
+def test_write_queue(tcp):
+    import errno
+    import socket as realsocket
+    tcpo, sock, selectors = tcp
+    sock.error = realsocket.error
+    tcpo.high_water = 20
+    tcpo.low_water = 10
+    conn = Mock()
+    tcpo.u2c['peer'] = conn
+    wire = bytearray()
+    def send_some(data):
+        # the kernel takes 6 bytes and then it's full
+        wire.extend(data[:6])
+        conn.send.side_effect = realsocket.error(errno.EAGAIN, 'full')
+        return 6
+    conn.send.side_effect = send_some
+    tcpo.send(b'0123456789', 'peer')
+    tcpo.send(b'abcdefghij', 'peer')
+    # nothing was dropped, and we'll be told when we can write more
+    assert tcpo.buffered('peer') == 2 * 14 - 6
+    assert tcpo.writable('peer') == False
+    tcpo.sel.modify.assert_called_with(
+        conn, selectors.EVENT_READ | selectors.EVENT_WRITE)
+    conn.send.side_effect = lambda data: wire.extend(data) or len(data)
+    tcpo.flush(conn)
+    assert tcpo.buffered('peer') == 0
+    assert tcpo.writable('peer') == True
+    tcpo.sel.modify.assert_called_with(conn, selectors.EVENT_READ)
+    assert bytes(wire) == (b'\x00\x00\x00\x0e0123456789'
+                           b'\x00\x00\x00\x0eabcdefghij')
+
+class FakeConn(object):
+    # hands recv_into whatever's been queued, in the chunks given
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view):
+        chunk = self.chunks.pop(0)
+        if len(chunk) > len(view):
+            self.chunks.insert(0, chunk[len(view):])
+            chunk = chunk[:len(view)]
+        view[:len(chunk)] = chunk
+        return len(chunk)
+
+def frame(msg):
+    import struct
+    return struct.pack("!I", len(msg) + 4) + msg
+
+def test_inbox_partial_frames():
+    import raft.tcp as tcp
+    data = frame(b'hello') + frame(b'there')
+    conn = FakeConn(data[:3], data[3:12], data[12:])
+    inbox = tcp.Inbox(16)
+    inbox.fill(conn, 16)
+    assert list(inbox.frames()) == []
+    inbox.fill(conn, 16)
+    assert [bytes(f) for f in inbox.frames()] == [b'hello']
+    inbox.fill(conn, 16)
+    assert [bytes(f) for f in inbox.frames()] == [b'there']
+
+def test_inbox_grows_without_moving_frames():
+    import raft.tcp as tcp
+    big = b'x' * 1000
+    data = frame(b'small') + frame(big)
+    conn = FakeConn(data)
+    inbox = tcp.Inbox(16)
+    inbox.fill(conn, 16)
+    first = list(inbox.frames())
+    # once we know how big the next frame is, reads make room for all of it
+    inbox.fill(conn, 16)
+    assert len(inbox.buf) >= 1004
+    second = list(inbox.frames())
+
+
+    assert [bytes(f) for f in second] == [big]
+    assert [bytes(f) for f in first] == [b'small']
+
+def test_inbox_bad_frame():
+    import raft.tcp as tcp
+    inbox = tcp.Inbox(16)
+    inbox.fill(FakeConn(b'\x00\x00\x00\x00'), 16)
+    with pytest.raises(ValueError):
+        list(inbox.frames())